@@ -4,19 +4,27 @@ import re
 import json
 import random
 import pandas as pd
+import numpy as np
 import gspread
 import warnings
 import urllib.request
 import logging
 import base64, gzip, time
+import pickle
+import zlib
 import httpx
 import math
+import heapq
+import hashlib
+import hmac
 import asyncio
+import functools
+import importlib.util
 from aiohttp import web
-from html import escape, unescape
+from html import escape
 from datetime import datetime
 from pathlib import Path
-from collections import Counter
+from collections import Counter, OrderedDict, defaultdict, deque
 from fpdf import FPDF                                         #könnte gelöscht werden -> ausprobieren wenn mal zeit besteht
 from fpdf.enums import XPos, YPos
 from dotenv import load_dotenv
@@ -25,16 +33,30 @@ from decimal import Decimal, ROUND_HALF_UP
 from google.cloud import firestore
 from telegram.constants import ParseMode
 from google.oauth2.service_account import Credentials
-from telegram.error import BadRequest
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import BadRequest, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, Message
 import telegram
 from persistence import (
     user_key,
-    get_profile as store_get_profile, set_profile as store_set_profile,
-    get_favorites as store_get_favorites, set_favorites as store_set_favorites,
+    # Async-API (Handler laufen im Event-Loop → nie blockierend speichern/laden)
+    aget_profile as store_get_profile, aset_profile as store_set_profile,
+    aget_favorites as store_get_favorites, aset_favorites as store_set_favorites,
+    aadd_favorites as store_add_favorites, aremove_favorites as store_remove_favorites,
     # Neu für Sessions (pro Chat):
     chat_key,
-    get_session as store_get_session, set_session as store_set_session, delete_session as store_delete_session,
+    aget_session as store_get_session, aset_session as store_set_session, adelete_session as store_delete_session,
+    aget_pinned_plans as store_get_pinned_plans, aset_pinned_plans as store_set_pinned_plans,
+    adelete_pinned_plans as store_delete_pinned_plans,
+    aflush_sessions as store_flush_sessions, session_write_stats as store_session_write_stats,
+    # Read-Through-Cache (einzige In-Memory-Kopie von Profilen/Favoriten/Sessions)
+    cache_peek, cache_put, cache_invalidate, cache_stats as store_cache_stats, cache_sizes as store_cache_sizes,
+    # Mehrere Entitäten in einem Commit (Batch/Transaktion)
+    unit_of_work,
+    # PTB-Zustand (StorePersistence)
+    aget_ptb_state as store_get_ptb_state, aget_ptb_states as store_get_ptb_states,
+    # Update-Deduplizierung über Instanzen hinweg
+    aclaim_update as store_claim_update,
 )
 from telegram.ext import (
     ApplicationBuilder,
@@ -45,8 +67,24 @@ from telegram.ext import (
     ContextTypes,
     CallbackQueryHandler,
     Defaults,
+    TypeHandler,
+    BasePersistence,
+    PersistenceInput,
+    BaseUpdateProcessor,
+    ApplicationHandlerStop,
+    BaseRateLimiter,
+    ExtBot,
 )
 from telegram.warnings import PTBUserWarning
+from metrics import (
+    HANDLER_SECONDS, LANE_WAIT_SECONDS, UPDATES_DROPPED, SHEETS_CACHE,
+    RATE_LIMIT_WAIT_SECONDS, RATE_LIMIT_DELAYED, RATE_LIMIT_RETRY_AFTER,
+    QUEUE_DEPTH, STORE_SIZE, HTTP_POOL, timed, render as render_metrics,
+)
+from tracing import (
+    trace_update, traced, span as trace_span, record as trace_record,
+    mark_error as trace_mark_error, stats as trace_stats,
+)
 
 warnings.filterwarnings("ignore", category=PTBUserWarning)
 
@@ -70,6 +108,14 @@ HTTPX_CLIENT  = httpx.AsyncClient(timeout=HTTPX_TIMEOUT, limits=HTTPX_LIMITS, fo
 
 
 MENU_INPUT, ASK_BEILAGEN, SELECT_MENUES, BEILAGEN_SELECT, ASK_FINAL_LIST, ASK_SHOW_LIST, FERTIG_PERSONEN, REZEPT_INDEX, REZEPT_PERSONEN, TAUSCHE_SELECT, TAUSCHE_CONFIRM, ASK_CONFIRM, EXPORT_OPTIONS, FAV_OVERVIEW, FAV_DELETE_SELECT, PDF_EXPORT_CHOICE, FAV_ADD_SELECT, RESTART_CONFIRM, PROFILE_CHOICE, PROFILE_NEW_A, PROFILE_NEW_B, PROFILE_NEW_C, PROFILE_OVERVIEW, QUICKONE_START, QUICKONE_CONFIRM, PERSONS_SELECTION, PERSONS_MANUAL, MENU_COUNT, MENU_AUFWAND = range(29)
+# Zustandsnummer → Name (Labels der Handler-Metriken)
+STATE_NAMES = dict(enumerate((
+    "MENU_INPUT ASK_BEILAGEN SELECT_MENUES BEILAGEN_SELECT ASK_FINAL_LIST ASK_SHOW_LIST FERTIG_PERSONEN "
+    "REZEPT_INDEX REZEPT_PERSONEN TAUSCHE_SELECT TAUSCHE_CONFIRM ASK_CONFIRM EXPORT_OPTIONS FAV_OVERVIEW "
+    "FAV_DELETE_SELECT PDF_EXPORT_CHOICE FAV_ADD_SELECT RESTART_CONFIRM PROFILE_CHOICE PROFILE_NEW_A "
+    "PROFILE_NEW_B PROFILE_NEW_C PROFILE_OVERVIEW QUICKONE_START QUICKONE_CONFIRM PERSONS_SELECTION "
+    "PERSONS_MANUAL MENU_COUNT MENU_AUFWAND"
+).split()))
 
 # HELPER:
 
@@ -110,6 +156,7 @@ TOKEN = os.getenv("TELEGRAM_API_KEY")
 BASE_URL = _compute_base_url()
 print(f"ENV CHECK → PORT={os.getenv('PORT','8080')} BASE_URL={'gesetzt' if BASE_URL else 'leer'}")
 WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # Bearer-Token für /metrics; auf Cloud Run ohne Token kein /metrics
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")  # darf None sein
 SHEET_ID = os.getenv("SHEET_ID", "1XzhGPWz7EFJAyZzaJQhoLyl-cTFNEa0yKvst0D0yVUs")
@@ -262,25 +309,32 @@ def _cache_read_if_fresh(name: str, ttl_sec: int):
     if not FS:
         return None
     try:
-        doc = _fs_doc_for(name).get()
+        with timed("firestore", "sheets_cache_read"):
+            doc = _fs_doc_for(name).get()
     except Exception as e:
         logging.warning("Sheets-Cache: Firestore-Read fehlgeschlagen (%s) → Fallback auf Sheets", e)
+        SHEETS_CACHE.inc(sheet=name, result="error")
         return None
 
     if not doc.exists:
+        SHEETS_CACHE.inc(sheet=name, result="miss")
         return None
 
     d = doc.to_dict() or {}
     updated_ts = int(d.get("updated_ts", 0))
     if time.time() - updated_ts > ttl_sec:
+        SHEETS_CACHE.inc(sheet=name, result="stale")
         return None  # abgelaufen
 
     try:
         payload = gzip.decompress(base64.b64decode(d["payload_b64_gzip"]))
-        return json.loads(payload.decode("utf-8"))
+        obj = json.loads(payload.decode("utf-8"))
     except Exception as e:
         logging.warning("Sheets-Cache: Dekomprimieren/JSON fehlgeschlagen (%s) → Fallback auf Sheets", e)
+        SHEETS_CACHE.inc(sheet=name, result="error")
         return None
+    SHEETS_CACHE.inc(sheet=name, result="hit")
+    return obj
 
 
 def _cache_write(name: str, compact_obj: dict):
@@ -289,31 +343,20 @@ def _cache_write(name: str, compact_obj: dict):
     try:
         payload = json.dumps(compact_obj, ensure_ascii=False).encode("utf-8")
         b64 = base64.b64encode(gzip.compress(payload)).decode("ascii")
-        _fs_doc_for(name).set(
-            {
-                "payload_b64_gzip": b64,
-                "updated_ts": int(time.time()),
-                "ttl_sec": SHEETS_CACHE_TTL_SEC,
-                "schema_version": 1,
-            },
-            merge=True,
-        )
+        with timed("firestore", "sheets_cache_write"):
+            _fs_doc_for(name).set(
+                {
+                    "payload_b64_gzip": b64,
+                    "updated_ts": int(time.time()),
+                    "ttl_sec": SHEETS_CACHE_TTL_SEC,
+                    "schema_version": 1,
+                },
+                merge=True,
+            )
     except Exception as e:
         logging.warning("Sheets-Cache: Firestore-Write fehlgeschlagen (%s) – ignoriere und fahre fort", e)
 
 
-def load_favorites() -> dict:
-    """Favoriten aus Datei laden (oder leeres Dict, wenn Datei fehlt)"""
-    try:
-        with open(FAV_FILE, encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-    except json.JSONDecodeError:
-        print("⚠️ Fehler beim Laden der Favoriten – ungültiges JSON.")
-        return {}
-
-
 def format_amount(q):
     """
     Gibt q zurück:
@@ -377,6 +420,32 @@ def normalize_quantity(amount, unit):
     return a, u_raw
 
 
+def to_base_unit(amount, unit):
+    """
+    Gegenstück zu normalize_quantity: rechnet in die Basiseinheit zurück
+    (kg → g, l/dl → ml), damit Mengen verschiedener Pläne summierbar sind.
+    Rückgabe: (amount, unit)
+    """
+    try:
+        a = float(amount)
+    except Exception:
+        return amount, unit
+
+    u_raw = (unit or "").strip()
+    u = u_raw.lower()
+    if u in ("g", "gramm", "gr"):
+        return a, "g"
+    if u in ("kg", "kilogramm"):
+        return a * 1000.0, "g"
+    if u in ("ml", "milliliter"):
+        return a, "ml"
+    if u in ("dl", "deziliter"):
+        return a * 100.0, "ml"
+    if u in ("l", "liter"):
+        return a * 1000.0, "ml"
+    return a, u_raw
+
+
 def dishes_header(count: int, step: int | None = None) -> str:
     """
     Baut den Titel für die Gerichte-Liste.
@@ -424,41 +493,72 @@ async def show_final_dishes_and_ask_persons(update: Update, context: ContextType
         ) + "\n"
 
     msg = await context.bot.send_message(chat_id, pad_message(text))
-    context.user_data.setdefault("flow_msgs", []).append(msg.message_id)
+    track_msg(context, "flow_msgs", msg.message_id)
 
     # 4) Personen-Dialog
     return await ask_for_persons(update, context)
 
 
 
-# ---- Debounced Redraw für 'Definiere Aufwand' ----
-async def _debounced_aufwand_render(q, context):
-    # schon ein Render geplant?
-    task = context.user_data.get("aufw_render_task")
-    if task and not task.done():
-        # nur markieren, dass ein neuer Stand vorhanden ist
-        context.user_data["aufw_dirty"] = True
-        return
+# ---- Debounced Redraw für alle Mehrfachauswahl-Keyboards ----
+EDIT_DEBOUNCE_S = float(os.getenv("EDIT_DEBOUNCE_S", "0.12"))
+
+class EditDebouncer:
+    """
+    Bündelt schnelle Klicks auf Toggle-Keyboards: pro (chat, message) höchstens
+    ein Edit je Zeitfenster, und zwar mit dem zuletzt übergebenen Render – der
+    liest den Stand erst beim Ausführen, zeichnet also immer den aktuellen.
+    Edits derselben Nachricht laufen nie parallel (keine Überholer).
+    """
 
-    context.user_data["aufw_dirty"] = True
+    def __init__(self, window: float = EDIT_DEBOUNCE_S):
+        self.window = window
+        self._pending: dict[tuple[int, int], list] = {}     # (chat, msg) → [render | None, Task]
+        self.requested = self.rendered = 0
+
+    @staticmethod
+    def _key(message) -> tuple[int, int]:
+        return (message.chat_id, message.message_id)
+
+    def schedule(self, message, render) -> None:
+        """render: async Callable ohne Argumente, das den aktuellen Stand zeichnet."""
+        self.requested += 1
+        key = self._key(message)
+        entry = self._pending.get(key)
+        if entry is not None:
+            entry[0] = render               # nur den neuesten Stand merken
+            return
+        entry = [render, None]
+        self._pending[key] = entry
+        entry[1] = asyncio.create_task(self._run(key, entry))
+
+    def cancel(self, message) -> None:
+        """Geplanten Render verwerfen (z. B. bei „Fertig“, bevor die Nachricht wegkommt)."""
+        entry = self._pending.pop(self._key(message), None)
+        if entry and entry[1] and not entry[1].done():
+            entry[1].cancel()
 
-    async def _runner():
+    async def _run(self, key, entry) -> None:
         try:
-            # kurzer Puffer für schnelle Mehrfachklicks
-            await asyncio.sleep(0.12)
-            if context.user_data.get("aufw_dirty"):
-                context.user_data["aufw_dirty"] = False
-                verteilung = context.user_data["aufwand_verteilung"]
-                total = context.user_data["menu_count"]
-                await q.message.edit_reply_markup(
-                    reply_markup=build_aufwand_keyboard(verteilung, total)
-                )
-        except Exception:
-            pass
+            while entry[0] is not None:
+                await asyncio.sleep(self.window)
+                render, entry[0] = entry[0], None
+                try:
+                    await render()
+                    self.rendered += 1
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        logging.debug("Debounced Edit %s fehlgeschlagen: %s", key, e)
+                except Exception as e:
+                    logging.debug("Debounced Edit %s fehlgeschlagen: %s", key, e)
         finally:
-            context.user_data["aufw_render_task"] = None
+            if self._pending.get(key) is entry:
+                self._pending.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"requested": self.requested, "rendered": self.rendered, "pending": len(self._pending)}
 
-    context.user_data["aufw_render_task"] = asyncio.create_task(_runner())
+edit_debouncer = EditDebouncer()
 
 
 def load_json(filename):
@@ -519,101 +619,437 @@ async def mark_yes_no(q, yes_selected: bool, yes_cb: str, no_cb: str):
         # falls Nachricht inzwischen weitergeleitet/gelöscht wurde – ignorieren
         pass
 
-def load_profiles() -> dict:
-    """Lädt alle gespeicherten Nutzerprofile aus der JSON-Datei."""
-    global profiles
-    profiles = load_json(PROFILES_FILE)
-    return profiles
+class _CacheView:
+    """
+    Dict-artige Sicht auf den Read-Through-Cache in persistence.py – hält
+    selbst keine Daten. Schlüssel ist die Telegram-ID als String; key_fn
+    bildet sie auf den Store-Schlüssel ab. Nachladen passiert ausschließlich
+    über die ensure_*_loaded-Helfer (async), Lesen hier ist immer I/O-frei.
+    """
+
+    def __init__(self, namespace: str, key_fn):
+        self.namespace = namespace
+        self.key_fn = key_fn
+
+    def get(self, uid, default=None):
+        v = cache_peek(self.namespace, self.key_fn(uid))
+        return default if v is None else v
+
+    def __getitem__(self, uid):
+        v = cache_peek(self.namespace, self.key_fn(uid))
+        if v is None:
+            raise KeyError(uid)
+        return v
+
+    def __contains__(self, uid) -> bool:
+        return cache_peek(self.namespace, self.key_fn(uid)) is not None
+
+    def __setitem__(self, uid, value) -> None:
+        cache_put(self.namespace, self.key_fn(uid), value)
+
+    def __delitem__(self, uid) -> None:
+        cache_invalidate(self.namespace, self.key_fn(uid))
+
+    def pop(self, uid, default=None):
+        v = self.get(uid, default)
+        cache_invalidate(self.namespace, self.key_fn(uid))
+        return v
+
+    def setdefault(self, uid, default):
+        v = self.get(uid)
+        if v is None:
+            self[uid] = v = default
+        return v
+
+
+# Sessions liegen pro Chat im Store, der Bot adressiert sie aber per user_id.
+# Die Zuordnung user → zuletzt genutzter Chat merkt sich remember_chat().
+_CHAT_OF: dict[str, int] = {}
+_CHAT_OF_MAX = 10000
+
+def _session_key(uid) -> str:
+    return chat_key(_CHAT_OF.get(str(uid), int(uid)))
+
+async def remember_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Merkt user_id → chat_id (begrenzt, die älteste Zuordnung fliegt zuerst)."""
+    if update.effective_user and update.effective_chat:
+        uid = str(update.effective_user.id)
+        _CHAT_OF.pop(uid, None)
+        _CHAT_OF[uid] = update.effective_chat.id
+        if len(_CHAT_OF) > _CHAT_OF_MAX:
+            _CHAT_OF.pop(next(iter(_CHAT_OF)))
+
+async def prefetch_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    TypeHandler (group=-1): merkt den Chat und lädt Session, Profil und
+    Favoriten in den Cache, falls sie (z. B. nach Idle-Verdrängung) fehlen,
+    sowie die Conversation-States dieses Chats (andere Instanzen).
+    Bei Cache-Treffern kein I/O – die Handler lesen danach synchron.
+    """
+    await remember_chat(update, context)
+    if not (update.effective_user and update.effective_chat):
+        return
+    ukey = user_key(update.effective_user.id)
+    persistence = context.application.persistence
+    try:
+        await asyncio.gather(
+            store_get_session(chat_key(update.effective_chat.id)),
+            store_get_profile(ukey),
+            store_get_favorites(ukey),
+            *([persistence.refresh_conversations(update, context.application)]
+              if isinstance(persistence, StorePersistence) else []),
+        )
+    except Exception as e:
+        logging.warning("Prefetch für %s fehlgeschlagen: %s", ukey, e)
 
-def save_profiles() -> None:
-    """Speichert das globale profiles-Dict in die JSON-Datei."""
-    save_json(PROFILES_FILE, profiles)
+profiles = _CacheView("profiles", lambda uid: user_key(int(uid)))
+favorites = _CacheView("favorites", lambda uid: user_key(int(uid)))
+sessions = _CacheView("sessions", _session_key)
 
-def ensure_profile_loaded(uid_str: str) -> bool:
+async def ensure_profile_loaded(uid_str: str) -> bool:
     """
-    Stellt sicher, dass ein Profil für uid_str im lokalen Dict 'profiles' liegt.
-    Falls nicht vorhanden, wird es aus dem Persistenz-Layer (JSON/Firestore)
-    nachgeladen und in 'profiles' zwischengespeichert.
-    Rückgabe: True, wenn Profil vorhanden (nach dem Schritt), sonst False.
+    Stellt sicher, dass das Profil für uid_str im Cache liegt (Read-Through;
+    bei Treffer ohne I/O). Rückgabe: True, wenn ein Profil vorhanden ist.
     """
-    if uid_str in profiles and isinstance(profiles[uid_str], dict):
-        return True
     try:
         ukey = user_key(int(uid_str))
     except Exception:
         return False
-    data = store_get_profile(ukey)
-    if data:
-        profiles[uid_str] = data
-        return True
-    return False
+    data = await store_get_profile(ukey)
+    return bool(data) and isinstance(data, dict)
 
-def ensure_favorites_loaded(uid_str: str) -> None:
+async def ensure_favorites_loaded(uid_str: str) -> None:
     """
-    Stellt sicher, dass favorites[uid_str] eine Liste ist.
-    Lädt sie bei Bedarf aus dem Persistenz-Layer (JSON/Firestore).
+    Stellt sicher, dass favorites[uid_str] eine Liste ist
+    (Read-Through über den Persistenz-Cache).
     """
-    if uid_str in favorites and isinstance(favorites[uid_str], list):
-        return
     try:
         ukey = user_key(int(uid_str))
-        favorites[uid_str] = store_get_favorites(ukey)
-        if not isinstance(favorites[uid_str], list):
+        if not isinstance(await store_get_favorites(ukey), list):
             favorites[uid_str] = []
     except Exception:
         favorites.setdefault(uid_str, [])
 
-def ensure_session_loaded_for_user_and_chat(update: Update) -> tuple[str, str]:
+@traced("session_load")
+async def ensure_session_loaded_for_user_and_chat(update: Update) -> tuple[str, str]:
     """
-    Lädt (falls nötig) die Chat-Session aus der Persistenz (Key = chat_id)
-    und legt sie in-memory unter sessions[uid] ab (Key = user_id).
+    Lädt (falls nötig) die Chat-Session aus der Persistenz (Key = chat_id);
+    im Bot ist sie danach unter sessions[uid] erreichbar (Key = user_id).
     Rückgabe: (uid_str, cid_str)
     """
     uid = str(update.effective_user.id)
     cid = str(update.effective_chat.id)
+    await remember_chat(update, None)
 
-    # Falls already vorhanden & nicht leer → fertig
-    if uid in sessions and isinstance(sessions[uid], dict) and sessions[uid]:
-        return uid, cid
-
-    # Aus Store pro Chat laden → unter uid ablegen
     try:
-        ckey = chat_key(int(cid))
-        data = store_get_session(ckey)
-        sessions[uid] = data if isinstance(data, dict) else {}
+        data = await store_get_session(chat_key(int(cid)))
+        if not isinstance(data, dict):
+            sessions[uid] = {}
     except Exception:
         sessions.setdefault(uid, {})
 
     return uid, cid
 
 
-def persist_session(update: Update) -> None:
+async def persist_session(update: Update) -> None:
     """
     Persistiert die aktuelle Session (Key = user_id in-memory) unter dem
     Chat-Schlüssel (Key = chat_id) im Store.
     """
     uid = str(update.effective_user.id)
     cid = str(update.effective_chat.id)
+    sess = sessions.get(uid)
+    if sess is None:
+        return                      # nichts im Cache → nichts (Leeres) überschreiben
     try:
         ckey = chat_key(int(cid))
-        store_set_session(ckey, sessions.get(uid, {}))
+        await store_set_session(ckey, sess)
     except Exception:
         # bewusst keine harten Fehler im Bot
         pass
 
+async def flush_session(update: Update) -> None:
+    """
+    Erzwingt das Schreiben der gepufferten Session dieses Chats
+    (Write-Behind) – am Ende einer Konversation aufrufen.
+    """
+    try:
+        await store_flush_sessions(chat_key(int(update.effective_chat.id)))
+    except Exception:
+        pass
+
+
+# ---- PTB-Persistenz (Conversation-States + user_data/chat_data über persistence.py)
+PTB_PERSISTENCE = os.getenv("PTB_PERSISTENCE", "1") == "1"
+PTB_CONV_MAX_AGE_SEC = float(os.getenv("PTB_CONV_MAX_AGE_H", "48")) * 3600
+# States anderer Instanzen pro Update nachladen braucht PTB-Interna
+# (ConversationHandler._conversations), geprüft nur für 21.x. Sonst – oder
+# mit PTB_CONV_LIVE=0 – lädt get_conversations() wie vorgesehen beim Boot.
+PTB_CONV_LIVE = (os.getenv("PTB_CONV_LIVE", "1") == "1"
+                 and (21, 8) <= tuple(telegram.__version_info__[:2]) < (22, 0))
+
+def _pack_ptb_data(data: dict) -> dict:
+    """user_data/chat_data → {"blob": base64(zlib(pickle))}; nicht picklebare Keys fallen weg."""
+    try:
+        raw = pickle.dumps(dict(data), protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        ok = {}
+        for k, v in data.items():
+            try:
+                pickle.dumps(v)
+                ok[k] = v
+            except Exception:
+                logging.info("PTB-Persistenz: '%s' nicht serialisierbar – übersprungen", k)
+        raw = pickle.dumps(ok, protocol=pickle.HIGHEST_PROTOCOL)
+    return {"blob": base64.b64encode(zlib.compress(raw)).decode("ascii"), "updated_at": int(time.time())}
+
+def _unpack_ptb_data(doc) -> dict:
+    if not doc or "blob" not in doc:
+        return {}
+    try:
+        return pickle.loads(zlib.decompress(base64.b64decode(doc["blob"])))
+    except Exception as e:
+        logging.warning("PTB-Persistenz: Daten unlesbar (%s) – starte leer", e)
+        return {}
+
+class StorePersistence(BasePersistence):
+    """
+    PTB-Persistenz auf Basis von persistence.py (JSON/SQLite/Firestore):
+      - user_data/chat_data werden lazy pro ID in refresh_*_data() geladen,
+        nicht beim Boot für alle Nutzer
+      - Conversation-States als ein Dokument je (Handler, Key); gelesen wird
+        bei Bedarf pro Update (refresh_conversations), nicht nur beim Boot →
+        mehrere Instanzen sehen die States der anderen (ohne PTB_CONV_LIVE:
+        einmal beim Boot über get_conversations). END löscht das Dokument,
+        Einträge ohne Änderung seit PTB_CONV_MAX_AGE_H verfallen
+      - PTB meldet Änderungen alle update_interval Sekunden; wir sammeln sie
+        und schreiben sie entprellt als EIN UnitOfWork-Commit
+    """
+
+    def __init__(self, update_interval: float = 5.0, flush_delay: float = 0.5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._flush_delay = flush_delay
+        self._conv_handlers: list | None = None                 # persistente ConversationHandler
+        self._conv_seen: OrderedDict[str, float] = OrderedDict()  # Doc-Key → letztes Update hier
+        self._loaded: OrderedDict[str, None] = OrderedDict()    # "user:<id>" / "chat:<id>" (LRU)
+        self._pending: dict[str, object] = {}                   # doc-key → Daten | None (löschen)
+        self._flush_task: asyncio.Task | None = None
+
+    # -- bot_data / callback_data: nicht genutzt
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    # -- user_data / chat_data (lazy)
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh(f"user:{user_id}", user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh(f"chat:{chat_id}", chat_data)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._queue(f"user:{user_id}", _pack_ptb_data(data))
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._queue(f"chat:{chat_id}", _pack_ptb_data(data))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded.pop(f"user:{user_id}", None)
+        self._queue(f"user:{user_id}", None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._loaded.pop(f"chat:{chat_id}", None)
+        self._queue(f"chat:{chat_id}", None)
+
+    # Gemerkte „schon geladen“-Keys; ein verdrängter Key wird beim nächsten
+    # Update höchstens erneut gelesen (befüllte Daten bleiben unangetastet)
+    _LOADED_MAX = 10000
+
+    async def _refresh(self, key: str, target: dict) -> None:
+        if key in self._loaded:
+            self._loaded.move_to_end(key)
+            return
+        self._loaded[key] = None
+        if len(self._loaded) > self._LOADED_MAX:
+            self._loaded.popitem(last=False)
+        if target:
+            return                      # schon in-memory befüllt → nichts überschreiben
+        try:
+            data = _unpack_ptb_data(await store_get_ptb_state(key))
+        except Exception as e:
+            logging.warning("PTB-Persistenz: Laden von %s fehlgeschlagen (%s)", key, e)
+            self._loaded.pop(key, None)
+            return
+        for k, v in data.items():
+            target.setdefault(k, v)
+
+    # -- Conversations
+    _CONV_SEEN_MAX = 10000
+
+    @staticmethod
+    def _conv_doc(name: str, key) -> str:
+        return f"conv:{name}:{json.dumps(list(key))}"
+
+    async def get_conversations(self, name: str):
+        # Mit PTB_CONV_LIVE kommen die States pro Update (refresh_conversations);
+        # hier dann nur das alte Sammel-Dokument conv:<name> überführen
+        try:
+            legacy = await store_get_ptb_state(f"conv:{name}")
+            docs = {} if PTB_CONV_LIVE else await store_get_ptb_states(f"conv:{name}:")
+        except Exception as e:
+            logging.warning("PTB-Persistenz: Laden von conv:%s fehlgeschlagen (%s)", name, e)
+            return {}
+        cutoff = time.time() - PTB_CONV_MAX_AGE_SEC
+        if legacy:
+            for kj, (state, ts) in (legacy.get("states") or {}).items():
+                if ts >= cutoff:
+                    self._pending.setdefault(f"conv:{name}:{kj}", {"state": state, "ts": ts})
+            self._queue(f"conv:{name}", None)
+        if PTB_CONV_LIVE:
+            return {}
+        states = {}
+        for doc_key, res in {**docs, **self._pending}.items():
+            if not doc_key.startswith(f"conv:{name}:") or not res or res.get("ts", 0) < cutoff:
+                continue
+            try:
+                states[tuple(json.loads(doc_key[len(name) + 6:]))] = res["state"]
+            except (ValueError, KeyError, TypeError):
+                continue
+        return states
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        if new_state is None or new_state == ConversationHandler.END:
+            self._queue(self._conv_doc(name, key), None)
+        else:
+            self._queue(self._conv_doc(name, key), {"state": new_state, "ts": int(time.time())})
+
+    def _persistent_conversations(self, application) -> list:
+        if self._conv_handlers is None:
+            found = []
+
+            def _walk(h):
+                if isinstance(h, ConversationHandler):
+                    if h.persistent and h.name and not h.per_message:
+                        found.append(h)
+                    for hs in [h.entry_points, h.fallbacks, *h.states.values()]:
+                        for sub in hs:
+                            _walk(sub)
+
+            for group in application.handlers.values():
+                for h in group:
+                    _walk(h)
+            self._conv_handlers = found
+        return self._conv_handlers
+
+    async def refresh_conversations(self, update: Update, application) -> None:
+        """
+        Vor der Handler-Auswahl (prefetch_user_state, group=-1): States dieses
+        Chats/Users aus dem Store holen, falls eine andere Instanz sie geändert
+        haben könnte. Hat diese Instanz den Key gerade selbst bedient (innerhalb
+        von update_interval + flush_delay), ist ihr Stand der neueste – kein Read.
+        """
+        if not PTB_CONV_LIVE:
+            return
+        chat, user = update.effective_chat, update.effective_user
+        now = time.monotonic()
+        fresh = self.update_interval + self._flush_delay + 1.0
+        todo = []
+        for h in self._persistent_conversations(application):
+            if (h.per_chat and not chat) or (h.per_user and not user):
+                continue
+            key = tuple(([chat.id] if h.per_chat else []) + ([user.id] if h.per_user else []))
+            doc = self._conv_doc(h.name, key)
+            last = self._conv_seen.pop(doc, None)
+            self._conv_seen[doc] = now
+            if len(self._conv_seen) > self._CONV_SEEN_MAX:
+                self._conv_seen.popitem(last=False)
+            if (last is not None and now - last < fresh) or doc in self._pending:
+                continue
+            todo.append((h, key, doc))
+        if not todo:
+            return
+        results = await asyncio.gather(*(store_get_ptb_state(doc) for _, _, doc in todo), return_exceptions=True)
+        cutoff = time.time() - PTB_CONV_MAX_AGE_SEC
+        for (h, key, doc), res in zip(todo, results):
+            if isinstance(res, Exception):
+                logging.warning("PTB-Persistenz: Laden von %s fehlgeschlagen (%s)", doc, res)
+                continue
+            if res and res.get("ts", 0) >= cutoff and res.get("state") != ConversationHandler.END:
+                self._apply_conversation_state(h, key, res["state"])
+            else:
+                self._apply_conversation_state(h, key, None)    # dort beendet/verfallen → hier auch
+
+    @staticmethod
+    def _apply_conversation_state(h, key, state) -> None:
+        """
+        Einzigen Zugriff auf PTB-Interna bündeln: PTB hat keine öffentliche
+        API, um einzelne States nachzuladen (nur get_conversations beim
+        Boot). Nur aktiv, wenn PTB_CONV_LIVE (geprüfte 21.x-Versionen).
+        """
+        convs = h._conversations
+        if state is not None:
+            convs.update_no_track({key: state})     # ohne „geändert“-Markierung → kein Rück-Write
+        else:
+            convs.pop(key, None)
+
+    # -- Schreiben (gesammelt + entprellt)
+    def _queue(self, key: str, value) -> None:
+        self._pending[key] = value
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self._flush_delay)
+        await self._write_pending()
+
+    async def _write_pending(self) -> None:
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        uow = unit_of_work()
+        for key, value in batch.items():
+            if value is None:
+                uow.delete_ptb_state(key)
+            else:
+                uow.set_ptb_state(key, value)
+        try:
+            await uow.acommit()
+        except Exception as e:
+            logging.warning("PTB-Persistenz: Commit von %d Einträgen fehlgeschlagen (%s)", len(batch), e)
+            for key, value in batch.items():
+                self._pending.setdefault(key, value)     # Neueres nicht überschreiben
+
+    async def flush(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_pending()
+
 
 
 
 async def cleanup_prof_loop(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     """Löscht alle während des Profil-Wizards entstandenen Nachrichten."""
-    bot = context.bot
-    msg_ids: list[int] = context.user_data.get("prof_msgs", [])
-    for mid in msg_ids:
-        try:
-            await bot.delete_message(chat_id, mid)
-        except Exception:
-            pass  # z. B. zu alt oder bereits gelöscht
-    context.user_data["prof_msgs"] = []
+    await purge_msgs(context, chat_id, ["prof_msgs"])
 
 
 async def cleanup_prof_loop_except_start(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
@@ -622,21 +1058,9 @@ async def cleanup_prof_loop_except_start(context: ContextTypes.DEFAULT_TYPE, cha
     AUSGENOMMEN die gemerkte Startfrage 'Wie möchtest Du fortfahren?'.
     """
     start_id = context.user_data.get("prof_start_msg_id")
-    msg_ids: list[int] = context.user_data.get("prof_msgs", [])
-
-    for mid in msg_ids:
-        if isinstance(start_id, int) and mid == start_id:
-            continue
-        try:
-            await context.bot.delete_message(chat_id, mid)
-        except Exception:
-            pass
-
+    await purge_msgs(context, chat_id, ["prof_msgs"], keep={start_id})
     # Liste auf die Startfrage reduzieren (falls vorhanden)
-    if isinstance(start_id, int):
-        context.user_data["prof_msgs"] = [start_id]
-    else:
-        context.user_data["prof_msgs"] = []
+    clear_tracked(context, "prof_msgs", start_id)
 
 
 def pad_message(text: str, min_width: int = 35) -> str:                       # definiert breite der nachrichten bzw. min breite
@@ -660,9 +1084,8 @@ async def safe_delete_and_untrack(context: ContextTypes.DEFAULT_TYPE, chat_id: i
     except Exception:
         pass
     try:
-        ids = context.user_data.get(list_key, [])
-        if isinstance(ids, list):
-            ids[:] = [mid for mid in ids if mid != message_id]
+        ids = tracked_msgs(context, list_key)
+        ids[:] = [mid for mid in ids if mid != message_id]
     except Exception:
         pass
 
@@ -704,7 +1127,7 @@ async def render_beilage_precheck_debug(update_or_query, context: ContextTypes.D
         if msg_obj is None:
             return
         m = await msg_obj.reply_text(dbg)
-        context.user_data.setdefault("flow_msgs", []).append(m.message_id)
+        track_msg(context, "flow_msgs", m.message_id)
     except Exception:
         pass
 
@@ -740,6 +1163,7 @@ async def upsert_distribution_debug(update: Update, context: ContextTypes.DEFAUL
     return msg.message_id
 
 
+@traced("render_proposal")
 async def render_proposal_with_debug(update: Update, context: ContextTypes.DEFAULT_TYPE, *, title: str, dishes: list[str], buttons: list[list[InlineKeyboardButton]], replace_old: bool = True,) -> int:
     """
     Garantiert: Debug steht immer OBERHALB der Karte und beide werden nur in-place ersetzt.
@@ -828,6 +1252,13 @@ def build_selection_debug_text(menues: list[str]) -> str:
         f"⚙️ Typ-Verteilung: {typ_text}",
         f"🥗 Ernährungsstil-Verteilung: {einschr_text}",
     ]
+
+    # Zutaten-Überlappung: eindeutige vs. summierte Zutaten der Auswahl
+    masks = [_ZUT_MASKS.get(g, 0) for g in menues]
+    summe = sum(m.bit_count() for m in masks)
+    if summe:
+        unique = zutaten_mask_for(menues).bit_count()
+        lines.append(f"🧺 Zutaten: {unique} verschieden / {summe} gesamt ({summe - unique} geteilt)")
     return "\n".join(lines)
 
 
@@ -835,7 +1266,7 @@ def build_selection_debug_text(menues: list[str]) -> str:
 def _track_export_msg(context: "ContextTypes.DEFAULT_TYPE", msg_id: int) -> None:
     if not isinstance(msg_id, int):
         return
-    context.user_data.setdefault("export_msgs", []).append(msg_id)
+    track_msg(context, "export_msgs", msg_id)
 
 
 def build_new_run_banner() -> str:
@@ -850,26 +1281,72 @@ def build_new_run_banner() -> str:
 
 # ===== Zentraler Flow-Reset & Mini-Helper =====
 
-def track_msg(context: ContextTypes.DEFAULT_TYPE, key: str, mid: int) -> None:
-    if isinstance(mid, int):
-        context.user_data.setdefault(key, []).append(mid)
+# Nachrichten-Ledger: EIN Dict pro Chat (chat_data["msg_ledger"]) mit einer
+# ID-Liste je Art (flow/prof/fav/fav_add/fav_work/export). Gelöscht wird gesammelt per
+# deleteMessages (bis zu 100 IDs pro Aufruf, Chunks parallel).
+MSG_KINDS = ("flow_msgs", "prof_msgs", "fav_msgs", "fav_add_msgs", "fav_work_ids", "export_msgs")
+DELETE_CHUNK = 100          # Bot-API-Limit für deleteMessages
+
+def msg_ledger(context: ContextTypes.DEFAULT_TYPE) -> dict[str, list[int]]:
+    store = context.chat_data if context.chat_data is not None else context.user_data
+    led = store.setdefault("msg_ledger", {})
+    # Altbestand (Listen direkt in user_data, vor dem Ledger) einmalig übernehmen
+    if context.user_data:
+        for kind in MSG_KINDS:
+            old = context.user_data.pop(kind, None)
+            if old:
+                led.setdefault(kind, []).extend(old)
+    return led
+
+def tracked_msgs(context: ContextTypes.DEFAULT_TYPE, kind: str) -> list[int]:
+    """Live-Liste der getrackten IDs einer Art (Änderungen wirken direkt)."""
+    return msg_ledger(context).setdefault(kind, [])
+
+def track_msg(context: ContextTypes.DEFAULT_TYPE, kind: str, *mids: int) -> None:
+    ids = tracked_msgs(context, kind)
+    ids.extend(m for m in mids if isinstance(m, int))
+
+def clear_tracked(context: ContextTypes.DEFAULT_TYPE, kind: str, *keep: int) -> None:
+    """Vergisst alle IDs einer Art (ohne zu löschen), optional bis auf keep."""
+    msg_ledger(context)[kind] = [m for m in keep if isinstance(m, int)]
+
+async def delete_msgs(bot, chat_id: int, ids) -> None:
+    """Löscht IDs gesammelt (deleteMessages, je 100) – Chunks laufen parallel."""
+    ids = list(dict.fromkeys(m for m in ids if isinstance(m, int)))
+    if not ids:
+        return
+    chunks = [ids[i:i + DELETE_CHUNK] for i in range(0, len(ids), DELETE_CHUNK)]
+    results = await asyncio.gather(
+        *(bot.delete_messages(chat_id=chat_id, message_ids=c) for c in chunks),
+        return_exceptions=True,
+    )
+    for res in results:
+        if isinstance(res, Exception):
+            logging.debug("deleteMessages in %s fehlgeschlagen: %s", chat_id, res)
 
-async def delete_proposal_card(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
-    # Vorschlagskarte
-    pid = context.user_data.pop("proposal_msg_id", None)
-    if isinstance(pid, int):
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=pid)
-        except Exception:
-            pass
+async def purge_msgs(context: ContextTypes.DEFAULT_TYPE, chat_id: int, kinds=MSG_KINDS, *, extra=(), keep=()) -> None:
+    """
+    Löscht alle getrackten Nachrichten der angegebenen Arten (plus extra)
+    in einem Rutsch und leert deren Listen; IDs in keep bleiben stehen.
+    """
+    led = msg_ledger(context)
+    ids = list(extra)
+    for kind in kinds:
+        cur = led.pop(kind, [])
+        ids.extend(m for m in cur if m not in keep)
+        kept = [m for m in cur if m in keep]
+        if kept:
+            led[kind] = kept
+    await delete_msgs(context.bot, chat_id, ids)
+
+def pop_proposal_ids(context: ContextTypes.DEFAULT_TYPE) -> list[int]:
+    """Vorschlagskarte + Verteilungs-Debug austragen (IDs zum Sammel-Löschen)."""
+    ids = (context.user_data.pop("proposal_msg_id", None), context.user_data.pop("dist_debug_msg_id", None))
+    return [m for m in ids if isinstance(m, int)]
 
-    # Verteilungs-Debug
-    did = context.user_data.pop("dist_debug_msg_id", None)
-    if isinstance(did, int):
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=did)
-        except Exception:
-            pass
+async def delete_proposal_card(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    # Vorschlagskarte + Verteilungs-Debug in einem Aufruf
+    await delete_msgs(context.bot, chat_id, pop_proposal_ids(context))
 
 
 async def delete_only_proposal_card(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
@@ -986,7 +1463,7 @@ async def reset_flow_state(
     chat_id = update.effective_chat.id if update.effective_chat else None
 
     # 1) Nachrichtenlisten: bekannte Keys
-    msg_keys_all = ["flow_msgs", "prof_msgs", "fav_msgs", "fav_add_msgs", "export_msgs"]
+    msg_keys_all = list(MSG_KINDS)
     if only_keys is not None:
         msg_keys = [k for k in msg_keys_all if k in only_keys]
         clear_ephemeral = False  # bei only_keys keine States löschen
@@ -997,14 +1474,7 @@ async def reset_flow_state(
         msg_keys = [k for k in msg_keys if k not in skip_keys]
 
     if delete_messages and chat_id is not None:
-        for key in msg_keys:
-            ids = context.user_data.get(key, [])
-            for mid in ids:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-                except Exception:
-                    pass
-            context.user_data[key] = []
+        await purge_msgs(context, chat_id, msg_keys)
 
     # 2) Ephemere User-States (nur wenn kein only_keys gesetzt ist)
     if clear_ephemeral:
@@ -1023,8 +1493,6 @@ async def reset_flow_state(
             "fav_total", "fav_del_sel", "fav_sel_sel", "fav_add_sel",
             # Profil-Wizard
             "new_profile",
-            # Ergebnis/Exporte
-            "final_list", "einkaufsliste_df", "kochliste_text",
         }
         for k in EPHEMERAL_KEYS:
             context.user_data.pop(k, None)
@@ -1036,7 +1504,7 @@ async def reset_flow_state(
                 del sessions[uid]
             if update.effective_chat:
                 ckey = chat_key(int(update.effective_chat.id))
-                store_delete_session(ckey)
+                await store_delete_session(ckey)
         except Exception:
             pass
 
@@ -1084,7 +1552,7 @@ async def ask_for_persons(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
 
     # b) Initial/sonst: neue Nachricht senden
     msg = await update.effective_message.reply_text(prompt, reply_markup=kb)
-    context.user_data.setdefault("flow_msgs", []).append(msg.message_id)
+    track_msg(context, "flow_msgs", msg.message_id)
     return PERSONS_SELECTION
 
 
@@ -1095,10 +1563,12 @@ async def ask_for_persons(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
 
 
 #gerichte zuteilen, falls aus favoriten gerichte selektiert
-def get_random_gerichte(profile, filters, aufwandsliste, block=None, limit=3, mode="session"):
+def get_random_gerichte(profile, filters, aufwandsliste, block=None, limit=3, mode="session", sparsam=False):
     """
     Liefert bis zu `limit` passende Gerichte nach Profil, Aufwand und Filter.
     Vermeidet Duplikate mit `block`.
+    sparsam=True: bevorzugt Gerichte, die Zutaten mit `block` bzw. der
+    bisherigen Auswahl teilen (siehe pick_sparsam).
     """
     if block is None:
         block = []
@@ -1110,14 +1580,19 @@ def get_random_gerichte(profile, filters, aufwandsliste, block=None, limit=3, mo
 
     result = []
     used = set()
+    acc = zutaten_mask_for(block) if sparsam else 0
 
     for stufe in aufwandsliste:
         kandidaten = basis[basis["Aufwand"] == stufe]
         kandidaten = kandidaten[~kandidaten["Gericht"].isin(used)]
         if kandidaten.empty:
             continue
-        w = pd.to_numeric(kandidaten["Gewicht"], errors="coerce").fillna(1.0)
-        choice = kandidaten.sample(n=1, weights=w)["Gericht"].iloc[0]
+        if sparsam:
+            (choice,), acc = pick_sparsam(kandidaten, 1, acc)
+        else:
+            with trace_span("sampling"):
+                w = pd.to_numeric(kandidaten["Gewicht"], errors="coerce").fillna(1.0)
+                choice = kandidaten.sample(n=1, weights=w)["Gericht"].iloc[0]
         result.append(choice)
         used.add(choice)
         if len(result) >= limit:
@@ -1240,23 +1715,22 @@ async def send_action_menu(msg, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🔖 Gerichte zu Favoriten hinzufügen", callback_data="favoriten")],
         [InlineKeyboardButton("🛒 Einkaufsliste in Bring! exportieren", callback_data="export_bring")],
         [InlineKeyboardButton("📄 Als PDF exportieren", callback_data="export_pdf")],
+        [InlineKeyboardButton("📌 Plan merken (für kombinierte Liste)", callback_data="plan_pin")],
         [InlineKeyboardButton("🔄 Das passt so. Neustart!", callback_data="restart")],
     ])
     out = await msg.reply_text(pad_message("Was steht als nächstes an?"), reply_markup=kb)
     _track_export_msg(context, out.message_id)
     return out
 
-# Load persisted data (env-aware: avoid JSON preload when Firestore is enabled)
-if (os.getenv("PERSISTENCE") or "json").strip().lower() == "firestore":
-    sessions = {}
-    favorites = {}
-    profiles = {}
-    recipe_cache = {}
-else:
-    sessions = load_json(SESSIONS_FILE)
-    favorites = load_favorites()
-    recipe_cache = load_json(CACHE_FILE)
-    profiles = load_profiles()
+# Profile, Favoriten und Sessions lädt der Persistenz-Cache lazy (siehe
+# _CacheView); nur der Rezept-Cache ist lokal (im Firestore-Modus flüchtig),
+# als LRU auf RECIPE_CACHE_MAX Rezepte begrenzt.
+RECIPE_CACHE_MAX = int(os.getenv("RECIPE_CACHE_MAX", "500"))
+recipe_cache: OrderedDict[str, str] = OrderedDict(
+    {} if PERSISTENCE == "firestore" else load_json(CACHE_FILE)
+)
+while len(recipe_cache) > RECIPE_CACHE_MAX:
+    recipe_cache.popitem(last=False)
 
 
 
@@ -1267,8 +1741,9 @@ else:
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 def lade_gerichtebasis():
-    sheet = client.open_by_key(SHEET_ID).worksheet(SHEET_GERICHTE)
-    rows  = sheet.get_all_values()  # Header = rows[0]
+    with timed("sheets", "gerichte"):
+        sheet = client.open_by_key(SHEET_ID).worksheet(SHEET_GERICHTE)
+        rows  = sheet.get_all_values()  # Header = rows[0]
     # A–J: Nummer | Code | Aktiv | Gericht | Aufwand | Typ | Ernährungsstil | Küche | Beilagen | Link
     data  = [row[:10] for row in rows[1:]]
     df    = pd.DataFrame(
@@ -1290,8 +1765,9 @@ def lade_gerichtebasis():
 
 
 def lade_beilagen():
-    sheet = client.open_by_key(SHEET_ID).worksheet("Beilagen")
-    raw = sheet.get_all_values()[1:]       # überspringe Header
+    with timed("sheets", "beilagen"):
+        sheet = client.open_by_key(SHEET_ID).worksheet("Beilagen")
+        raw = sheet.get_all_values()[1:]       # überspringe Header
     data = [row[:5] for row in raw]        # nur erste 5 Spalten
     df = pd.DataFrame(data, columns=["Nummer","Beilagen","Kategorie","Relevanz","Aufwand"])
     # nicht-numerische Zeilen rauswerfen
@@ -1337,8 +1813,9 @@ def allowed_sides_for_dish(dish: str) -> set[int]:
 
 
 def lade_zutaten():
-    sheet = client.open_by_key(SHEET_ID).worksheet(SHEET_ZUTATEN)
-    raw = sheet.get_all_values()[1:]  # Header überspringen
+    with timed("sheets", "zutaten"):
+        sheet = client.open_by_key(SHEET_ID).worksheet(SHEET_ZUTATEN)
+        raw = sheet.get_all_values()[1:]  # Header überspringen
     # Nur die ersten 6 Spalten („Gericht“, „Zutat“, „Kategorie“, „Typ“, „Menge“, „Einheit“)
     data = [row[:6] for row in raw]
     # Extrahiere vorab den Roh-String aus Spalte 5
@@ -1443,9 +1920,293 @@ def get_aufwand_for(dish: str):
     except Exception:
         return None
 
+# -------------------------------------------------
+# Zutaten-Inzidenz (Gericht × Zutat) für „Sparsam einkaufen“
+# -------------------------------------------------
+SPARSAM_TOP_K = int(os.getenv("SPARSAM_TOP_K", "3"))
+
+def normalize_zutat(name) -> str:
+    """Vergleichsschlüssel für Zutaten: casefold, Mehrfach-Leerzeichen entfernt."""
+    return " ".join(str(name or "").casefold().split())
+
+def _build_zutaten_incidence(df: pd.DataFrame) -> tuple[dict[str, int], dict[str, int], list[str]]:
+    """
+    Dünn besetzte Inzidenzmatrix Gericht × Zutat, zeilenweise als Bitmaske:
+      - jede normalisierte Zutat bekommt eine Bit-Position
+      - jedes Hauptgericht eine int-Maske über seine Zutaten
+    Freitext-Mengen („wenig“, „1 Prise“) zählen nicht – das sind Vorratsartikel,
+    die man ohnehin nicht mehrfach kauft.
+    """
+    zut_ids: dict[str, int] = {}
+    masks: dict[str, int] = {}
+    names: list[str] = []      # Bit-Position → Anzeigename (erste Schreibweise)
+    try:
+        rows = df[df["Typ"] == "Gericht"]
+        for dish, zutat, raw in zip(rows["Gericht"], rows["Zutat"], rows["Menge_raw"]):
+            raw = str(raw).strip().replace(",", ".")
+            if not raw.replace(".", "", 1).isdigit():
+                continue
+            key = normalize_zutat(zutat)
+            if not key:
+                continue
+            if key not in zut_ids:
+                zut_ids[key] = len(zut_ids)
+                names.append(str(zutat).strip())
+            masks[dish] = masks.get(dish, 0) | (1 << zut_ids[key])
+    except Exception as e:
+        logging.warning("Zutaten-Inzidenz konnte nicht aufgebaut werden (%s) – Sparmodus ohne Wirkung.", e)
+    return zut_ids, masks, names
+
+def _build_zutaten_index(masks: dict[str, int]) -> dict[int, set[str]]:
+    """Invertierter Index: Zutat-Bit → Menge der Gerichte, die sie enthalten."""
+    index: dict[int, set[str]] = defaultdict(set)
+    for dish, mask in masks.items():
+        while mask:
+            low = mask & -mask
+            index[low.bit_length() - 1].add(dish)
+            mask ^= low
+    return dict(index)
+
+_ZUT_IDS, _ZUT_MASKS, _ZUT_NAMES = _build_zutaten_incidence(df_zutaten)
+_ZUT_INDEX = _build_zutaten_index(_ZUT_MASKS)
+
+def overlap_score(mask: int, acc: int) -> float:
+    """(geteilte + 1) / (neue + 1) Zutaten gegenüber der bisherigen Auswahl."""
+    shared = (mask & acc).bit_count()
+    new    = (mask & ~acc).bit_count()
+    return (shared + 1) / (new + 1)
+
+@traced("sampling")
+def pick_sparsam(pool: pd.DataFrame, n: int, acc: int = 0, top_k: int = SPARSAM_TOP_K) -> tuple[list[str], int]:
+    """
+    Zieht bis zu n Gerichte aus pool, bevorzugt mit hoher Zutaten-Überlappung:
+    Pro Schritt die top_k Kandidaten nach overlap_score, daraus gewichtet (Gewicht).
+    Ist noch nichts gewählt (acc == 0), wird normal gewichtet gezogen.
+    Rückgabe: (Gerichte, neue Zutaten-Maske der Auswahl)
+    """
+    names   = pool["Gericht"].tolist()
+    weights = pd.to_numeric(pool["Gewicht"], errors="coerce").fillna(1.0).tolist()
+    masks   = [_ZUT_MASKS.get(g, 0) for g in names]
+
+    avail = list(range(len(names)))
+    random.shuffle(avail)  # zufälliger Tie-Break bei gleichem Score
+    chosen: list[str] = []
+    for _ in range(min(n, len(names))):
+        if acc:
+            cands = heapq.nlargest(top_k, avail, key=lambda j: overlap_score(masks[j], acc))
+        else:
+            cands = avail
+        i = random.choices(cands, weights=[weights[j] for j in cands], k=1)[0]
+        avail.remove(i)
+        chosen.append(names[i])
+        acc |= masks[i]
+    return chosen, acc
+
+def zutaten_mask_for(dishes) -> int:
+    """Vereinigte Zutaten-Maske mehrerer Gerichte."""
+    acc = 0
+    for g in dishes or []:
+        acc |= _ZUT_MASKS.get(g, 0)
+    return acc
+
+# -------------------------------------------------
+# Vorrat-Suche („Was habe ich da?“) über den invertierten Index
+# -------------------------------------------------
+VORRAT_TOP_K = int(os.getenv("VORRAT_TOP_K", "5"))
+
+def _vorrat_bits(teil: str, prefix: bool = True) -> int:
+    """Maske eines Begriffs: exakter Treffer oder Präfix (ab 4 Zeichen), sonst 0."""
+    tok = normalize_zutat(teil)
+    if not tok:
+        return 0
+    bit = _ZUT_IDS.get(tok)
+    if bit is not None:
+        return 1 << bit
+    treffer = 0
+    if prefix and len(tok) >= 4:
+        for key, b in _ZUT_IDS.items():
+            if key.startswith(tok) or (len(key) >= 4 and tok.startswith(key)):
+                treffer |= 1 << b
+    return treffer
+
+def vorrat_mask(eingabe: str) -> tuple[int, list[str]]:
+    """
+    Übersetzt Freitext („Tomaten, Zwiebeln; Reis“ oder „reis tomate“) in eine
+    Zutaten-Maske. Getrennt wird an Komma/Semikolon/Zeilenumbruch; ein Teil
+    mit Leerzeichen zählt nur als Ganzes, wenn er exakt eine Zutat ist
+    („Crème fraîche“), sonst wortweise („reis tomate“).
+    Begriffe matchen exakt oder per Präfix (ab 4 Zeichen: „Tomate“ ↔ „Tomaten“).
+    Rückgabe: (Maske, nicht erkannte Begriffe)
+    """
+    mask, unbekannt = 0, []
+    for teil in re.split(r"[,;\n]+", eingabe or ""):
+        if not teil.strip():
+            continue
+        woerter = teil.split()
+        bits = _vorrat_bits(teil, prefix=len(woerter) < 2)
+        if bits:
+            mask |= bits
+            continue
+        if len(woerter) < 2:
+            unbekannt.append(teil.strip())
+            continue
+        for wort in woerter:
+            bits = _vorrat_bits(wort)
+            if bits:
+                mask |= bits
+            else:
+                unbekannt.append(wort)
+    return mask, unbekannt
+
+def zutaten_names(mask: int) -> list[str]:
+    """Anzeigenamen aller Zutaten einer Maske (Katalog-Reihenfolge)."""
+    out = []
+    while mask:
+        low = mask & -mask
+        out.append(_ZUT_NAMES[low.bit_length() - 1])
+        mask ^= low
+    return out
+
+def search_vorrat(have: int, allowed: set[str] | None = None, k: int = VORRAT_TOP_K) -> list[tuple[str, int, int, int]]:
+    """
+    Rangiert Gerichte nach Abdeckung ihrer Zutaten durch den Vorrat.
+    Es werden nur die Posting-Listen der vorhandenen Zutaten gelesen,
+    nicht die ganze Zutaten-Tabelle.
+    Rückgabe: [(Gericht, vorhanden, total, fehlende-Maske), …] – beste zuerst
+    """
+    hits: Counter = Counter()
+    bits = have
+    while bits:
+        low = bits & -bits
+        for dish in _ZUT_INDEX.get(low.bit_length() - 1, ()):
+            if allowed is None or dish in allowed:
+                hits[dish] += 1
+        bits ^= low
+
+    def score(dish):
+        total = _ZUT_MASKS[dish].bit_count()
+        return (hits[dish] / total, hits[dish], -total)
+
+    best = heapq.nlargest(k, hits, key=score)
+    return [
+        (d, hits[d], _ZUT_MASKS[d].bit_count(), _ZUT_MASKS[d] & ~have)
+        for d in best
+    ]
+
+# -------------------------------------------------
+# Laden-Reihenfolge (Gang-Sortierung der Einkaufsliste)
+# -------------------------------------------------
+# Kategorien in Lauf-Reihenfolge; innerhalb einer Kategorie alphabetisch.
+AISLE_LAYOUTS = {
+    "alphabetisch": {
+        "label": "🔤 Alphabetisch",
+        "kategorien": None,  # None = Kategorien alphabetisch (bisheriges Verhalten)
+    },
+    "supermarkt": {
+        "label": "🛒 Supermarkt (Frische zuerst)",
+        "kategorien": [
+            "Obst & Gemüse", "Backwaren", "Fleisch & Fisch", "Kühlregal",
+            "Milchwaren", "Trockenware & Vorrat", "Getränke", "Haushalt & Sonstiges",
+        ],
+    },
+    "discounter": {
+        "label": "🏷️ Discounter (Trockenware zuerst)",
+        "kategorien": [
+            "Trockenware & Vorrat", "Getränke", "Haushalt & Sonstiges", "Backwaren",
+            "Obst & Gemüse", "Kühlregal", "Milchwaren", "Fleisch & Fisch",
+        ],
+    },
+}
+AISLE_DEFAULT = os.getenv("AISLE_DEFAULT", "alphabetisch")
+
+_AISLE_STRIDE = 1_000_000   # Kategorie-Rang × Stride + Zutaten-Rang
+
+def catalog_version(df: pd.DataFrame) -> str:
+    """Kurzer Hash über Zutat/Kategorie/Einheit – ändert sich nur mit dem Katalog."""
+    h = pd.util.hash_pandas_object(df[["Zutat", "Kategorie", "Einheit"]], index=False).values
+    return hashlib.sha1(h.tobytes()).hexdigest()[:12]
+
+def _build_aisle_keys(df: pd.DataFrame, layout: dict) -> dict[tuple[str, str], int]:
+    """(Kategorie, normalisierte Zutat) → int-Sortierschlüssel für ein Layout."""
+    kats = sorted({str(k) for k in df["Kategorie"].dropna()}, key=str.casefold)
+    order = layout.get("kategorien") or kats
+    kat_rank = {k: i for i, k in enumerate(order)}
+
+    zutaten = sorted({normalize_zutat(z) for z in df["Zutat"]})
+    zut_rank = {z: i for i, z in enumerate(zutaten)}
+
+    keys = {}
+    for kat in kats:
+        base = kat_rank.get(kat, len(order)) * _AISLE_STRIDE
+        for z in zutaten:
+            keys[(kat, z)] = base + zut_rank[z]
+    return keys
+
+_AISLE_CACHE: dict[tuple[str, str], dict[tuple[str, str], int]] = {}
+_CATALOG_VERSION = catalog_version(df_zutaten)
+
+def aisle_keys(layout_key: str) -> dict[tuple[str, str], int]:
+    """Vorberechnete Sortierschlüssel, einmal pro (Katalog-Version, Layout)."""
+    layout_key = layout_key if layout_key in AISLE_LAYOUTS else AISLE_DEFAULT
+    ck = (_CATALOG_VERSION, layout_key)
+    keys = _AISLE_CACHE.get(ck)
+    if keys is None:
+        keys = _build_aisle_keys(df_zutaten, AISLE_LAYOUTS[layout_key])
+        _AISLE_CACHE.clear()  # alte Katalog-Versionen verwerfen
+        _AISLE_CACHE[ck] = keys
+    return keys
+
+for _lk in AISLE_LAYOUTS:
+    _AISLE_CACHE[(_CATALOG_VERSION, _lk)] = _build_aisle_keys(df_zutaten, AISLE_LAYOUTS[_lk])
+
+def order_einkaufsliste(eink: pd.DataFrame, layout_key: str) -> pd.DataFrame:
+    """
+    Ordnet die Einkaufsliste nach Laden-Layout (stabiler argsort über
+    int-Schlüssel). Danach reicht groupby("Kategorie", sort=False).
+    Unbekannte Kategorien/Zutaten landen am Ende.
+    """
+    if eink.empty:
+        return eink.reset_index(drop=True)
+    keys = aisle_keys(layout_key)
+    tail = (len(AISLE_LAYOUTS) + 100) * _AISLE_STRIDE
+    arr = np.fromiter(
+        (keys.get((str(k), normalize_zutat(z)), tail)
+         for k, z in zip(eink["Kategorie"], eink["Zutat"])),
+        dtype=np.int64, count=len(eink),
+    )
+    return eink.iloc[np.argsort(arr, kind="stable")].reset_index(drop=True)
+
+# -------------------------------------------------
+# Zutaten-Vokabular: (Zutat, Kategorie, Einheit) → kompakte int-ID
+# -------------------------------------------------
+def _build_zutaten_vocab(df: pd.DataFrame):
+    """
+    Liefert (vocab, rows):
+      vocab: Liste der (Zutat, Kategorie, Einheit)-Tripel, Index = ID
+      rows:  (Typ, Gericht) → [(ID, Menge, Menge_raw | None), …] in Sheet-Reihenfolge
+             Menge_raw nur bei Freitext-Mengen, sonst None
+    """
+    vocab: list[tuple[str, str, str]] = []
+    ids: dict[tuple[str, str, str], int] = {}
+    rows: dict[tuple[str, str], list[tuple[int, float, str | None]]] = defaultdict(list)
+    for g, z, k, t, m, e, raw in zip(
+        df["Gericht"], df["Zutat"], df["Kategorie"], df["Typ"], df["Menge"], df["Einheit"], df["Menge_raw"]
+    ):
+        key = (str(z), str(k), str(e))
+        vid = ids.get(key)
+        if vid is None:
+            vid = ids[key] = len(vocab)
+            vocab.append(key)
+        raw = str(raw).strip()
+        rows[(str(t), str(g))].append((vid, float(m), None if raw.replace(".", "").isdigit() else raw))
+    return vocab, dict(rows)
+
+_ZUT_VOCAB, _ZUT_ROWS = _build_zutaten_vocab(df_zutaten)
+
 # -------------------------------------------------
 # Gerichte-Filter basierend auf Profil
 # -------------------------------------------------
+@traced("catalog_filter")
 def apply_profile_filters(df: pd.DataFrame, profile: dict | None) -> pd.DataFrame:
     """Filtert das Gerichte-DataFrame gemäss Profil-Einstellungen."""
     if not profile or profile.get("restriction") == "offen":
@@ -1464,6 +2225,7 @@ def apply_profile_filters(df: pd.DataFrame, profile: dict | None) -> pd.DataFram
 
     return filtered.reset_index(drop=True)
 
+@traced("sampling")
 def sample_by_weight(df: pd.DataFrame, weight: int, k: int) -> pd.DataFrame:
     """
     Liefert bis zu k Gerichte gemäss Gewichtungstabellen. Fehlende Mengen
@@ -1672,14 +2434,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def menu_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """/menu per Text – startet Profil-Loop"""
     # frische Liste für alle Wizard-Nachrichten
-    context.user_data["prof_msgs"] = []
+    clear_tracked(context, "prof_msgs")
 
     sent = await update.message.reply_text(
         pad_message("Wie möchtest Du fortfahren?"),
         reply_markup=build_profile_choice_keyboard(),
     )
     # erste Message fürs spätere Cleanup merken
-    context.user_data["prof_msgs"].append(sent.message_id)
+    track_msg(context, "prof_msgs", sent.message_id)
     context.user_data["prof_start_msg_id"] = sent.message_id
 
     return PROFILE_CHOICE
@@ -1690,13 +2452,13 @@ async def menu_start_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await q.answer()
 
     # neue Liste für alle Wizard-Nachrichten
-    context.user_data["prof_msgs"] = []
+    clear_tracked(context, "prof_msgs")
 
     sent = await q.message.reply_text(
         pad_message("Wie möchtest Du fortfahren?"),
         reply_markup=build_profile_choice_keyboard(),
     )
-    context.user_data["prof_msgs"].append(sent.message_id)
+    track_msg(context, "prof_msgs", sent.message_id)
     context.user_data["prof_start_msg_id"] = sent.message_id
     return PROFILE_CHOICE
 
@@ -1779,12 +2541,12 @@ async def profile_choice_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     async def send_and_log(text: str, *, store_id: bool = True, **kwargs):
         msg = await q.message.reply_text(text, **kwargs)
         if store_id:
-            context.user_data.setdefault("prof_msgs", []).append(msg.message_id)
+            track_msg(context, "prof_msgs", msg.message_id)
         return msg
 
     # ===== 1)  Bestehendes Profil =========================================
     if choice == "prof_exist":
-        if ensure_profile_loaded(uid):
+        if await ensure_profile_loaded(uid):
             # In-place Edit der Startfrage → "Wie viele Gerichte...?"
             context.user_data.pop("menu_count_sel", None)
             context.user_data["menu_count_page"] = "low"
@@ -1802,14 +2564,14 @@ async def profile_choice_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     reply_markup=kb
                 )
                 # Tracking: neu gesendete Nachricht in flow_msgs
-                context.user_data.setdefault("flow_msgs", []).append(msg.message_id)
+                track_msg(context, "flow_msgs", msg.message_id)
             else:
                 # Tracking: die ehem. Startfrage von prof_msgs → flow_msgs verschieben
                 try:
-                    context.user_data.get("prof_msgs", []).remove(q.message.message_id)
+                    tracked_msgs(context, "prof_msgs").remove(q.message.message_id)
                 except Exception:
                     pass
-                context.user_data.setdefault("flow_msgs", []).append(q.message.message_id)
+                track_msg(context, "flow_msgs", q.message.message_id)
                 # Startfrage-ID aufräumen, weil jetzt Flow-Nachricht
                 if context.user_data.get("prof_start_msg_id") == q.message.message_id:
                     context.user_data.pop("prof_start_msg_id", None)
@@ -1820,7 +2582,7 @@ async def profile_choice_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         async def send_and_log(text: str, *, store_id: bool = True, **kwargs):
             msg = await q.message.reply_text(text, **kwargs)
             if store_id:
-                context.user_data.setdefault("prof_msgs", []).append(msg.message_id)
+                track_msg(context, "prof_msgs", msg.message_id)
             return msg
 
         await send_and_log("Es besteht noch kein Profil. Erstelle eines!")
@@ -1850,14 +2612,14 @@ async def profile_choice_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 pad_message("Wie viele Gerichte soll ich vorschlagen?"),
                 reply_markup=kb
             )
-            context.user_data.setdefault("flow_msgs", []).append(msg.message_id)
+            track_msg(context, "flow_msgs", msg.message_id)
         else:
             # Tracking: die ehem. Startfrage von prof_msgs → flow_msgs verschieben
             try:
-                context.user_data.get("prof_msgs", []).remove(q.message.message_id)
+                tracked_msgs(context, "prof_msgs").remove(q.message.message_id)
             except Exception:
                 pass
-            context.user_data.setdefault("flow_msgs", []).append(q.message.message_id)
+            track_msg(context, "flow_msgs", q.message.message_id)
             # Startfrage-ID aufräumen, weil jetzt Flow-Nachricht
             if context.user_data.get("prof_start_msg_id") == q.message.message_id:
                 context.user_data.pop("prof_start_msg_id", None)
@@ -1875,7 +2637,7 @@ async def profile_choice_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # ===== 4)  Mein Profil =================================================
     if choice == "prof_show":
-        if ensure_profile_loaded(uid):
+        if await ensure_profile_loaded(uid):
             await send_and_log(
                 profile_overview_text(profiles[uid]),
                 reply_markup=build_profile_overview_keyboard(),
@@ -1969,8 +2731,8 @@ async def profile_new_c_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "styles":      list(context.user_data["new_profile"]["styles"]),
         "weight":      context.user_data["new_profile"]["weight"],
     }
-    # Persistentes Speichern (JSON oder Firestore – je nach PERSISTENCE)
-    store_set_profile(user_key(int(uid)), profiles[uid])
+    # Persistentes Speichern (JSON, SQLite oder Firestore – je nach PERSISTENCE)
+    await store_set_profile(user_key(int(uid)), profiles[uid])
 
 
     # Übersicht + Buttons
@@ -1993,8 +2755,8 @@ async def profile_overview_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
             pad_message("Ernährungsstil:"),
             reply_markup=build_restriction_keyboard(),
         )
-        if sent.message_id not in context.user_data.get("prof_msgs", []):
-            context.user_data.setdefault("prof_msgs", []).append(sent.message_id)
+        if sent.message_id not in tracked_msgs(context, "prof_msgs"):
+            track_msg(context, "prof_msgs", sent.message_id)
         return PROFILE_NEW_A
 
     if choice == "prof_back":
@@ -2063,14 +2825,14 @@ async def ask_menu_count(update: Update, context: ContextTypes.DEFAULT_TYPE, pag
     # b) Initial oder sonst: Nachricht mit Tastatur senden/editen (Layout bleibt gleich)
     if q:
         msg = await q.message.reply_text(text, reply_markup=kb)
-        context.user_data.setdefault("flow_msgs", []).append(msg.message_id)
+        track_msg(context, "flow_msgs", msg.message_id)
     elif update.message:
         msg = await update.message.reply_text(text, reply_markup=kb)
-        context.user_data.setdefault("flow_msgs", []).append(msg.message_id)
+        track_msg(context, "flow_msgs", msg.message_id)
     else:
         chat_id = update.effective_chat.id
         msg = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=kb)
-        context.user_data.setdefault("flow_msgs", []).append(msg.message_id)
+        track_msg(context, "flow_msgs", msg.message_id)
 
     return MENU_COUNT
 
@@ -2121,7 +2883,9 @@ async def menu_count_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["aufwand_verteilung"] = {"light": 0, "medium": 0, "heavy": 0}
         await q.message.edit_text(
             f"Du suchst <b>{sel}</b> Gerichte 👍\n\nDefiniere deren Aufwand:",
-            reply_markup=build_aufwand_keyboard(context.user_data["aufwand_verteilung"], sel)
+            reply_markup=build_aufwand_keyboard(
+                context.user_data["aufwand_verteilung"], sel, context.user_data.get("sparsam", False)
+            )
         )
         return MENU_AUFWAND
 
@@ -2226,7 +2990,8 @@ async def menu_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Hole Restgerichte basierend auf Profil & restlichem Aufwand
                 extra = get_random_gerichte(
                     profile, filters, rest_aufwand, block=block,
-                    limit=fehlend, mode="session"
+                    limit=fehlend, mode="session",
+                    sparsam=bool(context.user_data.get("sparsam")),
                 )
 
                 # Aufwand der extra Gerichte aus df_gerichte
@@ -2246,7 +3011,7 @@ async def menu_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "menues": final_gerichte,
                 "aufwand": final_aufwand,
             }
-            persist_session(update)
+            await persist_session(update)
 
 
             await render_proposal_with_debug(
@@ -2269,9 +3034,13 @@ async def menu_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         basis   = apply_profile_filters(df_gerichte, profile)
 
 
+        sparsam = bool(context.user_data.get("sparsam"))
+
         weight_pref = profile.get("weight") if profile else None
         if weight_pref:
-            subset = sample_by_weight(basis, weight_pref, total + round(total * 0.2))
+            # Sparmodus braucht mehr Kandidaten, damit Überlappung überhaupt wählbar ist
+            extra_n = total * 2 if sparsam else round(total * 0.2)
+            subset = sample_by_weight(basis, weight_pref, total + extra_n)
             if not subset.empty:
                 basis = subset
 
@@ -2294,15 +3063,23 @@ async def menu_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Mapping Aufwand-Stufe → Spalte Art
         aufwand2art = {1: "leicht", 2: "mittel", 3: "schwer"}
 
+        # Zutaten-Maske der bisherigen Auswahl (nur im Sparmodus relevant)
+        acc = 0
+
         # Hilfsfunktion: n Gerichte aus einer Teilmenge ziehen
         def pick(df_src, n, exclude_ids):
+            nonlocal acc
             if n <= 0:
                 return []
             pool = df_src[~df_src["Gericht"].isin(exclude_ids)].copy()
             if pool.empty:
                 return []
-            w = pd.to_numeric(pool["Gewicht"], errors="coerce").fillna(1.0)
-            return pool.sample(n=min(n, len(pool)), replace=False, weights=w)["Gericht"].tolist()
+            if sparsam:
+                chosen, acc = pick_sparsam(pool, n, acc)
+                return chosen
+            with trace_span("sampling"):
+                w = pd.to_numeric(pool["Gewicht"], errors="coerce").fillna(1.0)
+                return pool.sample(n=min(n, len(pool)), replace=False, weights=w)["Gericht"].tolist()
 
 
         bereits, ausgewaehlt, aufwand_liste = set(), [], []
@@ -2352,9 +3129,7 @@ async def menu_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if len(ausgewaehlt) < gesamt:
             rest_df = basis[~basis["Gericht"].isin(bereits)].copy()
             if not rest_df.empty:
-                w = pd.to_numeric(rest_df["Gewicht"], errors="coerce").fillna(1.0)
-                k = min(gesamt - len(ausgewaehlt), len(rest_df))
-                extra = rest_df.sample(n=k, replace=False, weights=w)["Gericht"].tolist()
+                extra = pick(rest_df, gesamt - len(ausgewaehlt), bereits)
                 for g in extra:
                     stufe = int(basis[basis["Gericht"] == g]["Aufwand"].iloc[0])
                     ausgewaehlt.append(g)
@@ -2364,7 +3139,7 @@ async def menu_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # ---------- Speichern & Ausgabe -------------------------------
         sessions[user_id] = {"menues": ausgewaehlt, "aufwand": aufwand_liste}
-        persist_session(update)
+        await persist_session(update)
 
         await render_proposal_with_debug(
             update, context,
@@ -2418,7 +3193,7 @@ async def menu_input_direct(user_input: str, update: Update, context: ContextTyp
 
 # ─────────── menu_confirm_cb ───────────
 async def menu_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     query = update.callback_query
     await query.answer()
     chat_id = query.message.chat.id
@@ -2457,7 +3232,7 @@ async def menu_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         context.user_data["swap_candidates"] = set()
         kb = build_swap_keyboard(sessions[uid]["menues"], set())
         msg = await query.message.reply_text(pad_message("Welche Gerichte möchtest Du tauschen?"), reply_markup=kb)
-        context.user_data["flow_msgs"].append(msg.message_id)
+        track_msg(context, "flow_msgs", msg.message_id)
         return TAUSCHE_SELECT
 
 
@@ -2465,6 +3240,25 @@ async def menu_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return ConversationHandler.END
 
 
+def build_persons_keyboard(page: str, sel) -> InlineKeyboardMarkup:
+    if page == "low":
+        nums = list(range(1, 7))
+        nav_label, nav_data = "Mehr ➡️", "persons_page_high"
+    else:
+        nums = list(range(7, 13))
+        nav_label, nav_data = "⬅️ Weniger", "persons_page_low"
+
+    row_numbers = [
+        InlineKeyboardButton(f"{n} ✅" if sel == n else f"{n}", callback_data=f"persons_{n}")
+        for n in nums
+    ]
+    done_label = "✔️ Weiter" if isinstance(sel, int) else "Weiter"
+    footer = [
+        InlineKeyboardButton(nav_label, callback_data=nav_data),
+        InlineKeyboardButton(done_label, callback_data="persons_done"),
+    ]
+    return InlineKeyboardMarkup([row_numbers, footer])
+
 async def persons_selection_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -2472,6 +3266,7 @@ async def persons_selection_cb(update: Update, context: ContextTypes.DEFAULT_TYP
 
     # 1) Seitenwechsel
     if data in ("persons_page_low", "persons_page_high"):
+        edit_debouncer.cancel(query.message)
         return await ask_for_persons(update, context, page="high" if data == "persons_page_high" else "low")
 
     # 2) Zahl gewählt -> nur markieren (✅), noch NICHT weiter
@@ -2483,29 +3278,16 @@ async def persons_selection_cb(update: Update, context: ContextTypes.DEFAULT_TYP
 
         context.user_data["temp_persons"] = sel
 
-        # Tastatur mit Haken neu aufbauen (Layout unverändert)
-        page = context.user_data.get("persons_page", "low")
-        if page == "low":
-            nums = list(range(1, 7))
-            nav_label, nav_data = "Mehr ➡️", "persons_page_high"
-        else:
-            nums = list(range(7, 13))
-            nav_label, nav_data = "⬅️ Weniger", "persons_page_low"
-
-        row_numbers = [
-            InlineKeyboardButton(f"{n} ✅" if sel == n else f"{n}", callback_data=f"persons_{n}")
-            for n in nums
-        ]
-        done_label = "✔️ Weiter" if isinstance(sel, int) else "Weiter"
-        footer = [
-            InlineKeyboardButton(nav_label, callback_data=nav_data),
-            InlineKeyboardButton(done_label, callback_data="persons_done"),
-        ]
-        await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup([row_numbers, footer]))
+        # Tastatur mit Haken neu aufbauen (Layout unverändert, gebündelt bei schnellen Klicks)
+        edit_debouncer.schedule(query.message, lambda: query.edit_message_reply_markup(
+            reply_markup=build_persons_keyboard(context.user_data.get("persons_page", "low"),
+                                                context.user_data.get("temp_persons"))
+        ))
         return PERSONS_SELECTION
 
     # 3) Fertig -> jetzt weiter
     if data == "persons_done":
+        edit_debouncer.cancel(query.message)
         sel = context.user_data.get("temp_persons")
         if not isinstance(sel, int):
             await query.answer("Bitte zuerst eine Zahl auswählen.", show_alert=True)
@@ -2541,7 +3323,7 @@ async def persons_manual_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ─────────── quickone_start ───────────
 async def quickone_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     uid = str(update.effective_user.id)
     chat_id = update.effective_chat.id
 
@@ -2549,7 +3331,7 @@ async def quickone_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await delete_proposal_card(context, chat_id)
 
     # 1) Flow-UI zurücksetzen (nur Nachrichtenliste), Pools nicht mehr nötig
-    context.user_data["flow_msgs"] = []
+    clear_tracked(context, "flow_msgs")
     context.user_data.pop("quickone_side_pools", None)  # nicht mehr genutzt
 
     # 2) Gerichtspool initialisieren oder weiterverwenden
@@ -2567,7 +3349,7 @@ async def quickone_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pad_message("⚠️ Es sind keine neuen Gerichte mehr im aktuellen Durchgang.\n"
                         "Starte bitte neu mit »🔄 Restart«.")
         )
-        context.user_data.setdefault("flow_msgs", []).append(msg.message_id)
+        track_msg(context, "flow_msgs", msg.message_id)
         return QUICKONE_CONFIRM
 
     # Favoriten (3x) × Aktiv-Gewicht
@@ -2585,7 +3367,7 @@ async def quickone_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "aufwand": [int(df_gerichte.loc[df_gerichte["Gericht"] == dish, "Aufwand"].iloc[0]) if not df_gerichte.loc[df_gerichte["Gericht"] == dish, "Aufwand"].empty else 0],
         "beilagen": {}
     }
-    persist_session(update)
+    await persist_session(update)
 
     # bevorzugt Session-Aufwand, sonst df
     try:
@@ -2611,7 +3393,7 @@ async def quickone_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ─────────── quickone_confirm_cb ───────────
 async def quickone_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     q = update.callback_query
     await q.answer()
     uid = str(update.effective_user.id)
@@ -2644,7 +3426,7 @@ async def quickone_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
             pad_message("Möchtest Du Beilagen hinzufügen?"),
             reply_markup=kb
         )
-        context.user_data.setdefault("flow_msgs", []).append(msg.message_id)
+        track_msg(context, "flow_msgs", msg.message_id)
         return QUICKONE_CONFIRM
 
 
@@ -2683,7 +3465,7 @@ async def quickone_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
             "aufwand": [int(df_gerichte.loc[df_gerichte["Gericht"] == dish, "Aufwand"].iloc[0]) if not df_gerichte.loc[df_gerichte["Gericht"] == dish, "Aufwand"].empty else 0],
             "beilagen": {}
         }
-        persist_session(update)
+        await persist_session(update)
 
         # Aufwand-Label
         try:
@@ -2750,7 +3532,7 @@ async def quickone_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 async def ask_beilagen_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     query = update.callback_query
     await query.answer()
     uid = str(query.from_user.id)
@@ -2785,7 +3567,7 @@ async def ask_beilagen_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["selected_menus"] = set()  # 0-basierte Indizes
         kb = build_menu_select_keyboard_for_sides(menus, context.user_data["selected_menus"], max_len=35)
         msg = await query.message.reply_text(pad_message("Für welche Gerichte?"), reply_markup=kb)
-        context.user_data.setdefault("flow_msgs", []).append(msg.message_id)
+        track_msg(context, "flow_msgs", msg.message_id)
         return SELECT_MENUES
 
 
@@ -2816,7 +3598,7 @@ async def ask_beilagen_for_menu(update_or_query, context: ContextTypes.DEFAULT_T
         msg_dbg = await update_or_query.message.reply_text(
             f"DEBUG {gericht}: raw='{raw}' → codes={codes} → allowed={allowed}"
         )
-        context.user_data.setdefault("flow_msgs", []).append(msg_dbg.message_id)
+        track_msg(context, "flow_msgs", msg_dbg.message_id)
 
     # 2) Beilage-Codes aus df_gerichte lesen und parsen
     raw = df_gerichte.loc[df_gerichte["Gericht"] == gericht, "Beilagen"].iloc[0]
@@ -2898,7 +3680,7 @@ async def ask_showlist_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def beilage_select_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     query = update.callback_query
     await query.answer()
     data = query.data
@@ -2912,11 +3694,13 @@ async def beilage_select_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sel = sessions.setdefault(uid, {}).setdefault("beilagen", {}).setdefault(gericht, [])
 
     if data == "beilage_done":
+        edit_debouncer.cancel(query.message)
         context.user_data["menu_idx"] += 1
         if context.user_data["menu_idx"] < len(idx_list):
             return await ask_beilagen_for_menu(query, context)
 
-        # Alle Menüs abgearbeitet → zentrale Ausgabe
+        # Alle Menüs abgearbeitet → Beilagen sichern, dann zentrale Ausgabe
+        await persist_session(update)
         return await show_final_dishes_and_ask_persons(update, context, step=1)
 
 
@@ -2928,10 +3712,11 @@ async def beilage_select_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         sel.append(num)
 
-    # Buttons neu zeichnen
-    markup = build_beilage_keyboard(set(context.user_data.get("allowed_beilage_codes", [])), sel)
-    await query.message.edit_reply_markup(markup)
-    
+    # Buttons neu zeichnen (gebündelt bei schnellen Klicks)
+    edit_debouncer.schedule(query.message, lambda: query.message.edit_reply_markup(
+        build_beilage_keyboard(set(context.user_data.get("allowed_beilage_codes", [])), sel)
+    ))
+
     return BEILAGEN_SELECT
 
 
@@ -2949,7 +3734,7 @@ async def ask_final_list_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     user_id = str(update.message.from_user.id)
     basis = df_gerichte
     reply = f"✅ Google Sheet OK, {len(basis)} Menüs verfügbar.\n"
@@ -3032,7 +3817,7 @@ def build_weight_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
-def build_aufwand_keyboard(verteilung: dict, total: int) -> InlineKeyboardMarkup:
+def build_aufwand_keyboard(verteilung: dict, total: int, sparsam: bool = False) -> InlineKeyboardMarkup:
     def zeile(label, key):
         anz = verteilung[key]
         return [
@@ -3060,6 +3845,13 @@ def build_aufwand_keyboard(verteilung: dict, total: int) -> InlineKeyboardMarkup
             InlineKeyboardButton(f"{summe}/{total} gewählt", callback_data="noop"),
         ])
 
+    rows.append([
+        InlineKeyboardButton(
+            f"{'✅' if sparsam else '⬜'} Sparsam einkaufen",
+            callback_data="aufwand_sparsam",
+        )
+    ])
+
     return InlineKeyboardMarkup(rows)
 
 
@@ -3088,8 +3880,24 @@ def build_profile_overview_keyboard() -> InlineKeyboardMarkup:
 #>>>>>>>>>>>>TAUSCHE
 ##############################################
 
+SWAP_HISTORY_MAX = int(os.getenv("SWAP_HISTORY_MAX", "30"))   # pro Aufwand-Stufe
+
+def get_swap_history(sess: dict) -> dict[int, list]:
+    """
+    No-Repeat-History der Session je Aufwand-Stufe (1–3). Aus dem Store
+    geladen sind die Schlüssel Strings ("1") → hier wieder int. Pro Stufe
+    bleiben nur die letzten SWAP_HISTORY_MAX Gerichte (kleine Session-Writes).
+    """
+    raw = sess.get("swap_history") or {}
+    hist = {
+        lvl: list(raw.get(lvl, raw.get(str(lvl), [])))[-SWAP_HISTORY_MAX:]
+        for lvl in (1, 2, 3)
+    }
+    sess["swap_history"] = hist
+    return hist
+
 async def tausche(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     user_id = str(update.message.from_user.id)
     if user_id not in sessions:
         return await update.message.reply_text("⚠️ Nutze erst /menu.")
@@ -3107,7 +3915,7 @@ async def tausche(update: Update, context: ContextTypes.DEFAULT_TYPE):
     basis_df = apply_profile_filters(df_gerichte, profile)
 
     # 2) Globaler Swap-History per Aufwand-Stufe initialisieren
-    swap_history = sess.setdefault("swap_history", {1: [], 2: [], 3: []})
+    swap_history = get_swap_history(sess)
     # Beim ersten Mal: die initialen Menüs eintragen
     if all(len(v) == 0 for v in swap_history.values()):
         for dish, lvl in zip(menues, aufw):
@@ -3189,7 +3997,7 @@ async def tausche(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             swap_history[current_aufw].append(neu)
 
-    persist_session(update)
+    await persist_session(update)
 
     
     if show_debug_for(update):
@@ -3232,7 +4040,7 @@ async def tausche(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def tausche_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     """
     Entry-Point für '/tausche' ohne Argumente:
     Zeigt ein Inline-Keyboard mit den Menü-Indizes 1…N zum Mehrfach-Tausch.
@@ -3256,10 +4064,16 @@ async def tausche_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=kb
     )
     # erste Prompt-Nachricht tracken
-    context.user_data["flow_msgs"] = [msg.message_id]
+    clear_tracked(context, "flow_msgs", msg.message_id)
     return TAUSCHE_SELECT
 
 
+def _schedule_aufwand_render(query, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ud = context.user_data
+    edit_debouncer.schedule(query.message, lambda: query.message.edit_reply_markup(
+        reply_markup=build_aufwand_keyboard(ud["aufwand_verteilung"], ud["menu_count"], ud.get("sparsam", False))
+    ))
+
 async def aufwand_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -3286,7 +4100,7 @@ async def aufwand_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 changed = True
 
         if changed:
-            await _debounced_aufwand_render(query, context)
+            _schedule_aufwand_render(query, context)
 
         return MENU_AUFWAND
 
@@ -3298,9 +4112,13 @@ async def aufwand_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         verteilung["medium"] = picks.count("medium")
         verteilung["heavy"]  = picks.count("heavy")
 
-        await query.message.edit_reply_markup(
-            reply_markup=build_aufwand_keyboard(verteilung, total)
-        )
+        _schedule_aufwand_render(query, context)
+        return MENU_AUFWAND
+
+    elif data == "aufwand_sparsam":
+        # Sparmodus umschalten (gilt für diesen und folgende Läufe)
+        context.user_data["sparsam"] = not context.user_data.get("sparsam", False)
+        _schedule_aufwand_render(query, context)
         return MENU_AUFWAND
 
     elif data == "aufwand_done":
@@ -3314,13 +4132,7 @@ async def aufwand_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         total = a1 + a2 + a3  # sichere Gesamtmenge
 
         # 🚫 WICHTIG: evtl. geplanten Debounce-Render abbrechen (gegen „erst Buttons weg, dann Text weg“)
-        task = context.user_data.pop("aufw_render_task", None)
-        if task and not task.done():
-            try:
-                task.cancel()
-            except Exception:
-                pass
-        context.user_data["aufw_dirty"] = False
+        edit_debouncer.cancel(query.message)
 
         # Nachricht EINMALIG komplett löschen (Buttons + Text zusammen)
         try:
@@ -3341,7 +4153,7 @@ async def aufwand_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def tausche_select_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     """Callback, um per Inline-Button mehrere Gerichte zu markieren."""
     q = update.callback_query
     await q.answer()
@@ -3359,18 +4171,15 @@ async def tausche_select_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             sel.add(idx)
 
-        # komplette Nachricht neu senden, damit Telegram das Label neu rendert
-        text = "Welche Gerichte möchtest Du tauschen?"
-        kb = build_swap_keyboard(sessions[uid]["menues"], sel)
-        try:
-            await q.edit_message_text(pad_message(text), reply_markup=kb)
-        except BadRequest as e:
-            # Ignoriere „Message is not modified“-Fehler, wir ändern ja nur bei echtem Wechsel
-            if "Message is not modified" not in str(e):
-                raise
-
+        # nur das Keyboard neu zeichnen (Text bleibt gleich), gebündelt bei schnellen Klicks
+        menues = sessions[uid]["menues"]
+        edit_debouncer.schedule(q.message, lambda: q.edit_message_reply_markup(
+            reply_markup=build_swap_keyboard(menues, sel)
+        ))
         return TAUSCHE_SELECT
 
+    edit_debouncer.cancel(q.message)
+
     if data == "swap_done" and not sel:
         # Tausch-Frage entfernen
         try:
@@ -3393,7 +4202,7 @@ async def tausche_select_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
              InlineKeyboardButton("Nein", callback_data="ask_no")]
         ])
         msg2 = await q.message.reply_text(pad_message("Möchtest Du Beilagen hinzufügen?"), reply_markup=kb)
-        context.user_data.setdefault("flow_msgs", []).append(msg2.message_id)
+        track_msg(context, "flow_msgs", msg2.message_id)
         return ASK_BEILAGEN
 
 
@@ -3406,7 +4215,7 @@ async def tausche_select_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sessions[uid].setdefault("beilagen", {})
         menues = sessions[uid]["menues"]
         aufw = sessions[uid]["aufwand"]
-        swap_history = sessions[uid].setdefault("swap_history", {1: [], 2: [], 3: []})
+        swap_history = get_swap_history(sessions[uid])
         if all(len(v) == 0 for v in swap_history.values()):
             for dish, lvl in zip(menues, aufw):
                 swap_history[lvl].append(dish)
@@ -3475,7 +4284,7 @@ async def tausche_select_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             sessions[uid]["beilagen"].pop(current_dish, None)
             swapped_slots.append(idx)
 
-        persist_session(update)
+        await persist_session(update)
         context.user_data["swapped_indices"] = swapped_slots
 
         # 2) Tauschfrage (diese Nachricht) entfernen + aus flow_msgs austragen
@@ -3486,7 +4295,7 @@ async def tausche_select_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         except Exception:
             pass
-        flow_ids = context.user_data.get("flow_msgs", [])
+        flow_ids = tracked_msgs(context, "flow_msgs")
         if isinstance(flow_ids, list):
             try:
                 flow_ids.remove(q.message.message_id)
@@ -3514,7 +4323,7 @@ async def tausche_select_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ─────────── tausche_confirm_cb ───────────
 async def tausche_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     q = update.callback_query
     await q.answer()
     chat_id = q.message.chat.id
@@ -3525,7 +4334,7 @@ async def tausche_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
         context.user_data["swap_candidates"] = set()
 
         # Nur die letzte Frage löschen (nicht die Liste/den Vorschlag)
-        flow = context.user_data.get("flow_msgs", [])
+        flow = tracked_msgs(context, "flow_msgs")
         if flow:
             last_id = flow.pop()
             try:
@@ -3535,13 +4344,13 @@ async def tausche_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         kb = build_swap_keyboard(sessions[uid]["menues"], context.user_data["swap_candidates"])
         msg = await q.message.reply_text(pad_message("Welche Gerichte möchtest Du tauschen?"), reply_markup=kb)
-        context.user_data["flow_msgs"].append(msg.message_id)
+        track_msg(context, "flow_msgs", msg.message_id)
         return TAUSCHE_SELECT
 
 
     if q.data == "swap_ok":
         # Buttons der Vorschlagskarte entfernen (kein Umschalten auf "Ja/Nein")
-        flow = context.user_data.get("flow_msgs", [])
+        flow = tracked_msgs(context, "flow_msgs")
         if flow:
             last_id = flow.pop()
             try:
@@ -3576,8 +4385,170 @@ async def tausche_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
 #>>>>>>>>>>>>FERTIG
 ##############################################
 
+class FinalList:
+    """
+    Kompakte, serialisierbare Endliste (liegt in sessions[uid]["final"]).
+    Zutaten sind Tupel (Vokabular-ID, Menge, Freitext | None), bereits für
+    die Personenzahl skaliert; Gerichte/Beilagen nur als Name bzw. Nummer.
+      dishes: [(Gericht, [Beilagen-Nummern], Aufwand | None, [Zutat-Tupel]), …]
+      sides:  {Beilagen-Nummer: [Zutat-Tupel]}  – jede Beilage nur einmal
+    Exporte (Chat, Bring!, PDF) rendern direkt daraus.
+    """
+    __slots__ = ("version", "personen", "layout", "dishes", "sides")
+
+    def __init__(self, personen: int, dishes: list, sides: dict, layout: str = AISLE_DEFAULT, version: str = ""):
+        self.version  = version or _CATALOG_VERSION
+        self.personen = personen
+        self.layout   = layout
+        self.dishes   = dishes
+        self.sides    = sides
+
+    @classmethod
+    @traced("final_list_build")
+    def build(cls, menues: list[str], beilagen: dict, aufwand: list, personen: int,
+              *, vegi: bool = False, layout: str = AISLE_DEFAULT) -> "FinalList":
+        faktor = personen / 4
+
+        def items(typ: str, name: str) -> list[tuple]:
+            out = []
+            for vid, menge, raw in _ZUT_ROWS.get((typ, name), ()):
+                # Vegi-Profil: Fleisch raus (Katalog-Kategorie „Fleisch & Fisch“)
+                if vegi and _ZUT_VOCAB[vid][1].strip().startswith("Fleisch"):
+                    continue
+                out.append((vid, round(menge * faktor, 3), raw))
+            return out
+
+        side_name = df_beilagen.set_index("Nummer")["Beilagen"].to_dict()
+        sides = {}
+        dishes = []
+        for i, g in enumerate(menues):
+            nums = [int(n) for n in (beilagen or {}).get(g, []) if int(n) in side_name]
+            for n in nums:
+                if n not in sides:
+                    sides[n] = items("Beilagen", side_name[n])
+            lvl = aufwand[i] if i < len(aufwand or []) else None
+            dishes.append((g, nums, lvl, items("Gericht", g)))
+        return cls(personen, dishes, sides, layout)
+
+    # -- Serialisierung: nur Listen von Maps – Firestore erlaubt keine
+    #    verschachtelten Arrays (sonst scheitert jeder Session-Write)
+    @staticmethod
+    def _items_out(its: list) -> list[dict]:
+        return [{"v": vid, "m": m, "raw": raw} for vid, m, raw in its]
+
+    @staticmethod
+    def _items_in(its: list) -> list[tuple]:
+        return [(int(t["v"]), t["m"], t.get("raw")) for t in its]
+
+    def to_dict(self) -> dict:
+        return {
+            "version":  self.version,
+            "personen": self.personen,
+            "layout":   self.layout,
+            "dishes":   [{"g": g, "sides": list(n), "lvl": lvl, "items": self._items_out(its)}
+                         for g, n, lvl, its in self.dishes],
+            "sides":    [{"n": n, "items": self._items_out(its)} for n, its in self.sides.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict | None) -> "FinalList | None":
+        """None, wenn nichts da ist oder die IDs zu einem anderen Katalog gehören."""
+        if not isinstance(d, dict) or d.get("version") != _CATALOG_VERSION:
+            return None
+        try:
+            dishes = [(x["g"], [int(n) for n in x.get("sides") or []], x.get("lvl"), cls._items_in(x.get("items") or []))
+                      for x in d["dishes"]]
+            sides  = {int(x["n"]): cls._items_in(x.get("items") or []) for x in d["sides"]}
+            return cls(int(d["personen"]), dishes, sides, d.get("layout") or AISLE_DEFAULT, d["version"])
+        except Exception:
+            return None
+
+    # -- Abfragen
+    def names(self) -> list[str]:
+        return [g for g, _, _, _ in self.dishes]
+
+    def einkauf(self) -> pd.DataFrame:
+        """
+        Aggregierte Einkaufsliste (Zutat | Kategorie | Einheit | Menge | Menge_raw)
+        in Laden-Reihenfolge. Menge_raw ist nur bei Freitext-Mengen ein str.
+        """
+        menge: dict[int, float] = {}
+        raw_first: dict[int, str | None] = {}
+        for its in [d[3] for d in self.dishes] + list(self.sides.values()):
+            for vid, m, raw in its:
+                menge[vid] = menge.get(vid, 0.0) + m
+                raw_first.setdefault(vid, raw)
+        df = pd.DataFrame(
+            [(*_ZUT_VOCAB[v], menge[v], raw_first[v]) for v in menge],
+            columns=["Zutat", "Kategorie", "Einheit", "Menge", "Menge_raw"],
+        )
+        return order_einkaufsliste(df, self.layout)
+
+
+def format_zutat_amount(zutat: str, einheit: str, menge: float, raw: str | None, sep: str = ": ") -> str:
+    """Eine Zutat als Text: Freitext-Menge (str) oder normalisierte Zahl + Einheit."""
+    if isinstance(raw, str):
+        return f"{zutat}{sep}{raw or 'wenig'}"
+    amt2, unit2 = normalize_quantity(float(menge), str(einheit))
+    return f"{zutat}{sep}{format_amount(amt2)} {unit2}"
+
+_AUFWAND_LABELS = {1: "(<30min)", 2: "(30-60min)", 3: "(>60min)"}
+
+def iter_kochliste(fl: FinalList):
+    """Liefert je Gericht (Gericht, Beilagen-Namen, Aufwand-Label, Zutaten-Texte)."""
+    side_name = df_beilagen.set_index("Nummer")["Beilagen"].to_dict()
+    aufwand_by_dish = df_gerichte.set_index("Gericht")["Aufwand"].to_dict()
+    for g, nums, lvl, its in fl.dishes:
+        # Aufwand zuerst aus der Session, sonst aus df (nur 1/2/3 zulassen)
+        if lvl not in (1, 2, 3):
+            try:
+                lvl = int(aufwand_by_dish.get(g, 0))
+            except Exception:
+                lvl = 0
+        parts = list(its)
+        for n in nums:
+            parts += fl.sides.get(n, [])
+        texts = [format_zutat_amount(_ZUT_VOCAB[v][0], _ZUT_VOCAB[v][2], m, raw, sep=" ") for v, m, raw in parts]
+        yield g, [side_name[n] for n in nums if n in side_name], _AUFWAND_LABELS.get(lvl, ""), texts
+
+@traced("render_list")
+def render_einkaufsliste_html(fl: FinalList) -> str:
+    text = f"\n<b>🛒 <u>Einkaufsliste für {fl.personen} Personen:</u></b>\n"
+    for cat, group in fl.einkauf().groupby("Kategorie", sort=False):
+        emoji = CAT_EMOJI.get(cat, "")
+        text += f"\n{emoji} <u>{escape(str(cat))}</u>\n"
+        for r in group.itertuples(index=False):
+            text += f"‣ {escape(format_zutat_amount(r.Zutat, r.Einheit, r.Menge, r.Menge_raw))}\n"
+    return text
+
+@traced("render_list")
+def render_kochliste_html(fl: FinalList) -> str:
+    text = f"\n<b><u>🍽 Kochliste für {fl.personen} Personen:</u></b>\n"
+    link_by_dish = df_gerichte.set_index("Gericht")["Link"].to_dict()
+    for g, side_names, label, texts in iter_kochliste(fl):
+        # Link (falls vorhanden) außen, Bold innen: <a><b>…</b></a>
+        raw_link = normalize_link(str(link_by_dish.get(g, "") or ""))
+        name_html = f"<b>{escape(g)}</b>"
+        if raw_link:
+            name_html = f'<a href="{escape(raw_link, quote=True)}"><b>{escape(g)}</b></a>'
+
+        # Zusatz hinter dem Gerichts-Namen (z.B. " mit Reis und Brokkoli")
+        full_title = format_dish_with_sides(g, side_names)
+        rest       = full_title[len(g):] if full_title.startswith(g) else ""
+        rest_html  = f"<b>{escape(rest)}</b>" if rest else ""
+        label_html = f" <i>{escape(label)}</i>" if label else ""
+
+        text += f"\n{name_html}{rest_html}{label_html}\n{escape(', '.join(texts))}\n"
+    return text
+
+def get_final_list(uid: str) -> FinalList | None:
+    """Endliste aus der (ggf. nachgeladenen) Session."""
+    return FinalList.from_dict((sessions.get(uid) or {}).get("final"))
+
+
+
 async def fertig_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     if str(update.message.from_user.id) not in sessions:
         await update.message.reply_text("⚠️ Keine Menüs gewählt.")
         return ConversationHandler.END
@@ -3585,7 +4556,7 @@ async def fertig_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return FERTIG_PERSONEN
 
 async def fertig_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     user_id = str(update.effective_user.id)
     chat_id = update.effective_chat.id
 
@@ -3601,127 +4572,15 @@ async def fertig_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Ungültige Zahl.")
             return PERSONS_MANUAL
 
-    faktor = personen / 4
-    df = df_zutaten
-    ausgew = sessions[user_id]["menues"]
-    context.user_data["final_list"] = ausgew
-
-    # Hauptgerichte
-    zut_gericht = df[
-        (df["Typ"] == "Gericht") &
-        (df["Gericht"].isin(ausgew))
-    ].copy()
-
-    # Beilagen
-    all_nums = sum(sessions[user_id].get("beilagen", {}).values(), [])
-    beilage_names = df_beilagen.loc[df_beilagen["Nummer"].isin(all_nums), "Beilagen"].tolist()
-    zut_beilage = df[
-        (df["Typ"] == "Beilagen") &
-        (df["Gericht"].isin(beilage_names))
-    ].copy()
-
-    # Zusammenführen + skalieren
-    zut = pd.concat([zut_gericht, zut_beilage], ignore_index=True)
-    zut["Menge"] *= faktor
-
-    # Vegi-Profil: Fleisch raus
+    sess = sessions[user_id]
     profile = profiles.get(user_id)
-    if profile and profile.get("restriction") == "Vegi":
-        zut = zut[zut["Kategorie"] != "Fleisch"]
-
-    # ---- Einkaufsliste (gruppiert) ----
-    eink = (
-        zut.groupby(["Zutat", "Kategorie", "Einheit"])
-        .agg(Menge=("Menge", "sum"), Menge_raw=("Menge_raw", "first"))
-        .reset_index()
-        .sort_values(["Kategorie", "Zutat"])
+    fl = FinalList.build(
+        sess["menues"], sess.get("beilagen", {}), sess.get("aufwand", []), personen,
+        vegi=bool(profile and profile.get("restriction") == "Vegi"),
+        layout=await aisle_layout_for(user_id, context),
     )
-
-    eink_text = f"\n<b>🛒 <u>Einkaufsliste für {personen} Personen:</u></b>\n"
-    for cat, group in eink.groupby("Kategorie"):
-        emoji = CAT_EMOJI.get(cat, "")
-        eink_text += f"\n{emoji} <u>{escape(str(cat))}</u>\n"
-        for _, r in group.iterrows():
-            raw = str(r["Menge_raw"]).strip()
-            if not raw.replace(".", "").isdigit():
-                txt = raw or "wenig"
-                line = f"‣ {r.Zutat}: {txt}"
-            else:
-                amt2, unit2 = normalize_quantity(float(r["Menge"]), str(r["Einheit"]))
-                amt = format_amount(amt2)
-                line = f"‣ {r['Zutat']}: {amt} {unit2}"
-            eink_text += f"{line}\n"
-
-    # --- Kochliste mit Hauptgericht- und Beilagen-Zutaten in der richtigen Reihenfolge ---
-    koch_text = f"\n<b><u>🍽 Kochliste für {personen} Personen:</u></b>\n"
-
-    # Schnelle Lookups für Link & Aufwand
-    _link_by_dish    = df_gerichte.set_index("Gericht")["Link"].to_dict()
-    _aufwand_by_dish = df_gerichte.set_index("Gericht")["Aufwand"].to_dict()
-    # Session-Aufwand (falls vorhanden) hat Vorrang
-    _aufwand_session = {}
-    try:
-        _aufwand_session = {d: lv for d, lv in zip(ausgew, sessions[user_id].get("aufwand", []))}
-    except Exception:
-        _aufwand_session = {}
-
-    _label_map = {1: "(<30min)", 2: "(30-60min)", 3: "(>60min)"}
-
-    for g in ausgew:
-        # 1) Beilagen-Namen zum Gericht
-        sel_nums       = sessions[user_id].get("beilagen", {}).get(g, [])
-        beilagen_namen = df_beilagen.loc[df_beilagen["Nummer"].isin(sel_nums), "Beilagen"].tolist()
-
-        # 2) Zutaten für Hauptgericht + Beilagen in Reihenfolge zusammenführen
-        part_haupt = zut[(zut["Typ"] == "Gericht") & (zut["Gericht"] == g)]
-        parts_list = [part_haupt]
-        for b in beilagen_namen:
-            part_b = zut[(zut["Typ"] == "Beilagen") & (zut["Gericht"] == b)]
-            parts_list.append(part_b)
-        part = pd.concat(parts_list, ignore_index=True)
-
-        # 3) Zutaten-Text (HTML-escapen)
-        ze_parts = []
-        for _, row in part.iterrows():
-            raw = str(row["Menge_raw"]).strip()
-            if not raw.replace(".", "").isdigit():
-                txt = raw or "wenig"
-                ze_parts.append(f"{row['Zutat']} {txt}")
-            else:
-                amt2, unit2 = normalize_quantity(float(row["Menge"]), str(row["Einheit"]))
-                amt = format_amount(amt2)
-                ze_parts.append(f"{row['Zutat']} {amt} {unit2}")
-
-        ze_html = escape(", ".join(ze_parts))
-
-        # 4) Titel: Link (falls vorhanden) + Beilagenzusatz + Aufwand-Label
-        #    a) Link robust (https:// ergänzen, falls fehlt)
-        raw_link = normalize_link(str(_link_by_dish.get(g, "") or ""))
-
-        #    b) Haupttitel (Link außen, Bold innen: <a><b>…</b></a>)
-        name_html = f"<b>{escape(g)}</b>"
-        if raw_link:
-            name_html = f'<a href="{escape(raw_link, quote=True)}"><b>{escape(g)}</b></a>'
-
-        #    c) Zusatz hinter dem Gerichts-Namen (z.B. " mit Reis und Brokkoli")
-        full_title = format_dish_with_sides(g, beilagen_namen)
-        rest       = full_title[len(g):] if full_title.startswith(g) else ""
-        rest_html  = f"<b>{escape(rest)}</b>" if rest else ""
-
-        #    d) Aufwand zuerst aus der Session, sonst aus df (nur 1/2/3 zulassen)
-        lvl = _aufwand_session.get(g, None)
-        if lvl not in (1, 2, 3):
-            try:
-                lvl = int(_aufwand_by_dish.get(g, 0))
-            except Exception:
-                lvl = 0
-
-        aufwand_label_html = ""
-        if lvl in _label_map:
-            aufwand_label_html = f"<i>{escape(_label_map[lvl])}</i>"
-
-        display_title_html = f"{name_html}{rest_html}{(' ' + aufwand_label_html) if aufwand_label_html else ''}"
-        koch_text += f"\n{display_title_html}\n{ze_html}\n"
+    eink_text = render_einkaufsliste_html(fl)
+    koch_text = render_kochliste_html(fl)
 
     # Vorschlagskarte ("Mein Vorschlag" / "Neuer Vorschlag") gezielt entfernen
     await delete_proposal_card(context, chat_id)
@@ -3730,9 +4589,9 @@ async def fertig_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ---- Flow-UI aufräumen (nur flow_msgs) ----
     await reset_flow_state(update, context, reset_session=False, delete_messages=True, only_keys=["flow_msgs"])
 
-    # ---- Für Exporte merken ----
-    context.user_data["einkaufsliste_df"] = eink
-    context.user_data["kochliste_text"]   = koch_text
+    # ---- Für Exporte & „📌 Plan merken“ merken (kompakt, übersteht Neustarts) ----
+    sessions[user_id]["final"] = fl.to_dict()
+    await persist_session(update)
     
     # — Einkaufs- & Kochliste senden + Export-Buttons an dieselbe Nachricht —
 
@@ -3753,6 +4612,115 @@ async def fertig_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+##############################################
+#>>>>>>>>>>>>GEMERKTE PLÄNE (kombinierte Einkaufsliste)
+##############################################
+
+PLAN_PIN_MAX = int(os.getenv("PLAN_PIN_MAX", "10"))
+
+def build_base_aggregate(eink: pd.DataFrame) -> list[dict]:
+    """
+    Einkaufsliste (FinalList.einkauf(), bereits für die Personenzahl skaliert)
+    → speicherbares Basis-Aggregat: Mengen in Basiseinheiten (g/ml),
+    Freitext-Mengen als 'raw'.
+    """
+    items = []
+    for zutat, kat, einheit, menge, raw in zip(
+        eink["Zutat"], eink["Kategorie"], eink["Einheit"], eink["Menge"], eink["Menge_raw"]
+    ):
+        if not isinstance(raw, str):
+            amt, unit = to_base_unit(float(menge), str(einheit))
+            items.append({"zutat": zutat, "kategorie": kat, "einheit": unit, "menge": round(amt, 3), "raw": None})
+        else:
+            items.append({"zutat": zutat, "kategorie": kat, "einheit": str(einheit), "menge": None, "raw": raw or "wenig"})
+    return items
+
+def merge_aggregates(plans: list[dict], layout_key: str = AISLE_DEFAULT) -> pd.DataFrame:
+    """
+    Führt die Basis-Aggregate mehrerer Pläne in einem Rutsch zusammen
+    (ein groupby über alle Zeilen, keine Neuberechnung aus df_zutaten).
+    Spalten: Zutat | Kategorie | Einheit | Menge | Menge_raw
+    """
+    rows = [it for p in plans for it in (p.get("items") or [])]
+    if not rows:
+        return pd.DataFrame(columns=["Zutat", "Kategorie", "Einheit", "Menge", "Menge_raw"])
+
+    df = pd.DataFrame(rows)
+    keys = ["zutat", "kategorie", "einheit"]
+    num = df[df["menge"].notna()]
+    txt = df[df["menge"].isna()]
+
+    num = num.groupby(keys, as_index=False).agg(menge=("menge", "sum"))
+    num["raw"] = None
+    txt = txt.groupby(keys, as_index=False).agg(raw=("raw", lambda s: " + ".join(dict.fromkeys(s))))
+    txt["menge"] = None
+
+    out = pd.concat([num, txt], ignore_index=True)
+    out.columns = [c.capitalize() for c in out.columns]
+    return order_einkaufsliste(out.rename(columns={"Raw": "Menge_raw"}), layout_key)
+
+def build_plans_text(plans: list[dict], layout_key: str = AISLE_DEFAULT) -> str:
+    """Übersicht der gemerkten Pläne + kombinierte Einkaufsliste (HTML)."""
+    lines = [f"📌 <b><u>Gemerkte Pläne ({len(plans)}):</u></b>"]
+    for i, p in enumerate(plans, 1):
+        dishes = ", ".join(p.get("menues") or [])
+        lines.append(f"{i}. {p.get('personen', '?')} Pers. · {escape(dishes)} <i>({escape(str(p.get('pinned_at', '')))})</i>")
+
+    lines.append("\n<b>🛒 <u>Kombinierte Einkaufsliste:</u></b>")
+    for cat, group in merge_aggregates(plans, layout_key).groupby("Kategorie", sort=False):
+        lines.append(f"\n{CAT_EMOJI.get(cat, '')} <u>{escape(str(cat))}</u>")
+        for r in group.itertuples(index=False):
+            if r.Menge_raw is not None and pd.isna(r.Menge):
+                lines.append(f"‣ {escape(str(r.Zutat))}: {escape(str(r.Menge_raw))}")
+            else:
+                amt2, unit2 = normalize_quantity(float(r.Menge), str(r.Einheit))
+                lines.append(f"‣ {escape(str(r.Zutat))}: {format_amount(amt2)} {escape(unit2)}")
+    return "\n".join(lines)
+
+async def plan_pin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Button „📌 Plan merken“: legt das Basis-Aggregat der aktuellen Liste ab."""
+    q = update.callback_query
+    uid, _ = await ensure_session_loaded_for_user_and_chat(update)
+    fl = get_final_list(uid)
+    if fl is None:
+        await q.answer("Keine fertige Einkaufsliste gefunden.", show_alert=True)
+        return
+
+    ukey = user_key(int(uid))
+    plans = await store_get_pinned_plans(ukey)
+    plan = {
+        "menues":    fl.names(),
+        "personen":  fl.personen,
+        "items":     build_base_aggregate(fl.einkauf()),
+        "pinned_at": datetime.now().strftime("%d.%m.%y %H:%M"),
+    }
+    if any(p.get("menues") == plan["menues"] and p.get("personen") == plan["personen"] for p in plans):
+        await q.answer("Dieser Plan ist schon gemerkt.", show_alert=False)
+        return
+
+    plans = (plans + [plan])[-PLAN_PIN_MAX:]
+    await store_set_pinned_plans(ukey, plans)
+    await q.answer(f"📌 Plan gemerkt ({len(plans)} gesamt) – /plaene zeigt die kombinierte Liste.", show_alert=True)
+
+async def plaene(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/plaene – gemerkte Pläne + kombinierte, einheiten-normalisierte Einkaufsliste."""
+    uid = str(update.message.from_user.id)
+    plans = await store_get_pinned_plans(user_key(int(uid)))
+    if not plans:
+        return await update.message.reply_text(
+            "📌 Noch keine Pläne gemerkt. Nach der Einkaufsliste: „📌 Plan merken“."
+        )
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🗑 Leeren", callback_data="plan_clear")]])
+    await update.message.reply_text(build_plans_text(plans, await aisle_layout_for(uid, context)), reply_markup=kb)
+
+async def plan_clear_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    await store_delete_pinned_plans(user_key(int(q.from_user.id)))
+    await q.edit_message_text("🗑 Gemerkte Pläne gelöscht.")
+
+
+
 ##############################################
 #>>>>>>>>>>>>EXPORTE / FINALE
 ##############################################
@@ -3764,26 +4732,21 @@ async def export_to_bring(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    eink = context.user_data.get("einkaufsliste_df")
-    if eink is None:
+    uid, _ = await ensure_session_loaded_for_user_and_chat(update)
+    fl = get_final_list(uid)
+    if fl is None:
         await query.edit_message_text("❌ Keine Einkaufsliste gefunden.")
         return ConversationHandler.END
 
-    # --- JSON-LD vorbereiten (stabil sortiert) ---
-    eink_sorted = (
-        eink.copy()
-        .assign(Kategorie=lambda d: d["Kategorie"].fillna("Sonstiges"))
-        .sort_values(["Kategorie", "Zutat"], kind="mergesort")
-    )
+    # --- JSON-LD vorbereiten (Reihenfolge = Laden-Layout der FinalList) ---
     recipe_ingredients = []
-    for _, r in eink_sorted.iterrows():
-        raw = str(r["Menge_raw"]).strip()
-        if raw and not raw.replace(".", "").isdigit():
+    for r in fl.einkauf().itertuples(index=False):
+        if isinstance(r.Menge_raw, str) and r.Menge_raw:
             # Freitext-Menge (z. B. "1 Dose")
-            recipe_ingredients.append(f"{raw} {r['Zutat']}".strip())
+            recipe_ingredients.append(f"{r.Menge_raw} {r.Zutat}".strip())
         else:
-            amt2, unit2 = normalize_quantity(float(r["Menge"]), str(r["Einheit"]))
-            recipe_ingredients.append(f"{format_amount(amt2)} {unit2} {r['Zutat']}".strip())
+            amt2, unit2 = normalize_quantity(float(r.Menge), str(r.Einheit))
+            recipe_ingredients.append(f"{format_amount(amt2)} {unit2} {r.Zutat}".strip())
 
     recipe_jsonld = {
         "@context": "https://schema.org",
@@ -3817,15 +4780,17 @@ async def export_to_bring(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
 
     try:
-        gist_resp = await HTTPX_CLIENT.post("https://api.github.com/gists", json=gist_payload, headers=headers)
-        gist_resp.raise_for_status()
+        with timed("github", "gist"):
+            gist_resp = await HTTPX_CLIENT.post("https://api.github.com/gists", json=gist_payload, headers=headers)
+            gist_resp.raise_for_status()
         raw_url = gist_resp.json()["files"]["recipe.html"]["raw_url"]
 
-        dl_resp = await HTTPX_CLIENT.get(
-            "https://api.getbring.com/rest/bringrecipes/deeplink",
-            params={"url": raw_url, "source": "web"},
-            follow_redirects=False,
-        )
+        with timed("bring", "deeplink"):
+            dl_resp = await HTTPX_CLIENT.get(
+                "https://api.getbring.com/rest/bringrecipes/deeplink",
+                params={"url": raw_url, "source": "web"},
+                follow_redirects=False,
+            )
         if dl_resp.status_code in (301, 302, 303, 307, 308):
             deeplink = dl_resp.headers.get("location")
         else:
@@ -3861,9 +4826,9 @@ async def export_to_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    eink_df   = context.user_data.get("einkaufsliste_df")
-    koch_text = context.user_data.get("kochliste_text")
-    if eink_df is None or eink_df.empty or not koch_text:
+    uid, _ = await ensure_session_loaded_for_user_and_chat(update)
+    fl = get_final_list(uid)
+    if fl is None or not fl.dishes:
         await query.edit_message_text("❌ Keine Listen zum Export gefunden.")
         return ConversationHandler.END
 
@@ -3909,8 +4874,11 @@ async def process_pdf_export_choice(update: Update, context: ContextTypes.DEFAUL
     await q.answer()
     choice = q.data.split("_")[-1]  # "einkauf", "koch" oder "beides"
 
-    eink_df   = context.user_data.get("einkaufsliste_df")
-    koch_text = context.user_data.get("kochliste_text")
+    uid, _ = await ensure_session_loaded_for_user_and_chat(update)
+    fl = get_final_list(uid)
+    if fl is None:
+        await q.edit_message_text("❌ Keine Listen zum Export gefunden.")
+        return ConversationHandler.END
 
     # PDF initialisieren (mit Kopf-/Fußzeile und 2 cm Rändern)
     date_str = datetime.now().strftime("%d.%m.%Y")
@@ -3927,40 +4895,17 @@ async def process_pdf_export_choice(update: Update, context: ContextTypes.DEFAUL
         pdf.set_font("DejaVu", "B", 14)
         pdf.cell(0, 10, "Kochliste", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
-        raw_lines = koch_text.splitlines()
-        lines = []
-        for l in raw_lines:
-            if not l.strip():
-                continue
-            plain = unescape(re.sub(r"<[^>]+>", "", l))
-            if "Kochliste" in plain:
-                continue
-            lines.append(l)
-
-        last_title = None
-        for l in lines:
-            if last_title is None:
-                last_title = l
-                continue
-
-            title_plain       = unescape(re.sub(r"<[^>]+>", "", last_title))
-            ingredients_plain = unescape(re.sub(r"<[^>]+>", "", l))
-            last_title = None
+        for g, side_names, label, texts in iter_kochliste(fl):
+            title_plain = format_dish_with_sides(g, side_names) + (f" {label}" if label else "")
 
             pdf.set_x(pdf.l_margin)
             pdf.set_font("DejaVu", "B", 12)
             pdf.multi_cell(pdf.epw, 8, title_plain, align="L")
 
-            pdf.set_x(pdf.l_margin)
-            pdf.set_font("DejaVu", "", 12)
-            pdf.multi_cell(pdf.epw, 8, ingredients_plain, align="L")
-            pdf.ln(2)
-
-        if last_title is not None:
-            title_plain = unescape(re.sub(r"<[^>]+>", "", last_title))
-            pdf.set_x(pdf.l_margin)
-            pdf.set_font("DejaVu", "B", 12)
-            pdf.multi_cell(pdf.epw, 8, title_plain, align="L")
+            if texts:
+                pdf.set_x(pdf.l_margin)
+                pdf.set_font("DejaVu", "", 12)
+                pdf.multi_cell(pdf.epw, 8, ", ".join(texts), align="L")
             pdf.ln(2)
 
     # ---------- Helper: EINKAUFSLISTE ----------
@@ -4008,7 +4953,7 @@ async def process_pdf_export_choice(update: Update, context: ContextTypes.DEFAUL
             return lines * line_h
 
         pdf.set_font("DejaVu", "", 12)
-        for cat, group in eink_df.sort_values(["Kategorie", "Zutat"]).groupby("Kategorie"):
+        for cat, group in fl.einkauf().groupby("Kategorie", sort=False):
             head = str(cat)
             ensure_space(8)
             pdf.set_font("DejaVu", "B", 12)
@@ -4017,14 +4962,8 @@ async def process_pdf_export_choice(update: Update, context: ContextTypes.DEFAUL
             pdf.set_x(current_x())
             pdf.set_font("DejaVu", "", 12)
 
-            for _, row in group.iterrows():
-                raw = str(row["Menge_raw"]).strip()
-                if not raw.replace(".", "").isdigit():
-                    txt  = raw or "wenig"
-                    line = f"▪ {row['Zutat']}: {txt}"
-                else:
-                    amt  = format_amount(row["Menge"])
-                    line = f"▪ {row['Zutat']}: {amt} {row['Einheit']}"
+            for r in group.itertuples(index=False):
+                line = f"▪ {format_zutat_amount(r.Zutat, r.Einheit, r.Menge, r.Menge_raw)}"
 
                 h = calc_item_height(line, line_h=6)
                 ensure_space(h)
@@ -4148,35 +5087,11 @@ async def restart_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return EXPORT_OPTIONS
 
     # === restart_yes ===
-    if confirm_id:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=confirm_id)
-        except Exception:
-            pass
-
-    # 1) Aktions-/Export-Nachrichten entfernen
-    for mid in context.user_data.get("export_msgs", []):
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-        except Exception:
-            pass
-    context.user_data["export_msgs"] = []
-
-    # 2) Vorschlagskarte gezielt entfernen
-    await delete_proposal_card(context, chat_id)
-
-    # 3) Alle bekannten UI-Listen JETZT leeren (damit später nichts „nachträglich“ löscht)
-    for key in ["flow_msgs", "prof_msgs", "fav_msgs", "fav_add_msgs"]:
-        ids = context.user_data.get(key, [])
-        for mid in ids:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-            except Exception:
-                pass
-        context.user_data[key] = []
+    # 1-3) Bestätigung, Aktions-/Export-Nachrichten, Vorschlagskarte und alle
+    #      UI-Listen in EINEM Sammel-Löschen (Listen danach leer → nichts löscht „nachträglich“)
+    await purge_msgs(context, chat_id, extra=[confirm_id, *pop_proposal_ids(context)])
     # Ein paar Marker zurücksetzen
-    for key in ["proposal_msg_id", "final_list_msg_id"]:
-        context.user_data.pop(key, None)
+    context.user_data.pop("final_list_msg_id", None)
 
     # 4) Session wirklich zurücksetzen (neuer Lauf!)
     uid = str(update.effective_user.id)
@@ -4184,7 +5099,7 @@ async def restart_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
         del sessions[uid]
     try:
         ckey = chat_key(int(update.effective_chat.id))
-        store_delete_session(ckey)
+        await store_delete_session(ckey)
     except Exception:
         pass
 
@@ -4230,33 +5145,18 @@ async def restart_confirm_ov(update: Update, context: ContextTypes.DEFAULT_TYPE)
     chat_id = q.message.chat.id
     data = q.data  # 'restart_yes_ov' | 'restart_no_ov'
 
-    # Bestätigungsfrage entfernen
-    try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=q.message.message_id)
-    except Exception:
-        pass
-
     if data == "restart_yes_ov":
-        # gleiche Aufräumlogik wie im anderen Restart
-        await delete_proposal_card(context, chat_id)
-
-        for key in ["flow_msgs", "prof_msgs", "fav_msgs", "fav_add_msgs", "export_msgs"]:
-            ids = context.user_data.get(key, [])
-            for mid in ids:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-                except Exception:
-                    pass
-            context.user_data[key] = []
-        for key in ["proposal_msg_id", "final_list_msg_id"]:
-            context.user_data.pop(key, None)
+        # gleiche Aufräumlogik wie im anderen Restart: Bestätigungsfrage,
+        # Vorschlagskarte und alle UI-Listen in einem Sammel-Löschen
+        await purge_msgs(context, chat_id, extra=[q.message.message_id, *pop_proposal_ids(context)])
+        context.user_data.pop("final_list_msg_id", None)
 
         uid = str(update.effective_user.id)
         if uid in sessions:
             del sessions[uid]
         try:
             ckey = chat_key(int(update.effective_chat.id))
-            store_delete_session(ckey)
+            await store_delete_session(ckey)
         except Exception:
             pass
 
@@ -4293,7 +5193,11 @@ async def restart_confirm_ov(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await send_overview(chat_id, context)
         return ConversationHandler.END
 
-    # data == 'restart_no_ov'
+    # data == 'restart_no_ov' → nur die Bestätigungsfrage entfernen
+    try:
+        await context.bot.delete_message(chat_id=chat_id, message_id=q.message.message_id)
+    except Exception:
+        pass
     return ConversationHandler.END
 
 
@@ -4304,35 +5208,17 @@ async def restart_cmd_global(update: Update, context: ContextTypes.DEFAULT_TYPE)
     chat_id = update.effective_chat.id
     uid     = str(update.effective_user.id)
 
-    # 1) Aktions-/Export-Nachrichten entfernen
-    for mid in context.user_data.get("export_msgs", []):
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-        except Exception:
-            pass
-    context.user_data["export_msgs"] = []
-
-    # 2) Vorschlagskarte gezielt entfernen
-    await delete_proposal_card(context, chat_id)
-
-    # 3) Alle bekannten UI-Listen leeren
-    for key in ["flow_msgs", "prof_msgs", "fav_msgs", "fav_add_msgs"]:
-        ids = context.user_data.get(key, [])
-        for mid in ids:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-            except Exception:
-                pass
-        context.user_data[key] = []
-    for key in ["proposal_msg_id", "final_list_msg_id"]:
-        context.user_data.pop(key, None)
+    # 1-3) Aktions-/Export-Nachrichten, Vorschlagskarte und alle UI-Listen
+    #      in einem Sammel-Löschen
+    await purge_msgs(context, chat_id, extra=pop_proposal_ids(context))
+    context.user_data.pop("final_list_msg_id", None)
 
     # 4) Session & QuickOne-Pool zurücksetzen
     if uid in sessions:
         del sessions[uid]
     try:
         ckey = chat_key(int(update.effective_chat.id))
-        store_delete_session(ckey)
+        await store_delete_session(ckey)
     except Exception:
         pass
     context.user_data.pop("quickone_remaining", None)
@@ -4383,60 +5269,27 @@ async def reset_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return ConversationHandler.END
 
     if q.data == "reset_yes":
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=confirm_id or q.message.message_id)
-        except Exception:
-            pass
-
-        # 1) Aktions-/Export-Nachrichten aufräumen
-        for mid in context.user_data.get("export_msgs", []):
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-            except Exception:
-                pass
-        context.user_data["export_msgs"] = []
-
-        # 2) Vorschlagskarte gezielt entfernen
-        await delete_proposal_card(context, chat_id)
+        # 1-3) Bestätigung, Aktions-/Export-Nachrichten, Vorschlagskarte und alle
+        #      UI-Listen (Flow-/Profil-/Fav-Nachrichten etc.) in einem Sammel-Löschen
+        await purge_msgs(context, chat_id, extra=[confirm_id or q.message.message_id, *pop_proposal_ids(context)])
+        context.user_data.pop("final_list_msg_id", None)
 
-        # 3) Alle bekannten UI-Listen leeren (Flow-/Profil-/Fav-Nachrichten etc.)
-        for key in ["flow_msgs", "prof_msgs", "fav_msgs", "fav_add_msgs"]:
-            ids = context.user_data.get(key, [])
-            for mid in ids:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-                except Exception:
-                    pass
-            context.user_data[key] = []
-        for key in ["proposal_msg_id", "final_list_msg_id"]:
-            context.user_data.pop(key, None)
-
-        # 4) Session & QuickOne-Pool zurücksetzen (in-memory + Persistenz pro Chat)
+        # 4+5) Session, Favoriten, Profil und gemerkte Pläne in EINEM Commit
+        #      zurücksetzen (Batch/Transaktion → nie nur halb zurückgesetzt)
         try:
-            if uid in sessions:
-                del sessions[uid]
-            ckey = chat_key(int(chat_id))
-            store_delete_session(ckey)
-        except Exception:
-            pass
+            ukey = user_key(int(uid))
+            await (
+                unit_of_work()
+                .delete_session(chat_key(int(chat_id)))
+                .set_favorites(ukey, [])
+                .delete_profile(ukey)
+                .delete_pinned_plans(ukey)
+                .acommit()
+            )
+        except Exception as e:
+            logging.warning("Reset: Persistenz-Commit fehlgeschlagen (%s)", e)
         context.user_data.pop("quickone_remaining", None)
 
-        # 5) Favoriten & Profil vollständig zurücksetzen (in-memory + Persistenz)
-        try:
-            # Favoriten
-            ensure_favorites_loaded(uid)
-            favorites[uid] = []
-            store_set_favorites(user_key(int(uid)), favorites[uid])
-        except Exception:
-            pass
-
-        try:
-            # Profil
-            profiles.pop(uid, None)
-            store_set_profile(user_key(int(uid)), {})  # leer speichern
-        except Exception:
-            pass
-
         # 6) „Neu starten“ wie beim bestätigten Neustart: Bye → Banner → Übersicht
         try:
             bye = await context.bot.send_message(chat_id, pad_message("Super, bis bald!👋"))
@@ -4472,7 +5325,7 @@ async def reset_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 ##############################################
 
 async def favorit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     user_id = str(update.message.from_user.id)
     if user_id not in sessions:
         return await update.message.reply_text("⚠️ Bitte erst /menu.")
@@ -4482,9 +5335,7 @@ async def favorit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     menues = sessions[user_id]["menues"]
     if 0<=idx<len(menues):
         fav = menues[idx]
-        ensure_favorites_loaded(user_id)
-        favorites.setdefault(user_id, []).append(fav)
-        store_set_favorites(user_key(int(user_id)), favorites[user_id])
+        await store_add_favorites(user_key(int(user_id)), [fav])
         await update.message.reply_text(f"❤️ '{fav}' als Favorit gespeichert.")
     else:
         await update.message.reply_text("❌ Ungültiger Index.")
@@ -4560,6 +5411,7 @@ async def fav_render_overview_in_place(update: Update, context: ContextTypes.DEF
         return
 
     # 1) neuen Text für die Favoritenliste bauen
+    await ensure_favorites_loaded(uid)
     txt = build_fav_overview_text_for(uid)
 
     # 2) Favoritenliste IN-PLACE editieren (bevorzugt)
@@ -4614,10 +5466,10 @@ async def fav_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Entry-Point für /meinefavoriten oder Button „Favoriten“."""
     msg = update.message or update.callback_query.message
     user_id = str(update.effective_user.id)
-    ensure_favorites_loaded(user_id)
+    await ensure_favorites_loaded(user_id)
     favs = favorites.get(user_id, [])
     # IDs aller Loop-Nachrichten sammeln
-    context.user_data["fav_msgs"] = []
+    clear_tracked(context, "fav_msgs")
 
     if not favs:
         warn = await msg.reply_text("Keine Favoriten vorhanden. Füge diese später hinzu!")
@@ -4646,7 +5498,7 @@ async def fav_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🔙 <b>Zurück</b> zum Hauptmenü",
         reply_markup=kb
     )
-    context.user_data["fav_msgs"].extend([m1.message_id, m2.message_id])
+    track_msg(context, "fav_msgs", m1.message_id, m2.message_id)
     context.user_data["fav_overview_ids"] = {"list": m1.message_id, "menu": m2.message_id}
     return FAV_OVERVIEW
 
@@ -4658,11 +5510,7 @@ async def fav_overview_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # „Nein“: alle gesammelten Loop-Nachrichten löschen & zurück ins Hauptmenü
     if q.data == "fav_edit_no":
-        for mid in context.user_data.get("fav_msgs", []):
-            try:
-                await context.bot.delete_message(chat_id=msg.chat.id, message_id=mid)
-            except:
-                pass
+        await purge_msgs(context, msg.chat.id, ["fav_msgs"])
     #    await send_main_buttons(msg)                    #ggf. einfügen, wenn man nochmals Buttons angezeigt bekommen möchte
         return ConversationHandler.END
 
@@ -4679,14 +5527,14 @@ async def fav_overview_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Welche Favoriten löschen?\n" +
             "\n".join(f"{i}. {d}" for i, d in enumerate(favs, start=1))
         )
-        context.user_data["fav_msgs"].append(list_msg.message_id)
+        track_msg(context, "fav_msgs", list_msg.message_id)
 
         # Keyboard senden + ID speichern
         sel_msg = await msg.reply_text(
             "Wähle Nummern (Mehrfachauswahl) und klicke »Fertig«:",
             reply_markup=build_fav_numbers_keyboard(len(favs), set())
         )
-        context.user_data["fav_msgs"].append(sel_msg.message_id)
+        track_msg(context, "fav_msgs", sel_msg.message_id)
 
         return FAV_DELETE_SELECT
 
@@ -4751,38 +5599,17 @@ async def fav_action_choice_cb(update: Update, context: ContextTypes.DEFAULT_TYP
     q = update.callback_query
     await q.answer()
     uid = str(q.from_user.id)
-    ensure_favorites_loaded(uid)
+    await ensure_favorites_loaded(uid)
     msg = q.message
 
     if q.data == "fav_action_back":
         chat_id = q.message.chat.id
 
-        # 1) Arbeits-UI (Listen/Keyboards der Unter-Loops) entfernen
-        for mid in context.user_data.get("fav_work_ids", []):
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-            except Exception:
-                pass
-        context.user_data["fav_work_ids"] = []
-
-        # 2) Die beiden Overview-Nachrichten (Liste + "Was möchtest Du machen?") zuverlässig entfernen
-        ids = context.user_data.get("fav_overview_ids") or {}
-        for key in ("list", "menu"):
-            mid = ids.get(key)
-            if mid:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-                except Exception:
-                    pass
-        context.user_data.pop("fav_overview_ids", None)
-
-        # 3) Fallback/Alt: evtl. noch in fav_msgs getrackte IDs auch säubern
-        for mid in context.user_data.get("fav_msgs", []):
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-            except Exception:
-                pass
-        context.user_data["fav_msgs"] = []
+        # 1-3) Arbeits-UI (Listen/Keyboards der Unter-Loops), die beiden Overview-
+        #      Nachrichten (Liste + "Was möchtest Du machen?") und evtl. noch in
+        #      fav_msgs getrackte IDs in einem Sammel-Löschen entfernen
+        ids = context.user_data.pop("fav_overview_ids", None) or {}
+        await purge_msgs(context, chat_id, ["fav_work_ids", "fav_msgs"], extra=[ids.get("list"), ids.get("menu")])
 
         # 4) Conversation beenden
         return ConversationHandler.END
@@ -4807,7 +5634,7 @@ async def fav_action_choice_cb(update: Update, context: ContextTypes.DEFAULT_TYP
             pad_message(text),
             reply_markup=build_fav_numbers_keyboard(total, set())
         )
-        context.user_data.setdefault("fav_work_ids", []).append(list_msg.message_id)
+        track_msg(context, "fav_work_ids", list_msg.message_id)
         return FAV_DELETE_SELECT
 
     if q.data == "fav_action_select":
@@ -4829,7 +5656,7 @@ async def fav_action_choice_cb(update: Update, context: ContextTypes.DEFAULT_TYP
             pad_message(text),
             reply_markup=build_fav_selection_keyboard(total, set())
         )
-        context.user_data.setdefault("fav_work_ids", []).append(list_msg.message_id)
+        track_msg(context, "fav_work_ids", list_msg.message_id)
         return FAV_ADD_SELECT
 
 
@@ -4844,14 +5671,10 @@ async def fav_selection_done_cb(update: Update, context: ContextTypes.DEFAULT_TY
 
     # Auswahl anhand der fortlaufenden Nummern auflösen
     selected = [idx_map[i] for i in sel if i in idx_map]
+    edit_debouncer.cancel(q.message)
 
     # Arbeitsnachrichten (Liste + Keyboard) wegräumen
-    for mid in context.user_data.get("fav_work_ids", []):
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-        except Exception:
-            pass
-    context.user_data["fav_work_ids"] = []
+    await purge_msgs(context, chat_id, ["fav_work_ids"])
     context.user_data.pop("fav_sel_sel", None)
     context.user_data.pop("fav_sel_index_map", None)
 
@@ -4878,7 +5701,7 @@ async def fav_del_number_toggle_cb(update: Update, context: ContextTypes.DEFAULT
     sel = context.user_data.setdefault("fav_del_sel", set())
     sel.symmetric_difference_update({idx})
     total = context.user_data["fav_total"]
-    await q.edit_message_reply_markup(build_fav_numbers_keyboard(total, sel))
+    edit_debouncer.schedule(q.message, lambda: q.edit_message_reply_markup(build_fav_numbers_keyboard(total, sel)))
     #return FAV_ADD_SELECT
     return FAV_DELETE_SELECT
 
@@ -4890,30 +5713,23 @@ async def fav_del_done_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = q.message.chat.id
 
     # Auswahl lesen (fortlaufende Nummern)
+    edit_debouncer.cancel(q.message)
     sel = sorted(context.user_data.get("fav_del_sel", set()))
     idx_map: dict[int, str] = context.user_data.get("fav_del_index_map", {}) or {}
 
-    ensure_favorites_loaded(uid)
-    favs = favorites.get(uid, [])[:]
+    await ensure_favorites_loaded(uid)
 
     # Welche Gerichte sollen entfernt werden?
     to_remove = {idx_map[i] for i in sel if i in idx_map}
 
     removed = 0
     if to_remove:
-        # Reihenfolge der übrigen Favoriten beibehalten
-        favs = [d for d in favs if d not in to_remove]
-        favorites[uid] = favs
-        store_set_favorites(user_key(int(uid)), favorites[uid])
+        # Ein Write (ArrayRemove bzw. ein DELETE), Reihenfolge der übrigen bleibt
+        await store_remove_favorites(user_key(int(uid)), list(to_remove))
         removed = len(to_remove)
 
     # Arbeitsnachrichten (Liste + Keyboard) entfernen
-    for mid in context.user_data.get("fav_work_ids", []):
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-        except Exception:
-            pass
-    context.user_data["fav_work_ids"] = []
+    await purge_msgs(context, chat_id, ["fav_work_ids"])
     context.user_data.pop("fav_del_sel", None)
     context.user_data.pop("fav_del_index_map", None)
 
@@ -4940,7 +5756,7 @@ async def fav_number_toggle_cb(update: Update, context: ContextTypes.DEFAULT_TYP
     sel = context.user_data.setdefault("fav_del_sel", set())
     sel.symmetric_difference_update({idx})
     total = context.user_data["fav_total"]
-    await q.edit_message_reply_markup(build_fav_numbers_keyboard(total, sel))
+    edit_debouncer.schedule(q.message, lambda: q.edit_message_reply_markup(build_fav_numbers_keyboard(total, sel)))
     return FAV_DELETE_SELECT
 
 def build_fav_selection_keyboard(total: int, selected: set[int]) -> InlineKeyboardMarkup:
@@ -4956,7 +5772,9 @@ async def fav_selection_toggle_cb(update: Update, context: ContextTypes.DEFAULT_
     sel = context.user_data.setdefault("fav_sel_sel", set())
     sel.symmetric_difference_update({idx})
     total = context.user_data.get("fav_total", 0)
-    await q.edit_message_reply_markup(reply_markup=build_fav_selection_keyboard(total, sel))
+    edit_debouncer.schedule(q.message, lambda: q.edit_message_reply_markup(
+        reply_markup=build_fav_selection_keyboard(total, sel)
+    ))
     return FAV_ADD_SELECT
 
 
@@ -4968,19 +5786,21 @@ async def fav_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await q.answer()
     msg = q.message
 
-    # Liste der Gerichte aus user_data holen
-    dishes = context.user_data.get("final_list", [])
+    # Liste der Gerichte aus der Endliste (Session) holen
+    uid, _ = await ensure_session_loaded_for_user_and_chat(update)
+    fl = get_final_list(uid)
+    dishes = fl.names() if fl else []
     if not dishes:
         await msg.edit_text("ℹ️ Keine Gerichte verfügbar.")
         return ConversationHandler.END
 
     # Auswahl initialisieren
     context.user_data["fav_add_sel"]  = set()
-    context.user_data["fav_add_msgs"] = []
+    clear_tracked(context, "fav_add_msgs")
 
     # bestehende Favoriten des Users
     user_id       = str(q.from_user.id)
-    ensure_favorites_loaded(user_id)
+    await ensure_favorites_loaded(user_id)
     existing_favs = set(favorites.get(user_id, []))
 
     header_text = pad_message(
@@ -4991,7 +5811,7 @@ async def fav_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Aktionsmenü in Kopfzeile + Buttons verwandeln (ersetzt)
     await msg.edit_text(header_text, reply_markup=kb)
-    context.user_data["fav_add_msgs"].append(msg.message_id)
+    track_msg(context, "fav_add_msgs", msg.message_id)
 
     return FAV_ADD_SELECT
 
@@ -5009,42 +5829,36 @@ async def fav_add_number_toggle_cb(update: Update, context: ContextTypes.DEFAULT
     else:
         sel.add(idx)
 
-    dishes = context.user_data.get("final_list", [])
-    user_id = str(q.from_user.id)
-    ensure_favorites_loaded(user_id)
+    user_id, _ = await ensure_session_loaded_for_user_and_chat(update)
+    fl = get_final_list(user_id)
+    dishes = fl.names() if fl else []
+    await ensure_favorites_loaded(user_id)
     existing_favs = set(favorites.get(user_id, []))
 
-    await q.edit_message_reply_markup(
+    edit_debouncer.schedule(q.message, lambda: q.edit_message_reply_markup(
         reply_markup=build_fav_add_keyboard_dishes(dishes, sel, existing_favs, max_len=35)
-    )
+    ))
     return FAV_ADD_SELECT
 
 
 async def fav_add_done_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
+    edit_debouncer.cancel(q.message)
     sel    = sorted(context.user_data.get("fav_add_sel", []))
-    dishes = context.user_data.get("final_list", [])
-    user_id = str(q.from_user.id)
+    user_id, _ = await ensure_session_loaded_for_user_and_chat(update)
+    fl = get_final_list(user_id)
+    dishes = fl.names() if fl else []
 
     # In Favoriten speichern
-    ensure_favorites_loaded(user_id)
+    await ensure_favorites_loaded(user_id)
+    neu = [dishes[i-1] for i in sel if 1 <= i <= len(dishes)]
+    await store_add_favorites(user_key(int(user_id)), neu)      # ein Write, kein Read
     favs = favorites.get(user_id, [])
-    for i in sel:
-        if 1 <= i <= len(dishes):
-            dish = dishes[i-1]
-            if dish not in favs:
-                favs.append(dish)
-    favorites[user_id] = favs
-    store_set_favorites(user_key(int(user_id)), favorites[user_id])
 
     # Alle Loop-Messages löschen
     msg = q.message
-    for mid in context.user_data.get("fav_add_msgs", []):
-        try:
-            await context.bot.delete_message(chat_id=msg.chat.id, message_id=mid)
-        except:
-            pass
+    await purge_msgs(context, msg.chat.id, ["fav_add_msgs"])
 
     # Favoriten-Übersicht senden
     txt = "⭐ Deine aktualisierte Favoritenliste:\n" + "\n".join(f"‣ {d}" for d in favs)
@@ -5067,18 +5881,100 @@ async def fav_add_done_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
-    ensure_favorites_loaded(user_id)
+    await ensure_favorites_loaded(user_id)
     favs = favorites.get(user_id, [])
     if not context.args or not context.args[0].isdigit():
         return await update.message.reply_text("❌ Nutzung: /delete 1")
     idx = int(context.args[0]) - 1
     if 0<=idx<len(favs):
-        rem = favs.pop(idx)
-        store_set_favorites(user_key(int(user_id)), favorites[user_id])
+        rem = favs[idx]
+        await store_remove_favorites(user_key(int(user_id)), [rem])
         await update.message.reply_text(f"🗑 Favorit '{rem}' gelöscht.")
     else:
         await update.message.reply_text("❌ Ungültiger Index.")
 
+async def build_vorrat_text(uid: str, eingabe: str) -> str:
+    """Antworttext für die Vorrat-Suche (HTML), Profil-Filter werden respektiert."""
+    have, unbekannt = vorrat_mask(eingabe)
+    if not have:
+        return "🤷 Keine der Zutaten kenne ich. Beispiel: /vorrat Tomaten Zwiebeln Reis"
+
+    await ensure_profile_loaded(uid)
+    allowed = set(apply_profile_filters(df_gerichte, profiles.get(uid))["Gericht"])
+    treffer = search_vorrat(have, allowed)
+    if not treffer:
+        return "🤷 Kein passendes Gericht gefunden."
+
+    lines = ["🧺 <b>Das geht mit deinem Vorrat:</b>", ""]
+    for i, (dish, vorhanden, total, fehlt) in enumerate(treffer, 1):
+        lines.append(f"{i}. <b>{escape(dish)}</b> – {vorhanden}/{total} Zutaten")
+        fehlend = zutaten_names(fehlt)
+        if fehlend:
+            lines.append(f"   fehlt: {escape(', '.join(fehlend))}")
+    if unbekannt:
+        lines += ["", f"<i>Nicht erkannt: {escape(', '.join(unbekannt))}</i>"]
+    return "\n".join(lines)
+
+async def vorrat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/vorrat Tomaten, Zwiebeln – welche Gerichte gehen mit dem, was da ist?"""
+    eingabe = " ".join(context.args or [])
+    if not eingabe.strip():
+        return await update.message.reply_text("❌ Nutzung: /vorrat Tomaten Zwiebeln Reis (mehrteilige Zutaten mit Komma trennen)")
+    uid = str(update.message.from_user.id)
+    await update.message.reply_text(await build_vorrat_text(uid, eingabe))
+
+async def webapp_data_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Nimmt JSON aus der Mini-App entgegen (aktuell: Feld 'vorrat')."""
+    try:
+        if not update.message or not update.message.web_app_data:
+            return
+        payload = json.loads(update.message.web_app_data.data)
+        eingabe = str(payload.get("vorrat") or "").strip()
+        if not eingabe:
+            return
+        uid = str(update.message.from_user.id)
+        await update.message.reply_text(await build_vorrat_text(uid, eingabe))
+    except Exception:
+        logging.exception("Mini-App-Daten konnten nicht verarbeitet werden")
+        await update.effective_message.reply_text("❌ Konnte Mini-App-Daten nicht verarbeiten. Bitte versuch es nochmal.")
+
+async def aisle_layout_for(uid: str, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Gewähltes Laden-Layout: Profil > user_data > Default."""
+    await ensure_profile_loaded(uid)
+    prof = profiles.get(uid) or {}
+    key = prof.get("aisle") or context.user_data.get("aisle") or AISLE_DEFAULT
+    return key if key in AISLE_LAYOUTS else AISLE_DEFAULT
+
+def build_aisle_keyboard(current: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"{'✅ ' if k == current else ''}{v['label']}", callback_data=f"aisle_{k}")]
+        for k, v in AISLE_LAYOUTS.items()
+    ])
+
+async def laden(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/laden – Sortierung der Einkaufsliste nach Laden-Layout wählen."""
+    uid = str(update.message.from_user.id)
+    cur = await aisle_layout_for(uid, context)
+    await update.message.reply_text(
+        "🏪 In welcher Reihenfolge soll die Einkaufsliste sortiert sein?",
+        reply_markup=build_aisle_keyboard(cur),
+    )
+
+async def laden_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    key = q.data[len("aisle_"):]
+    if key not in AISLE_LAYOUTS:
+        return
+    uid = str(q.from_user.id)
+    # Mit Profil → im Profil speichern (geräteübergreifend), sonst nur für diese Sitzung
+    if await ensure_profile_loaded(uid) and profiles.get(uid):
+        profiles[uid]["aisle"] = key
+        await store_set_profile(user_key(int(uid)), profiles[uid])
+    else:
+        context.user_data["aisle"] = key
+    await q.edit_message_text(f"🏪 Einkaufsliste wird jetzt so sortiert: {AISLE_LAYOUTS[key]['label']}")
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Fallback-Handler für /cancel: bricht den aktuellen Flow ab.
@@ -5100,7 +5996,7 @@ async def restart_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ##############################################
 
 async def rezept_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     if str(update.message.from_user.id) not in sessions:
         await update.message.reply_text("⚠️ Keine Menüs gewählt.")
         return ConversationHandler.END
@@ -5119,7 +6015,7 @@ async def rezept_index(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def rezept_personen(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_session_loaded_for_user_and_chat(update)
+    await ensure_session_loaded_for_user_and_chat(update)
     try:
         user_id = str(update.message.from_user.id)
         personen = int(update.message.text.strip())
@@ -5147,6 +6043,7 @@ async def rezept_personen(update: Update, context: ContextTypes.DEFAULT_TYPE):
         cache_key = f"{dish}|{personen}"
         if cache_key in recipe_cache:
             steps = recipe_cache[cache_key]
+            recipe_cache.move_to_end(cache_key)
         else:
             prompt = f"""Erstelle ein Rezept für '{dish}' für {personen} Personen:
 Zutaten:
@@ -5156,10 +6053,11 @@ Anleitung (kurz Schritt-für-Schritt):"""
             _client = _get_openai_client()
             if _client:
                 try:
-                    resp = _client.chat.completions.create(
-                        model=os.getenv("OPENAI_MODEL", "gpt-3.5-turbo"),
-                        messages=[{"role": "user", "content": prompt}],
-                    )
+                    with timed("openai", "chat"):
+                        resp = _client.chat.completions.create(
+                            model=os.getenv("OPENAI_MODEL", "gpt-3.5-turbo"),
+                            messages=[{"role": "user", "content": prompt}],
+                        )
                     steps = resp.choices[0].message.content.strip()
                 except Exception as e:
                     logging.warning("OpenAI-Fehler, nutze Fallback: %s", e)
@@ -5168,6 +6066,8 @@ Anleitung (kurz Schritt-für-Schritt):"""
                 steps = _fallback_steps(dish, zut_text)
 
             recipe_cache[cache_key] = steps
+            while len(recipe_cache) > RECIPE_CACHE_MAX:
+                recipe_cache.popitem(last=False)
             save_json(CACHE_FILE, recipe_cache)
 
         msg = (
@@ -5191,10 +6091,739 @@ Anleitung (kurz Schritt-für-Schritt):"""
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+# Webhook-Eingang: Update nur parsen + einreihen, sofort 200 an Telegram.
+# Abgearbeitet wird von PTBs Update-Fetcher (app.update_queue) über den
+# ChatLaneUpdateProcessor: pro Chat strikt der Reihe nach, über alle Chats
+# hinweg bis zu UPDATE_WORKERS parallel. Der Fetcher macht aus jedem Update
+# sofort einen Task – die Queue selbst bleibt also fast leer. Begrenzt wird
+# deshalb der gesamte Rückstau (Queue + wartende/laufende Updates im
+# Prozessor): ist er voll → 503 (Telegram stellt später erneut zu, statt dass
+# wir Updates stillschweigend verlieren).
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "1000"))
+UPDATE_WORKERS   = int(os.getenv("UPDATE_WORKERS", "8"))
+
+def _update_kind(update) -> str:
+    """Grobe Art des Updates für Trace-Logs (keine Nachrichtentexte loggen)."""
+    if not isinstance(update, Update):
+        return type(update).__name__
+    if update.callback_query:
+        return "callback:" + (update.callback_query.data or "")[:32]
+    msg = update.effective_message
+    if msg and msg.text and msg.text.startswith("/"):
+        return "command:" + msg.text.split()[0][:32]
+    if msg:
+        return "message"
+    return "other"
+
+class ChatLaneUpdateProcessor(BaseUpdateProcessor):
+    """
+    Update-Prozessor mit einer geordneten „Lane“ pro Chat:
+      - Updates desselben Chats laufen nacheinander (asyncio.Lock ist FIFO),
+        damit Callback-Folgen/ConversationHandler-States konsistent bleiben
+      - verschiedene Chats laufen parallel, gedeckelt durch max_workers
+      - gemessen wird die Wartezeit bis zum Start (Lane + globaler Slot)
+    PTBs eigene Semaphore lassen wir bewusst weit offen: sonst würden
+    wartende Updates eines langsamen Chats die globalen Slots blockieren.
+    Den Speicher begrenzt stattdessen `pending` (übergeben, noch nicht
+    fertig) – WebhookIntake lehnt ab, sobald der Rückstau voll ist.
+    """
+
+    _LANE_STATS_MAX = 500       # so viele Lanes behalten wir in den Kennzahlen
+
+    def __init__(self, max_workers: int):
+        super().__init__(max_concurrent_updates=max(UPDATE_QUEUE_MAX, max_workers))
+        self.max_workers = max_workers
+        self._slots = asyncio.Semaphore(max_workers)
+        self._lanes: dict[int, list] = {}          # chat_id → [Lock, Anzahl wartend/laufend]
+        self._lane_stats: OrderedDict[int, list] = OrderedDict()   # chat_id → [n, wait_sum, wait_max]
+        self.pending = 0                            # Updates in Lanes/PTB-Semaphore wartend oder laufend
+        self.processed = 0
+        self.wait_sum = self.wait_max = 0.0
+
+    @staticmethod
+    def _lane_of(update) -> int | None:
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def process_update(self, update, coroutine) -> None:
+        self.pending += 1
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            self.pending -= 1
+
+    async def do_process_update(self, update, coroutine) -> None:
+        lane_id = self._lane_of(update)
+        with trace_update(update_id=getattr(update, "update_id", None), chat_id=lane_id, kind=_update_kind(update)):
+            await self._run_in_lane(lane_id, coroutine)
+
+    async def _run_in_lane(self, lane_id, coroutine) -> None:
+        t0 = time.monotonic()
+        if lane_id is None:
+            async with self._slots:
+                self._record(None, time.monotonic() - t0)
+                await coroutine
+            return
+        lane = self._lanes.setdefault(lane_id, [asyncio.Lock(), 0])
+        lane[1] += 1
+        try:
+            async with lane[0]:
+                async with self._slots:
+                    self._record(lane_id, time.monotonic() - t0)
+                    await coroutine
+        finally:
+            lane[1] -= 1
+            if lane[1] == 0:
+                self._lanes.pop(lane_id, None)
+
+    def _record(self, lane_id, wait: float) -> None:
+        trace_record("lane_wait", wait)
+        LANE_WAIT_SECONDS.observe(wait, lane="chat" if lane_id is not None else "none")
+        self.processed += 1
+        self.wait_sum += wait
+        self.wait_max = max(self.wait_max, wait)
+        if lane_id is None:
+            return
+        st = self._lane_stats.pop(lane_id, None) or [0, 0.0, 0.0]
+        st[0] += 1
+        st[1] += wait
+        st[2] = max(st[2], wait)
+        self._lane_stats[lane_id] = st
+        if len(self._lane_stats) > self._LANE_STATS_MAX:
+            self._lane_stats.popitem(last=False)
+
+    def stats(self, top: int = 5) -> dict:
+        worst = sorted(self._lane_stats.items(), key=lambda kv: kv[1][2], reverse=True)[:top]
+        return {
+            "max_workers": self.max_workers,
+            "pending": self.pending,
+            "active_lanes": len(self._lanes),
+            "processed": self.processed,
+            "wait_ms_avg": round(self.wait_sum / self.processed * 1000, 1) if self.processed else None,
+            "wait_ms_max": round(self.wait_max * 1000, 1),
+            "lanes_worst_wait": [
+                {"chat": cid, "updates": n, "wait_ms_avg": round(ws / n * 1000, 1), "wait_ms_max": round(wm * 1000, 1)}
+                for cid, (n, ws, wm) in worst
+            ],
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# Telegram stellt bei langsamem Webhook dasselbe Update erneut zu. Gesehene
+# update_ids merken wir in einem Ringpuffer; optional zusätzlich im
+# Persistenz-Backend, damit auch eine andere Instanz das Duplikat erkennt.
+UPDATE_DEDUP_SIZE   = int(os.getenv("UPDATE_DEDUP_SIZE", "4096"))
+UPDATE_DEDUP_SHARED = os.getenv("UPDATE_DEDUP_SHARED", "0") == "1"
+UPDATE_DEDUP_TTL    = int(os.getenv("UPDATE_DEDUP_TTL", "3600"))
+
+class UpdateDeduplicator:
+    """
+    TypeHandler (group=-2, vor allen anderen): verwirft bereits gesehene
+    update_ids per ApplicationHandlerStop, noch bevor Prefetch oder
+    Conversation-Handler laufen. Ringpuffer (deque) + Set, beide begrenzt.
+    """
+
+    def __init__(self, size: int = UPDATE_DEDUP_SIZE, shared: bool = UPDATE_DEDUP_SHARED):
+        self.shared = shared
+        self._ring: deque[int] = deque()
+        self._seen: set[int] = set()
+        self._size = size
+        self.checked = self.dropped_local = self.dropped_shared = self.shared_errors = 0
+
+    def seen_before(self, update_id: int) -> bool:
+        """Lokal prüfen und merken (synchron → kein Rennen zwischen Tasks)."""
+        self.checked += 1
+        if update_id in self._seen:
+            self.dropped_local += 1
+            UPDATES_DROPPED.inc(scope="local")
+            return True
+        self._seen.add(update_id)
+        self._ring.append(update_id)
+        if len(self._ring) > self._size:
+            self._seen.discard(self._ring.popleft())
+        return False
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not isinstance(update, Update):
+            return
+        if self.seen_before(update.update_id):
+            raise ApplicationHandlerStop
+        if not self.shared:
+            return
+        try:
+            fresh = await store_claim_update(update.update_id, UPDATE_DEDUP_TTL)
+        except Exception as e:
+            # Backend weg → lieber doppelt verarbeiten als Updates verlieren
+            self.shared_errors += 1
+            logging.warning("Update-Dedup (shared) fehlgeschlagen: %s", e)
+            return
+        if not fresh:
+            self.dropped_shared += 1
+            UPDATES_DROPPED.inc(scope="shared")
+            raise ApplicationHandlerStop
+
+    def stats(self) -> dict:
+        return {
+            "checked": self.checked,
+            "dropped_local": self.dropped_local,
+            "dropped_shared": self.dropped_shared,
+            "shared": self.shared,
+            "shared_errors": self.shared_errors,
+            "tracked": len(self._ring),
+        }
+
+def update_backlog(app) -> int:
+    """Rückstau: Updates in der Queue + vom Prozessor übernommene, nicht fertige."""
+    return app.update_queue.qsize() + getattr(app.update_processor, "pending", 0)
+
+class WebhookIntake:
+    """Fast-Ack für den aiohttp-Webhook mit begrenztem Rückstau und Kennzahlen."""
+
+    _WARN_EVERY = 30.0          # Sekunden zwischen zwei „Rückstau fast voll“-Warnungen
+
+    def __init__(self, app):
+        self.app = app
+        self.enqueued = self.shed = self.bad_requests = 0
+        self.max_depth = 0
+        self._last_warn = 0.0
+
+    @property
+    def depth(self) -> int:
+        return update_backlog(self.app)
+
+    async def handle(self, request):
+        try:
+            data = await request.json()
+        except Exception:
+            self.bad_requests += 1
+            return web.Response(status=400, text="bad request")
+        if self.depth >= UPDATE_QUEUE_MAX:
+            self.shed += 1
+            return web.Response(status=503, text="busy")
+        try:
+            self.app.update_queue.put_nowait(Update.de_json(data, self.app.bot))
+        except asyncio.QueueFull:
+            self.shed += 1
+            return web.Response(status=503, text="busy")
+        self.enqueued += 1
+        depth = self.depth
+        self.max_depth = max(self.max_depth, depth)
+        if depth >= 0.8 * UPDATE_QUEUE_MAX and time.monotonic() - self._last_warn > self._WARN_EVERY:
+            self._last_warn = time.monotonic()
+            logging.warning("Update-Rückstau fast voll: %d/%d", depth, UPDATE_QUEUE_MAX)
+        return web.Response(text="OK")
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "queued": self.app.update_queue.qsize(),
+            "max_depth": self.max_depth,
+            "capacity": UPDATE_QUEUE_MAX,
+            "enqueued": self.enqueued,
+            "shed": self.shed,
+            "bad_requests": self.bad_requests,
+            "workers": UPDATE_WORKERS,
+        }
+
+    async def drain(self, timeout: float = 8.0) -> None:
+        """Beim Herunterfahren: warten, bis Queue und Worker leer sind (max. timeout)."""
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+# Ausgehende Bot-API-Requests: globales + pro-Chat-Limit, retry_after beachten.
+# Telegram erlaubt grob ~30 Nachrichten/s gesamt, ~1/s pro Chat und 20/min
+# in Gruppen. Aufräum-Löschungen laufen in der niedrigen Prioritätsklasse.
+TG_RATE_GLOBAL   = float(os.getenv("TG_RATE_GLOBAL", "30"))
+TG_RATE_CHAT     = float(os.getenv("TG_RATE_CHAT", "1"))
+TG_RATE_GROUP    = float(os.getenv("TG_RATE_GROUP_PER_MIN", "20")) / 60.0
+TG_RETRY_MAX     = int(os.getenv("TG_RETRY_MAX", "3"))
+
+PRIO_USER, PRIO_CLEANUP = 0, 1
+
+class _TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.stamp = burst, time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Sekunden bis zum nächsten freien Token (0 = sofort)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Rate-Limiter vor allen Bot-Requests (ApplicationBuilder.rate_limiter):
+      - Token-Bucket global + pro Chat (Gruppen strenger als Privatchats)
+      - zwei Klassen: PRIO_USER (Senden/Editieren) vor PRIO_CLEANUP (Löschen);
+        Aufräumen bekommt globale Tokens nur, wenn kein Nutzer-Request wartet
+      - RetryAfter (429): alle Requests pausieren, dann bis TG_RETRY_MAX erneut
+    Über rate_limit_args=PRIO_CLEANUP/PRIO_USER lässt sich die Klasse pro
+    Aufruf überschreiben.
+    """
+
+    _CLEANUP_ENDPOINTS = frozenset({"deleteMessage", "deleteMessages"})
+    # Kein Nachrichtenversand → zählt nicht gegen die Limits
+    _UNLIMITED = frozenset({"getUpdates", "getMe", "setWebhook", "deleteWebhook",
+                            "getWebhookInfo", "answerCallbackQuery", "getFile"})
+    _CHAT_BUCKETS_MAX = 10000
+
+    def __init__(self, per_sec: float = TG_RATE_GLOBAL, chat_per_sec: float = TG_RATE_CHAT,
+                 group_per_sec: float = TG_RATE_GROUP, max_retries: int = TG_RETRY_MAX):
+        self._global = _TokenBucket(per_sec, per_sec)
+        self._chat_rate, self._group_rate = chat_per_sec, group_per_sec
+        self._chats: OrderedDict[int, _TokenBucket] = OrderedDict()
+        self._queues = (deque(), deque())   # je Klasse: auf globales Token wartend (FIFO)
+        self._paused_until = 0.0
+        self.max_retries = max_retries
+        self.requests = [0, 0]
+        self.delayed = [0, 0]
+        self.wait_max = [0.0, 0.0]
+        self.retry_after_hits = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: int) -> _TokenBucket:
+        b = self._chats.pop(chat_id, None)
+        if b is None:
+            rate = self._group_rate if chat_id < 0 else self._chat_rate
+            b = _TokenBucket(rate, max(1.0, 3 * rate))       # kleiner Burst erlaubt
+        self._chats[chat_id] = b
+        if len(self._chats) > self._CHAT_BUCKETS_MAX:
+            self._chats.popitem(last=False)
+        return b
+
+    async def _acquire(self, prio: int, chat_id: int | None) -> None:
+        t0 = time.monotonic()
+        # 1) pro Chat (nur Nutzer-Requests; Löschen ist dort nicht gedrosselt)
+        if chat_id is not None and prio == PRIO_USER:
+            bucket = self._chat_bucket(chat_id)
+            while (d := bucket.delay(time.monotonic())) > 0:
+                await asyncio.sleep(d)
+            bucket.take()
+        # 2) global: höhere Klasse zuerst, innerhalb der Klasse in Ankunftsreihenfolge
+        ticket, queue = object(), self._queues[prio]
+        queue.append(ticket)
+        try:
+            while True:
+                now = time.monotonic()
+                d = self._paused_until - now
+                if d <= 0 and (queue[0] is not ticket or any(self._queues[:prio])):
+                    d = 0.01                       # Vortritt für Vordermann / Nutzer-Requests
+                if d <= 0:
+                    d = self._global.delay(now)
+                if d <= 0:
+                    self._global.take()
+                    break
+                await asyncio.sleep(d)
+        finally:
+            queue.remove(ticket)
+        waited = time.monotonic() - t0
+        label = "user" if prio == PRIO_USER else "cleanup"
+        RATE_LIMIT_WAIT_SECONDS.observe(waited, prio=label)
+        if waited > 0.001:
+            trace_record("telegram.ratelimit_wait", waited)
+            RATE_LIMIT_DELAYED.inc(prio=label)
+            self.delayed[prio] += 1
+            self.wait_max[prio] = max(self.wait_max[prio], waited)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in self._UNLIMITED:
+            if endpoint == "getUpdates":               # Long-Polling → keine sinnvolle Latenz
+                return await callback(*args, **kwargs)
+            with timed("telegram", endpoint):
+                return await callback(*args, **kwargs)
+        if rate_limit_args in (PRIO_USER, PRIO_CLEANUP):
+            prio = rate_limit_args
+        else:
+            prio = PRIO_CLEANUP if endpoint in self._CLEANUP_ENDPOINTS else PRIO_USER
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id) if chat_id is not None else None
+        except (TypeError, ValueError):
+            chat_id = None                         # @kanalname → nur globales Limit
+        self.requests[prio] += 1
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(prio, chat_id)
+            try:
+                with timed("telegram", endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after_hits += 1
+                RATE_LIMIT_RETRY_AFTER.inc(endpoint=endpoint)
+                if attempt == self.max_retries:
+                    logging.warning("429 für %s nach %d Versuchen – gebe auf", endpoint, attempt + 1)
+                    raise
+                ra = e.retry_after
+                secs = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+                # Telegram drosselt den ganzen Bot → alle Requests pausieren
+                self._paused_until = max(self._paused_until, time.monotonic() + secs + 0.1)
+                logging.info("429 für %s: pausiere %.1fs (Versuch %d)", endpoint, secs, attempt + 1)
+
+    def stats(self) -> dict:
+        return {
+            "requests": {"user": self.requests[PRIO_USER], "cleanup": self.requests[PRIO_CLEANUP]},
+            "delayed": {"user": self.delayed[PRIO_USER], "cleanup": self.delayed[PRIO_CLEANUP]},
+            "wait_ms_max": {"user": round(self.wait_max[PRIO_USER] * 1000, 1),
+                            "cleanup": round(self.wait_max[PRIO_CLEANUP] * 1000, 1)},
+            "retry_after": self.retry_after_hits,
+            "chat_buckets": len(self._chats),
+        }
+
+# HTTP-Transport für Telegram: eigener Pool für normale Bot-Calls (Größe an
+# die Worker gekoppelt – Lösch-Batches und Edit-Bursts laufen parallel) und
+# ein kleiner getrennter Pool für getUpdates. Timeouts wie HTTPX_CLIENT.
+TG_POOL_SIZE     = int(os.getenv("TG_POOL_SIZE", str(max(16, UPDATE_WORKERS * 4))))
+TG_KEEPALIVE_S   = float(os.getenv("TG_KEEPALIVE_S", "30"))
+TG_HTTP2         = os.getenv("TG_HTTP2", "0") == "1"          # braucht das Paket h2 (httpx[http2])
+
+class TunedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest mit Keep-Alive-Limits, optional HTTP/2 und Pool-Kennzahlen."""
+
+    def __init__(self, name: str, pool_size: int, *, http2: bool = False, **kwargs):
+        self.name = name
+        self.pool_size = pool_size
+        if http2 and importlib.util.find_spec("h2") is None:
+            logging.warning("TG_HTTP2=1, aber h2 fehlt (pip install 'httpx[http2]') → HTTP/1.1")
+            http2 = False
+        self.requests = self.inflight = self.peak_inflight = self.pool_timeouts = 0
+        super().__init__(
+            connection_pool_size=pool_size,
+            connect_timeout=HTTPX_TIMEOUT.connect,
+            read_timeout=HTTPX_TIMEOUT.read,
+            write_timeout=HTTPX_TIMEOUT.write,
+            pool_timeout=HTTPX_TIMEOUT.pool,
+            http_version="2" if http2 else "1.1",
+            httpx_kwargs={"limits": httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=TG_KEEPALIVE_S,
+            )},
+            **kwargs,
+        )
+
+    async def do_request(self, *args, **kwargs):
+        self.requests += 1
+        self.inflight += 1
+        self.peak_inflight = max(self.peak_inflight, self.inflight)
+        try:
+            return await super().do_request(*args, **kwargs)
+        except TimedOut as e:
+            if "pool" in str(e).lower():
+                self.pool_timeouts += 1     # alle Verbindungen belegt → Pool zu klein
+            raise
+        finally:
+            self.inflight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "size": self.pool_size,
+            "http": self.http_version,
+            "requests": self.requests,
+            "inflight": self.inflight,
+            "peak_inflight": self.peak_inflight,
+            "pool_timeouts": self.pool_timeouts,
+            # mehr Requests unterwegs als Verbindungen → der Rest wartet auf den Pool
+            "queued": max(0, self.inflight - self.pool_size),
+        }
+
+# Render-Cache: Hash des zuletzt gesendeten Texts/Keyboards pro Nachricht.
+# Ein Edit mit identischem Inhalt wird lokal übersprungen, statt Telegram mit
+# „Message is not modified“ antworten zu lassen.
+RENDER_CACHE_MAX = int(os.getenv("RENDER_CACHE_MAX", "5000"))
+# Höchstalter eines Eintrags: Edits anderer Instanzen sieht der Cache nicht,
+# ein alter Hash darf einen echten Edit also nur kurz unterdrücken.
+RENDER_CACHE_MAX_AGE_S = float(os.getenv("RENDER_CACHE_MAX_AGE_S", "30"))
+
+def _render_hash(*parts) -> bytes:
+    h = hashlib.blake2b(digest_size=12)
+    for p in parts:
+        p = getattr(p, "value", p)                  # DefaultValue/Enum → eigentlicher Wert
+        if hasattr(p, "to_json"):
+            p = p.to_json()
+        elif isinstance(p, (list, tuple)):
+            p = [x.to_json() if hasattr(x, "to_json") else x for x in p]
+        h.update(repr(p).encode("utf-8"))
+        h.update(b"\x00")
+    return h.digest()
+
+class RenderGuardBot(ExtBot):
+    """
+    ExtBot, der sich pro (chat, message) den Hash von Text und Keyboard merkt
+    (aus send_message und erfolgreichen Edits). edit_message_text und
+    edit_message_reply_markup mit unverändertem Inhalt gehen nicht raus;
+    zurück kommt die zuletzt gelieferte Message. Gilt für alle Edit-Wege
+    (bot.edit_*, Message.edit_*, CallbackQuery.edit_message_*).
+    Der Cache ist pro Instanz; Inline-Nachrichten werden nicht gecacht.
+    Andere Edits (Caption, Media, Live-Location, stop_poll) und Löschen
+    verwerfen den Eintrag; nach RENDER_CACHE_MAX_AGE_S wird ihm nicht mehr
+    vertraut (Edits von anderen Instanzen).
+    """
+
+    def __init__(self, *args, **kwargs):
+        # Unterstrich-Attribute: TelegramObject friert sonst nach __init__ ein
+        self._renders: OrderedDict[tuple[int, int], list] = OrderedDict()   # → [text_hash, markup_hash, Message, ts]
+        self._edits_sent = self._edits_skipped = 0
+        super().__init__(*args, **kwargs)
+
+    @staticmethod
+    def _render_key(chat_id, message_id):
+        try:
+            return (int(chat_id), int(message_id))
+        except (TypeError, ValueError):
+            return None
+
+    def _remember(self, key, text_hash, markup_hash, msg) -> None:
+        self._renders.pop(key, None)
+        self._renders[key] = [text_hash, markup_hash, msg, time.monotonic()]
+        if len(self._renders) > RENDER_CACHE_MAX:
+            self._renders.popitem(last=False)
+
+    def _unchanged(self, key, text_hash, markup_hash):
+        hit = self._renders.get(key) if key else None
+        if hit and time.monotonic() - hit[3] > RENDER_CACHE_MAX_AGE_S:
+            self._renders.pop(key, None)
+            return None
+        if hit and (text_hash is None or hit[0] == text_hash) and hit[1] == markup_hash:
+            self._renders.move_to_end(key)
+            self._edits_skipped += 1
+            return hit[2]
+        return None
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        msg = await super().send_message(chat_id, text, *args, **kwargs)
+        if not args and isinstance(msg, Message):
+            self._remember(
+                (msg.chat_id, msg.message_id),
+                _render_hash(text, kwargs.get("parse_mode"), kwargs.get("entities")),
+                _render_hash(kwargs.get("reply_markup")),
+                msg,
+            )
+        return msg
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, inline_message_id=None, *args, **kwargs):
+        key = None if (args or inline_message_id) else self._render_key(chat_id, message_id)
+        th = _render_hash(text, kwargs.get("parse_mode"), kwargs.get("entities"))
+        mh = _render_hash(kwargs.get("reply_markup"))       # ohne reply_markup entfernt Telegram das Keyboard
+        cached = self._unchanged(key, th, mh)
+        if cached is not None:
+            return cached
+        self._edits_sent += 1
+        try:
+            res = await super().edit_message_text(text, chat_id, message_id, inline_message_id, *args, **kwargs)
+        except Exception:
+            if key:
+                self._renders.pop(key, None)
+            raise
+        if key and isinstance(res, Message):
+            self._remember(key, th, mh, res)
+        return res
+
+    async def edit_message_reply_markup(self, chat_id=None, message_id=None, inline_message_id=None, *args, **kwargs):
+        key = None if (args or inline_message_id) else self._render_key(chat_id, message_id)
+        mh = _render_hash(kwargs.get("reply_markup"))
+        cached = self._unchanged(key, None, mh)
+        if cached is not None:
+            return cached
+        self._edits_sent += 1
+        try:
+            res = await super().edit_message_reply_markup(chat_id, message_id, inline_message_id, *args, **kwargs)
+        except Exception:
+            if key:
+                self._renders.pop(key, None)
+            raise
+        if key and isinstance(res, Message):
+            prev = self._renders.get(key)
+            self._remember(key, prev[0] if prev else None, mh, res)
+        return res
+
+    def _forget(self, chat_id, message_id) -> None:
+        key = self._render_key(chat_id, message_id)
+        if key:
+            self._renders.pop(key, None)
+
+    # Edits, die der Cache nicht abbildet → Eintrag verwerfen
+    async def edit_message_caption(self, chat_id=None, message_id=None, *args, **kwargs):
+        self._forget(chat_id, message_id)
+        return await super().edit_message_caption(chat_id, message_id, *args, **kwargs)
+
+    async def edit_message_media(self, media, chat_id=None, message_id=None, *args, **kwargs):
+        self._forget(chat_id, message_id)
+        return await super().edit_message_media(media, chat_id, message_id, *args, **kwargs)
+
+    async def edit_message_live_location(self, chat_id=None, message_id=None, *args, **kwargs):
+        self._forget(chat_id, message_id)
+        return await super().edit_message_live_location(chat_id, message_id, *args, **kwargs)
+
+    async def stop_message_live_location(self, chat_id=None, message_id=None, *args, **kwargs):
+        self._forget(chat_id, message_id)
+        return await super().stop_message_live_location(chat_id, message_id, *args, **kwargs)
+
+    async def stop_poll(self, chat_id, message_id, *args, **kwargs):
+        self._forget(chat_id, message_id)
+        return await super().stop_poll(chat_id, message_id, *args, **kwargs)
+
+    async def delete_message(self, chat_id, message_id, *args, **kwargs):
+        self._forget(chat_id, message_id)
+        return await super().delete_message(chat_id, message_id, *args, **kwargs)
+
+    async def delete_messages(self, chat_id, message_ids, *args, **kwargs):
+        for mid in message_ids:
+            self._renders.pop(self._render_key(chat_id, mid), None)
+        return await super().delete_messages(chat_id, message_ids, *args, **kwargs)
+
+    def render_stats(self) -> dict:
+        return {"edits_sent": self._edits_sent, "edits_skipped": self._edits_skipped, "tracked": len(self._renders)}
+
+def _handler_label(handler) -> str:
+    """Callback-Pattern / Befehl / Callback-Name als Metrik-Label."""
+    if isinstance(handler, CommandHandler):
+        return "/" + ",".join(sorted(handler.commands))
+    pattern = getattr(handler, "pattern", None)
+    if pattern is not None:
+        return getattr(pattern, "pattern", None) or getattr(pattern, "__name__", None) or str(pattern)
+    return getattr(handler.callback, "__name__", type(handler).__name__)
+
+def _timed_callback(callback, conversation: str, state: str, pattern: str):
+    span_name = f"handler:{conversation}/{state}/{getattr(callback, '__name__', pattern)}"
+
+    @functools.wraps(callback)
+    async def _wrapped(update, context):
+        t0 = time.perf_counter()
+        status = "ok"
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise                                   # Steuerfluss, kein Fehler
+        except Exception as e:
+            status = "error"
+            trace_mark_error(f"{span_name}: {type(e).__name__}")
+            raise
+        finally:
+            dt = time.perf_counter() - t0
+            HANDLER_SECONDS.observe(dt, conversation=conversation, state=state, pattern=pattern, status=status)
+            trace_record(span_name, dt)
+    return _wrapped
+
+def _flush_on_end(callback):
+    """Endet eine Konversation (END), wird der Session-Puffer des Chats sofort geschrieben."""
+    @functools.wraps(callback)
+    async def _wrapped(update, context):
+        result = await callback(update, context)
+        if result == ConversationHandler.END and isinstance(update, Update) and update.effective_chat:
+            await flush_session(update)
+        return result
+    return _wrapped
+
+def instrument_handlers(app) -> int:
+    """
+    Hängt an jeden registrierten Handler (auch in ConversationHandlern:
+    entry_points, states, fallbacks) eine Laufzeitmessung. Handler-Objekte,
+    die in mehreren Conversations stecken (cancel/reset), bekommen
+    conversation="shared". Jeder Handler, der END zurückgibt, schreibt
+    danach den Session-Puffer (Write-Behind) des Chats.
+    Rückgabe: Anzahl instrumentierter Handler.
+    """
+    places: list[tuple] = []
+
+    def _walk(handler, conversation: str, state: str) -> None:
+        if isinstance(handler, ConversationHandler):
+            name = handler.name or "conversation"
+            for h in handler.entry_points:
+                _walk(h, name, "entry")
+            for st, hs in handler.states.items():
+                for h in hs:
+                    _walk(h, name, STATE_NAMES.get(st, str(st)))
+            for h in handler.fallbacks:
+                _walk(h, name, "fallback")
+        elif getattr(handler, "callback", None) is not None:
+            places.append((handler, conversation, state))
+
+    for group in app.handlers.values():
+        for h in group:
+            _walk(h, "-", "-")
+
+    uses = Counter(id(h) for h, _, _ in places)
+    done = set()
+    for h, conversation, state in places:
+        if id(h) in done:
+            continue
+        done.add(id(h))
+        if uses[id(h)] > 1:
+            conversation, state = "shared", "-"
+        h.callback = _timed_callback(_flush_on_end(h.callback), conversation, state, _handler_label(h))
+    return len(done)
+
+def register_metric_sources(app, dedup, tg_requests) -> None:
+    QUEUE_DEPTH.source(lambda: update_backlog(app))
+    HTTP_POOL.source(lambda: {
+        (req.name, k): v
+        for req in tg_requests
+        for k, v in req.stats().items() if k not in ("size", "http")
+    })
+    STORE_SIZE.source(lambda: {
+        **{f"persistence_{ns}": n for ns, n in store_cache_sizes().items()},
+        "chat_of": len(_CHAT_OF),
+        "recipe_cache": len(recipe_cache),
+        "render_cache": len(app.bot._renders),
+        "edit_debounce_pending": len(edit_debouncer._pending),
+        "update_dedup": dedup.stats()["tracked"],
+        "chat_lanes": app.update_processor.stats(top=0)["active_lanes"],
+    })
+
 def main():
     print("BUILD_MARK = FIX_WEBHOOK_", __import__("datetime").datetime.utcnow().isoformat())
-    app = ApplicationBuilder().token(TOKEN).defaults(Defaults(parse_mode=ParseMode.HTML, disable_web_page_preview=True)).build()
+    # Referenzen behalten: Pool-Kennzahlen kommen aus den eigenen Zählern
+    tg_requests = (
+        TunedHTTPXRequest("bot", TG_POOL_SIZE, http2=TG_HTTP2),
+        TunedHTTPXRequest("get_updates", 1),
+    )
+    bot = RenderGuardBot(
+        token=TOKEN,
+        defaults=Defaults(parse_mode=ParseMode.HTML, disable_web_page_preview=True),
+        rate_limiter=PriorityRateLimiter(),
+        request=tg_requests[0],
+        get_updates_request=tg_requests[1],
+    )
+    builder = (
+        ApplicationBuilder()
+        .bot(bot)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_MAX))
+        .concurrent_updates(ChatLaneUpdateProcessor(UPDATE_WORKERS))
+    )
+    if PTB_PERSISTENCE:
+        # Conversation-States + user_data überleben Neustarts/Scale-out
+        builder = builder.persistence(StorePersistence(
+            update_interval=float(os.getenv("PTB_PERSIST_INTERVAL", "5")),
+        ))
+    app = builder.build()
     
+    # Doppelt zugestellte Updates verwerfen, bevor irgendein Handler läuft
+    dedup = UpdateDeduplicator()
+    app.add_handler(TypeHandler(Update, dedup), group=-2)
+
+    # user_id → chat_id merken + Nutzerzustand in den Cache holen (vor allen anderen Handlern)
+    app.add_handler(TypeHandler(Update, prefetch_user_state), group=-1)
+
     # --- GLOBAL PRIORITY HANDLERS (immer zuerst) ---
     # Übersicht-Button "🔄 Restart" (Callback-Flow):
     app.add_handler(CallbackQueryHandler(restart_start_ov,   pattern="^restart_ov$",                        block=True), group=0)
@@ -5222,6 +6851,11 @@ def main():
     app.add_handler(CommandHandler("favorit", favorit))
     #app.add_handler(CommandHandler("meinefavoriten", meinefavoriten))
     app.add_handler(CommandHandler("delete", delete))
+    app.add_handler(CommandHandler("vorrat", vorrat))
+    app.add_handler(CommandHandler("plaene", plaene))
+    app.add_handler(CommandHandler("laden", laden))
+    app.add_handler(CallbackQueryHandler(laden_cb, pattern=r"^aisle_[a-z]+$"))
+    app.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, webapp_data_handler))
 
 
     #### ---- MENU-Conversation ----
@@ -5262,6 +6896,7 @@ def main():
                         CallbackQueryHandler(fav_add_start,   pattern="^favoriten$"),
                         CallbackQueryHandler(export_to_bring, pattern="^export_bring$"),
                         CallbackQueryHandler(export_to_pdf,   pattern="^export_pdf$"),
+                        CallbackQueryHandler(plan_pin_cb,     pattern="^plan_pin$"),
                         CallbackQueryHandler(restart_start,           pattern="^restart$"),
             ],
             RESTART_CONFIRM: [
@@ -5277,7 +6912,9 @@ def main():
             
         },
         fallbacks=[cancel_handler, reset_handler],
-        allow_reentry=True
+        allow_reentry=True,
+        name="menu",
+        persistent=PTB_PERSISTENCE,
     ))
 
     #### ---- Globale Handler ----
@@ -5288,6 +6925,8 @@ def main():
     app.add_handler(CallbackQueryHandler(fav_add_start,    pattern="^favoriten$"))
     app.add_handler(CallbackQueryHandler(export_to_bring,  pattern="^export_bring$"))
     app.add_handler(CallbackQueryHandler(export_to_pdf,    pattern="^export_pdf$"))
+    app.add_handler(CallbackQueryHandler(plan_pin_cb,      pattern="^plan_pin$"))
+    app.add_handler(CallbackQueryHandler(plan_clear_cb,    pattern="^plan_clear$"))
     app.add_handler(CallbackQueryHandler(process_pdf_export_choice, pattern="^pdf_export_"))
     app.add_handler(CallbackQueryHandler(restart_start,    pattern="^restart$"))
     app.add_handler(CallbackQueryHandler(restart_start_ov, pattern="^restart_ov$"))
@@ -5314,7 +6953,9 @@ def main():
         },
 
         fallbacks=[cancel_handler, reset_handler],
-        allow_reentry=True
+        allow_reentry=True,
+        name="quickone",
+        persistent=PTB_PERSISTENCE,
     ))
 
 
@@ -5353,7 +6994,9 @@ def main():
 
         },
         fallbacks=[],
-        allow_reentry=True
+        allow_reentry=True,
+        name="favoriten",
+        persistent=PTB_PERSISTENCE,
     ))
 
 
@@ -5368,12 +7011,18 @@ def main():
             REZEPT_PERSONEN: [MessageHandler(filters.TEXT & ~filters.COMMAND, rezept_personen)],
         },
         fallbacks=[cancel_handler, reset_handler],
-        allow_reentry=True
+        allow_reentry=True,
+        name="rezept",
+        persistent=PTB_PERSISTENCE,
     ))
 
 
 
 
+    # Laufzeit je Handler + Gauges für /metrics
+    logging.info("Metriken: %d Handler instrumentiert", instrument_handlers(app))
+    register_metric_sources(app, dedup, tg_requests)
+
     # (Cloud Run start moved into main())
 
 
@@ -5386,12 +7035,18 @@ def main():
     async def _health_route(_request):
         return web.Response(text="OK")  # 200
 
-    async def _telegram_webhook(request):
-        # Telegram schickt POST JSON; an PTB weiterreichen
-        data = await request.json()
-        update = Update.de_json(data, app.bot)
-        await app.process_update(update)
-        return web.Response(text="OK")
+    async def _metrics_route(request):
+        if METRICS_TOKEN:
+            # nur Header – ein ?token= landet in Access-Logs
+            auth = request.headers.get("Authorization", "")
+            given = auth[7:] if auth.startswith("Bearer ") else ""
+            if not hmac.compare_digest(given.encode(), METRICS_TOKEN.encode()):
+                return web.Response(status=403, text="forbidden")
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    # Telegram schickt POST JSON → einreihen und sofort bestätigen
+    intake = WebhookIntake(app)
+    _telegram_webhook = intake.handle
 
     path = "/" + url_path.lstrip("/")
 
@@ -5406,6 +7061,10 @@ def main():
         aio = web.Application()
         aio.router.add_get("/", _health_route)
         aio.router.add_get("/webhook/health", _health_route)
+        if METRICS_TOKEN:
+            aio.router.add_get("/metrics", _metrics_route)
+        else:
+            logging.warning("METRICS_TOKEN nicht gesetzt → /metrics auf Cloud Run deaktiviert")
         aio.router.add_post(path, _telegram_webhook)
 
         async def _on_startup(_app):
@@ -5424,8 +7083,23 @@ def main():
 
 
         async def _on_cleanup(_app):
+            await intake.drain()
+            logging.info("Update-Queue: %s", intake.stats())
+            logging.info("Chat-Lanes: %s", app.update_processor.stats())
+            logging.info("Update-Dedup: %s", dedup.stats())
+            logging.info("Rate-Limiter: %s", app.bot.rate_limiter.stats())
+            logging.info("Edit-Debounce: %s", edit_debouncer.stats())
+            logging.info("Render-Cache: %s", app.bot.render_stats())
+            logging.info("Tracing: %s", trace_stats())
+            logging.info("HTTP-Pools: %s", {r.name: r.stats() for r in tg_requests})
             await app.stop()
             await app.shutdown()
+            try:
+                await store_flush_sessions()
+                logging.info("Session-Write-Behind: %s", store_session_write_stats())
+                logging.info("Persistenz-Cache: %s", store_cache_stats())
+            except Exception:
+                pass
             try:
                 await HTTPX_CLIENT.aclose()
             except Exception:
@@ -5442,6 +7116,7 @@ def main():
 
         aio = web.Application()
         aio.router.add_get("/webhook/health", _health_route)
+        aio.router.add_get("/metrics", _metrics_route)
         aio.router.add_post(path, _telegram_webhook)
 
         async def _on_startup(_app):
@@ -5454,8 +7129,23 @@ def main():
             await app.start()
 
         async def _on_cleanup(_app):
+            await intake.drain()
+            logging.info("Update-Queue: %s", intake.stats())
+            logging.info("Chat-Lanes: %s", app.update_processor.stats())
+            logging.info("Update-Dedup: %s", dedup.stats())
+            logging.info("Rate-Limiter: %s", app.bot.rate_limiter.stats())
+            logging.info("Edit-Debounce: %s", edit_debouncer.stats())
+            logging.info("Render-Cache: %s", app.bot.render_stats())
+            logging.info("Tracing: %s", trace_stats())
+            logging.info("HTTP-Pools: %s", {r.name: r.stats() for r in tg_requests})
             await app.stop()
             await app.shutdown()
+            try:
+                await store_flush_sessions()
+                logging.info("Session-Write-Behind: %s", store_session_write_stats())
+                logging.info("Persistenz-Cache: %s", store_cache_stats())
+            except Exception:
+                pass
             try:
                 await HTTPX_CLIENT.aclose()
             except Exception:
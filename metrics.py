@@ -0,0 +1,212 @@
+# metrics.py
+# Schlanke Metrik-Registry (Counter, Gauge, Histogram) mit Ausgabe im
+# Prometheus-Textformat – ohne zusätzliche Abhängigkeit.
+#
+#   from metrics import HANDLER_SECONDS, timed, render
+#   with timed("sheets", "gerichte"):
+#       ...
+#   aio.router.add_get("/metrics", ...)  → render()
+
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import tracing
+
+# Latenz-Buckets in Sekunden: Telegram/Firestore liegen typ. bei 50–500 ms,
+# OpenAI/Sheets im Sekundenbereich.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_LOCK = threading.Lock()          # Write-Behind-Thread schreibt ebenfalls Metriken
+_REGISTRY: List["_Metric"] = []
+
+
+def _esc(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_esc(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _fmt_num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = ()):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        with _LOCK:
+            _REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+    def lines(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        k = self._key(labels)
+        with _LOCK:
+            self._values[k] = self._values.get(k, 0) + amount
+
+    def lines(self) -> List[str]:
+        with _LOCK:
+            items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_num(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Wert wird beim Abruf über eine Callback-Funktion gelesen (kein Buchhalten)."""
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = ()):
+        super().__init__(name, doc, labels)
+        self._sources: List[Callable[[], object]] = []
+
+    def source(self, fn: Callable[[], object]) -> None:
+        """fn() → Zahl, oder bei Labels ein Dict {label-Tupel bzw. -Wert: Zahl}."""
+        self._sources.append(fn)
+
+    def lines(self) -> List[str]:
+        out = self._header()
+        for fn in self._sources:
+            try:
+                val = fn()
+            except Exception:
+                continue                    # eine kaputte Quelle soll /metrics nicht sprengen
+            if isinstance(val, dict):
+                for k, v in sorted(val.items(), key=lambda kv: str(kv[0])):
+                    k = k if isinstance(k, tuple) else (k,)
+                    out.append(f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_num(v)}")
+            elif val is not None:
+                out.append(f"{self.name} {_fmt_num(val)}")
+        return out
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, list] = {}          # key → [counts je Bucket, sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        k = self._key(labels)
+        with _LOCK:
+            s = self._series.get(k)
+            if s is None:
+                s = self._series[k] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s[0][i] += 1
+                    break
+            s[1] += value
+            s[2] += 1
+
+    def lines(self) -> List[str]:
+        with _LOCK:
+            items = sorted((k, [list(s[0]), s[1], s[2]]) for k, s in self._series.items())
+        out = self._header()
+        for k, (counts, total, n) in items:
+            acc = 0
+            for b, c in zip(self.buckets, counts):
+                acc += c
+                le = 'le="%s"' % _fmt_num(b)
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le)} {acc}")
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le)} {n}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {_fmt_num(total)}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {n}")
+        return out
+
+
+def render() -> str:
+    """Alle Metriken im Prometheus-Textformat (text/plain; version=0.0.4)."""
+    with _LOCK:
+        metrics = list(_REGISTRY)
+    lines: List[str] = []
+    for m in metrics:
+        lines.extend(m.lines())
+    return "\n".join(lines) + "\n"
+
+
+# ---------------------------------------------------------------------------
+# Gemeinsame Metriken des Bots
+# ---------------------------------------------------------------------------
+
+HANDLER_SECONDS = Histogram(
+    "foodbot_handler_seconds", "Laufzeit der PTB-Handler",
+    ("conversation", "state", "pattern", "status"),
+)
+EXTERNAL_SECONDS = Histogram(
+    "foodbot_external_call_seconds", "Latenz externer Aufrufe (Telegram, Firestore, Sheets, OpenAI, GitHub, Bring)",
+    ("service", "op"),
+)
+EXTERNAL_ERRORS = Counter(
+    "foodbot_external_call_errors_total", "Fehlgeschlagene externe Aufrufe",
+    ("service", "op"),
+)
+SHEETS_CACHE = Counter(
+    "foodbot_sheets_cache_total", "Sheets-Cache (Firestore-Snapshot) Treffer/Fehlschläge",
+    ("sheet", "result"),
+)
+LANE_WAIT_SECONDS = Histogram(
+    "foodbot_lane_wait_seconds", "Wartezeit eines Updates bis zum Start (Chat-Lane + globaler Slot)",
+    ("lane",),
+)
+UPDATES_DROPPED = Counter(
+    "foodbot_updates_dropped_total", "Verworfene doppelt zugestellte Updates",
+    ("scope",),
+)
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    "foodbot_rate_limit_wait_seconds", "Wartezeit ausgehender Telegram-Requests im Rate-Limiter",
+    ("prio",),
+)
+RATE_LIMIT_DELAYED = Counter(
+    "foodbot_rate_limit_delayed_total", "Vom Rate-Limiter verzögerte Telegram-Requests",
+    ("prio",),
+)
+RATE_LIMIT_RETRY_AFTER = Counter(
+    "foodbot_rate_limit_retry_after_total", "429-Antworten (RetryAfter) von Telegram",
+    ("endpoint",),
+)
+QUEUE_DEPTH = Gauge("foodbot_update_queue_depth", "Update-Rückstau: PTB-Queue + wartende/laufende Updates im Prozessor")
+STORE_SIZE = Gauge("foodbot_store_entries", "Einträge in In-Memory-Stores/Caches", ("store",))
+HTTP_POOL = Gauge("foodbot_http_pool", "Telegram-HTTP-Pools: Requests, laufende/wartende Requests, Pool-Timeouts", ("pool", "stat"))
+
+
+@contextmanager
+def timed(service: str, op: str):
+    """
+    Misst die Dauer des Blocks als externen Aufruf; Exceptions zählen als
+    Fehler. Läuft ein Update-Trace, wird der Aufruf dort als Span angehängt.
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        EXTERNAL_ERRORS.inc(service=service, op=op)
+        raise
+    finally:
+        dt = time.perf_counter() - t0
+        EXTERNAL_SECONDS.observe(dt, service=service, op=op)
+        tracing.record(f"{service}.{op}", dt)
@@ -1,12 +1,23 @@
 # persistence.py
 # Einheitliche Persistenz-API für Profile, Favoriten und Sessions.
-# Backend umschaltbar per Env: PERSISTENCE=json (Default) oder firestore.
+# Backend umschaltbar per Env: PERSISTENCE=json (Default), sqlite oder firestore.
 
 import os
 import json
-from datetime import datetime
+import time
+import asyncio
+import atexit
+import logging
+import sqlite3
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from copy import deepcopy
+from datetime import datetime, timezone
 from typing import Dict, Any, List, Optional
 
+from metrics import timed
+
 # ---------------------------------------------------------------------------
 # Public API (nutzen wir später im Bot)
 # ---------------------------------------------------------------------------
@@ -20,46 +31,358 @@ def chat_key(tg_chat_id: int) -> str:
     return f"c:{tg_chat_id}"
 
 # ---- Profile
+# Lesen geht durch den Read-Through-Cache (siehe _TTLCache), Schreiben
+# aktualisiert ihn (write-through) – der Bot hält keine eigenen Kopien mehr.
 def get_profile(uid: str) -> Optional[Dict[str, Any]]:
-    return _backend().get_profile(uid)
+    c = _cache("profiles")
+    hit = c.lookup(uid)
+    if hit is not _MISS:
+        return hit
+    v = c.version(uid)
+    return c.fill(uid, _backend().get_profile(uid), v)
 
 def set_profile(uid: str, data: Dict[str, Any]) -> None:
     d = dict(data)
     d.setdefault("created_at", _now_iso())
     d["updated_at"] = _now_iso()
     _backend().set_profile(uid, d)
+    _cache("profiles").store(uid, d)
 
 def delete_profile(uid: str) -> None:
     _backend().delete_profile(uid)
+    _cache("profiles").store(uid, None)
 
 # ---- Favoriten (Array von String-Namen)
 def get_favorites(uid: str) -> List[str]:
-    return _backend().get_favorites(uid)
+    c = _cache("favorites")
+    hit = c.lookup(uid)
+    if hit is not _MISS:
+        return hit
+    v = c.version(uid)
+    return c.fill(uid, _backend().get_favorites(uid), v)
 
 def set_favorites(uid: str, items: List[str]) -> None:
-    _backend().set_favorites(uid, _unique(items))
+    items = _unique(items)
+    _backend().set_favorites(uid, items)
+    _cache("favorites").store(uid, items)
 
+# Einzel-/Batch-Änderungen ohne vorheriges Lesen: Firestore nutzt
+# ArrayUnion/ArrayRemove (serverseitig, kein Lost Update zwischen Geräten),
+# SQLite je ein Statement. Reihenfolge: neue Einträge hinten angehängt.
 def add_favorite(uid: str, item: str) -> None:
-    cur = get_favorites(uid)
-    cur.append(item)
-    set_favorites(uid, cur)
+    add_favorites(uid, [item])
 
 def remove_favorite(uid: str, item: str) -> None:
-    cur = [x for x in get_favorites(uid) if x != item]
-    set_favorites(uid, cur)
+    remove_favorites(uid, [item])
+
+def add_favorites(uid: str, items: List[str]) -> None:
+    items = _unique(items)
+    if items:
+        _backend().add_favorites(uid, items)
+        _cache_fav_delta(uid, add=items)
+
+def remove_favorites(uid: str, items: List[str]) -> None:
+    items = _unique(items)
+    if items:
+        _backend().remove_favorites(uid, items)
+        _cache_fav_delta(uid, remove=items)
 
 # ---- Sessions (aktueller Menü-/Planungszustand)
+# Schreibzugriffe laufen über den Write-Behind-Puffer (siehe _WriteBehind):
+# mehrere set_session() pro Chat innerhalb des Fensters → ein Backend-Write.
+# Der Cache hält das lebende Dict des Bots, der Puffer einen Snapshot.
 def get_session(cid: str) -> Optional[Dict[str, Any]]:
-    return _backend().get_session(cid)
+    c = _cache("sessions")
+    hit = c.lookup(cid)
+    if hit is not _MISS:
+        return hit
+    v = c.version(cid)
+    pending = _write_behind().peek(cid)
+    if pending is not None:
+        return c.fill(cid, pending, v)          # read-your-writes
+    return _resolve_session(c, cid, _backend().get_session(cid), v)
 
 def set_session(cid: str, sess: Dict[str, Any]) -> None:
-    d = dict(sess)
+    _buffer_session(cid, sess)
+    _cache("sessions").store(cid, sess)
+
+def delete_session(cid: str) -> None:
+    _write_behind().discard_and(cid, lambda: _backend().delete_session(cid))
+    _cache("sessions").store(cid, None)
+
+def flush_sessions(cid: Optional[str] = None) -> None:
+    """Schreibt gepufferte Sessions sofort (alle oder nur cid)."""
+    _write_behind().flush(cid)
+
+def session_write_stats() -> Dict[str, Any]:
+    """Kennzahlen des Write-Behind-Puffers (Coalescing, Flush-Latenz)."""
+    return _write_behind().stats()
+
+# ---- Gemerkte Pläne (Liste finalisierter Pläne inkl. Basis-Aggregat)
+def get_pinned_plans(uid: str) -> List[Dict[str, Any]]:
+    c = _cache("plans")
+    hit = c.lookup(uid)
+    if hit is not _MISS:
+        return hit
+    v = c.version(uid)
+    return c.fill(uid, _backend().get_pinned_plans(uid), v)
+
+def set_pinned_plans(uid: str, plans: List[Dict[str, Any]]) -> None:
+    plans = list(plans)
+    _backend().set_pinned_plans(uid, plans)
+    _cache("plans").store(uid, plans)
+
+def delete_pinned_plans(uid: str) -> None:
+    _backend().delete_pinned_plans(uid)
+    _cache("plans").store(uid, [])
+
+# ---- PTB-Zustand (user_data/chat_data/Conversations, siehe StorePersistence im Bot)
+# Ungecacht: PTB hält die Daten ohnehin im Speicher. Geschrieben wird
+# gesammelt über UnitOfWork.set_ptb_state()/delete_ptb_state().
+def get_ptb_state(key: str) -> Optional[Dict[str, Any]]:
+    return _backend().get_ptb_state(key)
+
+def get_ptb_states(prefix: str, page: int = 500) -> Dict[str, Dict[str, Any]]:
+    """Alle PTB-Einträge, deren Schlüssel mit prefix beginnt (seitenweise per scan())."""
+    be, out, after = _backend(), {}, prefix
+    while True:
+        rows = be.scan("ptb_state", after, page)
+        for key, doc in rows:
+            if not key.startswith(prefix):
+                return out
+            out[key] = doc
+        if len(rows) < page:
+            return out
+        after = rows[-1][0]
+
+# ---- Update-Deduplizierung über Instanzen hinweg
+# claim_update() „reserviert“ eine Telegram-update_id atomar: True = erste
+# Instanz, die sie sieht; False = Duplikat. Einträge verfallen nach ttl Sek.
+def claim_update(update_id: int, ttl: int = 3600) -> bool:
+    return _backend().claim_update(update_id, ttl)
+
+# ---- Unit of Work (mehrere Entitäten, ein Commit)
+class UnitOfWork:
+    """
+    Sammelt Änderungen an Profil, Favoriten, Session und Plänen während eines
+    Handlers und schreibt sie am Ende gemeinsam: Firestore als ein WriteBatch,
+    SQLite als eine Transaktion, JSON als je ein Datei-Write pro Namespace.
+    Entweder alles oder nichts – halb zurückgesetzte Nutzer gibt es nicht mehr.
+
+        uow = unit_of_work()
+        uow.delete_session(cid); uow.set_favorites(uid, []); uow.delete_profile(uid)
+        await uow.acommit()
+    """
+
+    def __init__(self):
+        self._ops: List[tuple] = []          # (namespace, key, value|None=löschen)
+
+    def set_profile(self, uid: str, data: Dict[str, Any]) -> "UnitOfWork":
+        d = dict(data)
+        d.setdefault("created_at", _now_iso())
+        d["updated_at"] = _now_iso()
+        self._ops.append(("profiles", uid, d)); return self
+
+    def delete_profile(self, uid: str) -> "UnitOfWork":
+        self._ops.append(("profiles", uid, None)); return self
+
+    def set_favorites(self, uid: str, items: List[str]) -> "UnitOfWork":
+        self._ops.append(("favorites", uid, _unique(items))); return self
+
+    def set_session(self, cid: str, sess: Dict[str, Any]) -> "UnitOfWork":
+        d = deepcopy(sess)
+        d.setdefault("created_at", _now_iso())
+        d["updated_at"] = _now_iso()
+        self._ops.append(("sessions", cid, d)); return self
+
+    def delete_session(self, cid: str) -> "UnitOfWork":
+        self._ops.append(("sessions", cid, None)); return self
+
+    def set_pinned_plans(self, uid: str, plans: List[Dict[str, Any]]) -> "UnitOfWork":
+        self._ops.append(("plans", uid, list(plans))); return self
+
+    def delete_pinned_plans(self, uid: str) -> "UnitOfWork":
+        self._ops.append(("plans", uid, None)); return self
+
+    def set_ptb_state(self, key: str, data: Dict[str, Any]) -> "UnitOfWork":
+        self._ops.append(("ptb_state", key, data)); return self
+
+    def delete_ptb_state(self, key: str) -> "UnitOfWork":
+        self._ops.append(("ptb_state", key, None)); return self
+
+    def commit(self) -> None:
+        if not self._ops:
+            return
+        self._drop_pending_sessions()
+        _backend().commit_batch(self._ops)
+        self._apply_to_cache()
+
+    async def acommit(self) -> None:
+        if not self._ops:
+            return
+        await asyncio.to_thread(self._drop_pending_sessions)
+        await _acall("commit_batch", self._ops)
+        self._apply_to_cache()
+
+    def _drop_pending_sessions(self) -> None:
+        # gepufferte Session-Snapshots dürfen den Batch nicht nachträglich überholen
+        for ns, key, _ in self._ops:
+            if ns == "sessions":
+                _write_behind().discard_and(key, lambda: None)
+
+    def _apply_to_cache(self) -> None:
+        empty = {"favorites": [], "plans": []}
+        for ns, key, value in self._ops:
+            if ns in _CACHE_TTL_DEFAULTS:
+                _cache(ns).store(key, empty.get(ns) if value is None else value)
+        self._ops = []
+
+def unit_of_work() -> UnitOfWork:
+    return UnitOfWork()
+
+# ---- Cache-Zugriff ohne I/O (für die dict-artigen Sichten im Bot)
+def cache_peek(namespace: str, key: str) -> Optional[Any]:
+    """Gecachter Wert (auch wenn die TTL abgelaufen ist) oder None – nie I/O."""
+    return _cache(namespace).peek(key)
+
+def cache_put(namespace: str, key: str, value: Any) -> None:
+    """Legt einen Wert nur lokal in den Cache (ohne Backend-Write)."""
+    _cache(namespace).store(key, value)
+
+def cache_invalidate(namespace: str, key: str) -> None:
+    """Verwirft den Cache-Eintrag; der nächste get_* liest wieder aus dem Backend."""
+    _cache(namespace).invalidate(key)
+
+def cache_stats() -> Dict[str, Any]:
+    """Trefferquote, Größe und Verdrängungen je Namespace (serialisiert alle Werte – nicht pro Request)."""
+    return {ns: c.stats() for ns, c in _caches().items()}
+
+def cache_sizes() -> Dict[str, int]:
+    """Nur die Eintragszahl je Namespace – billig, z. B. für /metrics."""
+    return {ns: len(c) for ns, c in _caches().items()}
+
+# ---------------------------------------------------------------------------
+# Async-API (für die PTB-Handler): blockiert den Event-Loop nie.
+# Firestore → nativer AsyncClient; JSON/SQLite → Thread-Offload.
+# ---------------------------------------------------------------------------
+
+async def aget_profile(uid: str) -> Optional[Dict[str, Any]]:
+    return await _aread("profiles", "get_profile", uid)
+
+async def aset_profile(uid: str, data: Dict[str, Any]) -> None:
+    d = dict(data)
     d.setdefault("created_at", _now_iso())
     d["updated_at"] = _now_iso()
-    _backend().set_session(cid, d)
+    await _acall("set_profile", uid, d)
+    _cache("profiles").store(uid, d)
 
-def delete_session(cid: str) -> None:
-    _backend().delete_session(cid)
+async def adelete_profile(uid: str) -> None:
+    await _acall("delete_profile", uid)
+    _cache("profiles").store(uid, None)
+
+async def aget_favorites(uid: str) -> List[str]:
+    return await _aread("favorites", "get_favorites", uid)
+
+async def aset_favorites(uid: str, items: List[str]) -> None:
+    items = _unique(items)
+    await _acall("set_favorites", uid, items)
+    _cache("favorites").store(uid, items)
+
+async def aadd_favorite(uid: str, item: str) -> None:
+    await aadd_favorites(uid, [item])
+
+async def aremove_favorite(uid: str, item: str) -> None:
+    await aremove_favorites(uid, [item])
+
+async def aadd_favorites(uid: str, items: List[str]) -> None:
+    items = _unique(items)
+    if items:
+        await _acall("add_favorites", uid, items)
+        _cache_fav_delta(uid, add=items)
+
+async def aremove_favorites(uid: str, items: List[str]) -> None:
+    items = _unique(items)
+    if items:
+        await _acall("remove_favorites", uid, items)
+        _cache_fav_delta(uid, remove=items)
+
+async def aget_session(cid: str) -> Optional[Dict[str, Any]]:
+    c = _cache("sessions")
+    hit = c.lookup(cid)
+    if hit is not _MISS:
+        return hit
+    v = c.version(cid)
+    pending = _write_behind().peek(cid)
+    if pending is not None:
+        return c.fill(cid, pending, v)
+    return _resolve_session(c, cid, await _acall("get_session", cid), v)
+
+def _resolve_session(c: "_TTLCache", cid: str, remote: Optional[Dict[str, Any]], v: int):
+    """
+    Abgelaufener Session-Cache: trägt das Backend noch den Stempel, den
+    diese Instanz zuletzt geschrieben hat, hat niemand sonst geschrieben →
+    gecachtes Dict behalten (der Bot mutiert es in-place). Sonst gewinnt
+    der Stand aus dem Backend (andere Instanz hat geschrieben/gelöscht) –
+    auch „nicht vorhanden“: ohne eigenen Stempel beweist nichts, dass die
+    gecachte Kopie neuer ist als das Löschen.
+    """
+    cached = c.peek(cid)
+    if cached is not None and isinstance(remote, dict):
+        ours = _write_behind().persisted_stamp(cid)
+        if ours is not None and ours == remote.get("updated_at"):
+            return c.fill(cid, cached, v)
+    return c.fill(cid, remote, v)
+
+async def aset_session(cid: str, sess: Dict[str, Any]) -> None:
+    wb = _write_behind()
+    if wb.window > 0:
+        set_session(cid, sess)                      # nur Puffer, kein I/O
+    else:
+        await asyncio.to_thread(set_session, cid, sess)
+
+async def adelete_session(cid: str) -> None:
+    await asyncio.to_thread(delete_session, cid)    # wartet ggf. auf laufenden Flush
+
+async def aflush_sessions(cid: Optional[str] = None) -> None:
+    await asyncio.to_thread(flush_sessions, cid)
+
+async def aget_pinned_plans(uid: str) -> List[Dict[str, Any]]:
+    return await _aread("plans", "get_pinned_plans", uid)
+
+async def aset_pinned_plans(uid: str, plans: List[Dict[str, Any]]) -> None:
+    plans = list(plans)
+    await _acall("set_pinned_plans", uid, plans)
+    _cache("plans").store(uid, plans)
+
+async def adelete_pinned_plans(uid: str) -> None:
+    await _acall("delete_pinned_plans", uid)
+    _cache("plans").store(uid, [])
+
+async def aget_ptb_state(key: str) -> Optional[Dict[str, Any]]:
+    return await _acall("get_ptb_state", key)
+
+async def aget_ptb_states(prefix: str) -> Dict[str, Dict[str, Any]]:
+    return await asyncio.to_thread(get_ptb_states, prefix)
+
+async def aclaim_update(update_id: int, ttl: int = 3600) -> bool:
+    return await _acall("claim_update", update_id, ttl)
+
+async def _aread(namespace: str, method: str, key: str):
+    """Read-Through: Cache-Treffer ohne I/O, sonst Backend + Cache füllen."""
+    c = _cache(namespace)
+    hit = c.lookup(key)
+    if hit is not _MISS:
+        return hit
+    v = c.version(key)
+    return c.fill(key, await _acall(method, key), v)
+
+async def _acall(method: str, *args):
+    be = _backend()
+    if isinstance(be, _FirestoreBackend):
+        with timed("firestore", method):
+            return await getattr(_AsyncFirestoreBackend.instance(), method)(*args)
+    with timed(be.__class__.__name__.strip("_").replace("Backend", "").lower(), method):
+        return await asyncio.to_thread(getattr(be, method), *args)
 
 # ---------------------------------------------------------------------------
 # Backend Switch
@@ -69,8 +392,109 @@ def _backend():
     mode = (os.getenv("PERSISTENCE") or "json").strip().lower()
     if mode == "firestore":
         return _FirestoreBackend.instance()
+    if mode == "sqlite":
+        return _SqliteBackend.instance()
     return _JsonBackend.instance()
 
+NAMESPACES = ("profiles", "favorites", "sessions", "plans", "ptb_state")
+
+def open_backend(mode: str, data_dir: Optional[str] = None):
+    """
+    Eigene Backend-Instanz (nicht der Singleton des Bots) – z. B. für
+    persistence_migrate.py. Jede Instanz kann scan() (seitenweise lesen,
+    sortiert nach Schlüssel), commit_batch() (UnitOfWork-Ops schreiben) und
+    location() (aufgelöster Speicherort, z. B. um Quelle = Ziel zu erkennen).
+    """
+    mode = (mode or "json").strip().lower()
+    if mode == "firestore":
+        return _FirestoreBackend()
+    if mode == "sqlite":
+        return _SqliteBackend(data_dir)
+    if mode == "json":
+        return _JsonBackend(data_dir)
+    raise ValueError(f"Unbekanntes Backend: {mode}")
+
+_WB = None
+_WB_LOCK = threading.Lock()
+
+def _write_behind() -> "_WriteBehind":
+    global _WB
+    if _WB is None:
+        with _WB_LOCK:
+            if _WB is None:
+                _WB = _WriteBehind(float(os.getenv("SESSION_WRITE_BEHIND_MS", "750")) / 1000.0)
+                atexit.register(_WB.flush)
+    return _WB
+
+# TTL je Namespace in Sekunden (0 = kein Ablauf). Sessions laufen kurz ab,
+# weil Updates eines Chats auf verschiedenen Instanzen landen können; nach
+# Ablauf entscheidet der updated_at-Stempel (siehe _resolve_session).
+_CACHE_TTL_DEFAULTS = {"profiles": 300, "favorites": 300, "plans": 300, "sessions": 30}
+_CACHES: Dict[str, "_TTLCache"] = {}
+_CACHES_LOCK = threading.Lock()
+
+def _buffer_session(cid: str, sess: Dict[str, Any]) -> None:
+    sess.setdefault("created_at", _now_iso())   # einmal pro Session, nicht pro Write
+    d = deepcopy(sess)            # Snapshot – der Bot mutiert sein Dict weiter
+    d["updated_at"] = _now_iso()
+    _write_behind().put(cid, d)
+
+def _spill_session(cid: str, sess: Dict[str, Any]) -> None:
+    # Sessions mutiert der Bot in-place → ungesicherte lokale Änderungen vor
+    # dem Verdrängen sichern. Nur gelesene (nie hier geschriebene) und
+    # unveränderte Sessions kosten nichts. Der Stempel bleibt der des
+    # letzten eigenen Writes: ein Spill ist keine neue Änderung und darf
+    # einen neueren Stand einer anderen Instanz nicht „überholen“.
+    if not sess:
+        return
+    base = _write_behind().local_base(cid)
+    if base is None:
+        return
+    d = _json_norm(sess)
+    d["created_at"] = base.get("created_at", d.get("created_at"))
+    d["updated_at"] = base.get("updated_at")
+    if d != base:
+        _write_behind().put(cid, d)
+
+def _caches() -> Dict[str, "_TTLCache"]:
+    if len(_CACHES) < len(_CACHE_TTL_DEFAULTS):
+        with _CACHES_LOCK:
+            maxsize = int(os.getenv("PERSISTENCE_CACHE_MAX", "5000"))
+            idle = float(os.getenv("PERSISTENCE_CACHE_IDLE", "3600"))
+            for ns, ttl in _CACHE_TTL_DEFAULTS.items():
+                if ns not in _CACHES:
+                    ttl = float(os.getenv(f"PERSISTENCE_CACHE_TTL_{ns.upper()}", str(ttl)))
+                    spill = _spill_session if ns == "sessions" else None
+                    _CACHES[ns] = _TTLCache(ns, ttl, maxsize, idle=idle, on_evict=spill)
+    return _CACHES
+
+def cache_sweep() -> int:
+    """Idle-Einträge aller Namespaces verdrängen (z. B. periodisch aufrufen)."""
+    return sum(c.sweep() for c in _caches().values())
+
+def _cache(namespace: str) -> "_TTLCache":
+    return _caches()[namespace]
+
+def _cache_fav_delta(uid: str, add: List[str] = (), remove: List[str] = ()) -> None:
+    """Wendet eine Favoriten-Änderung auf den Cache an (ohne Backend-Read)."""
+    c = _cache("favorites")
+    cur = c.current(uid)
+    if cur is _MISS or cur is None:
+        c.invalidate(uid)           # nichts Frisches da → beim nächsten get_* laden
+        return
+    rm = set(remove)
+    c.store(uid, _unique([x for x in cur if x not in rm] + list(add)))
+
+def _path_parent(doc: Dict[str, Any], path: tuple) -> Dict[str, Any]:
+    for k in path[:-1]:
+        doc = doc.setdefault(k, {})
+    return doc
+
+def _sqlite_path(path: tuple) -> str:
+    if any('"' in k for k in path):
+        raise ValueError("Schlüssel mit Anführungszeichen")   # → voller Write
+    return "$" + "".join(f'."{k}"' for k in path)
+
 def _unique(items: List[str]) -> List[str]:
     seen, out = set(), []
     for x in items:
@@ -81,6 +505,397 @@ def _unique(items: List[str]) -> List[str]:
 def _now_iso() -> str:
     return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
+# ---------------------------------------------------------------------------
+# Read-Through-Cache
+# ---------------------------------------------------------------------------
+
+_MISS = object()
+
+class _TTLCache:
+    """
+    LRU-Cache mit TTL für einen Namespace. Jeder Eintrag trägt eine
+    Versionsnummer, die bei jedem store() steigt: ein Backend-Read, der
+    während eines Writes unterwegs war, überschreibt den neueren Wert nicht
+    (fill() mit veralteter Version gibt den Cache-Inhalt zurück).
+    Auch „nicht vorhanden“ (None) wird gecacht.
+
+    Speicher bleibt beschränkt: maxsize (LRU) und idle (Sekunden ohne
+    Zugriff, 0 = aus). Verdrängte, noch nicht abgelaufene Einträge gehen an
+    on_evict (Spill ins Backend, z. B. Sessions in den Write-Behind-Puffer);
+    abgelaufene sind evtl. überholt und werden nur verworfen.
+    """
+
+    _SWEEP_EVERY = 30.0          # Sekunden zwischen zwei Idle-Sweeps
+
+    def __init__(self, name: str, ttl: float, maxsize: int, idle: float = 0.0, on_evict=None):
+        self.name = name
+        self.ttl = ttl
+        self.idle = idle
+        self.maxsize = max(1, maxsize)
+        self.on_evict = on_evict
+        self._data: "OrderedDict[str, list]" = OrderedDict()   # key → [value, expires, version, last_access]
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + self._SWEEP_EVERY
+        self.hits = self.misses = self.stale = self.evictions = self.idle_evictions = 0
+
+    def _expiry(self) -> float:
+        return time.monotonic() + self.ttl if self.ttl > 0 else float("inf")
+
+    def lookup(self, key: str):
+        """Frischer Wert oder _MISS (abgelaufen zählt als Miss)."""
+        with self._lock:
+            e = self._data.get(key)
+            if e is None:
+                self.misses += 1
+                return _MISS
+            now = time.monotonic()
+            if e[1] < now:
+                self.stale += 1
+                return _MISS
+            e[3] = now
+            self._data.move_to_end(key)
+            self.hits += 1
+            return e[0]
+
+    def peek(self, key: str):
+        with self._lock:
+            e = self._data.get(key)
+            if e is None:
+                return None
+            e[3] = time.monotonic()
+            self._data.move_to_end(key)
+            return e[0]
+
+    def current(self, key: str):
+        """Wie lookup(), aber ohne Statistik/LRU-Update (für Delta-Updates)."""
+        with self._lock:
+            e = self._data.get(key)
+            if e is None or e[1] < time.monotonic():
+                return _MISS
+            return e[0]
+
+    def version(self, key: str) -> int:
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def store(self, key: str, value) -> None:
+        with self._lock:
+            evicted = self._put(key, value, self._versions.get(key, 0) + 1)
+        self._spill(evicted)
+        self.maybe_sweep()
+
+    def fill(self, key: str, value, seen_version: int):
+        """Übernimmt einen Backend-Read – außer es wurde inzwischen geschrieben."""
+        with self._lock:
+            cur = self._versions.get(key, 0)
+            if cur != seen_version:
+                e = self._data.get(key)
+                return e[0] if e is not None else value
+            evicted = self._put(key, value, cur)
+        self._spill(evicted)
+        return value
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._versions[key] = self._versions.get(key, 0) + 1
+            if len(self._versions) > 2 * self.maxsize:
+                self._versions = {k: v for k, v in self._versions.items() if k in self._data}
+
+    def maybe_sweep(self) -> None:
+        if self.idle > 0 and time.monotonic() >= self._next_sweep:
+            self.sweep()
+
+    def sweep(self) -> int:
+        """Verdrängt alle Einträge ohne Zugriff seit idle Sekunden."""
+        now = time.monotonic()
+        with self._lock:
+            self._next_sweep = now + self._SWEEP_EVERY
+            if self.idle <= 0:
+                return 0
+            evicted = []
+            # _data ist nach letztem Zugriff sortiert → vorne die ältesten
+            while self._data:
+                key, e = next(iter(self._data.items()))
+                if now - e[3] < self.idle:
+                    break
+                self._data.popitem(last=False)
+                self._versions.pop(key, None)
+                if e[1] >= now:
+                    evicted.append((key, e[0]))
+            self.idle_evictions += len(evicted)
+        self._spill(evicted)
+        return len(evicted)
+
+    def _put(self, key: str, value, version: int) -> List[tuple]:
+        self._data[key] = [value, self._expiry(), version, time.monotonic()]
+        self._data.move_to_end(key)
+        self._versions[key] = version
+        evicted = []
+        now = time.monotonic()
+        while len(self._data) > self.maxsize:
+            old, e = self._data.popitem(last=False)
+            self._versions.pop(old, None)
+            self.evictions += 1
+            if e[1] >= now:
+                evicted.append((old, e[0]))
+        return evicted
+
+    def _spill(self, evicted: List[tuple]) -> None:
+        # außerhalb des Locks: der Callback darf I/O machen
+        if not self.on_evict:
+            return
+        for key, value in evicted:
+            if value is None:
+                continue
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logging.warning("Cache-Spill %s/%s fehlgeschlagen: %s", self.name, key, e)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            looked = self.hits + self.misses + self.stale
+            values = [e[0] for e in self._data.values()]
+            st = {
+                "size": len(values),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "idle_evictions": self.idle_evictions,
+                "hit_ratio": round(self.hits / looked, 3) if looked else 0.0,
+            }
+        # grobe Größe: serialisierte Länge der Werte (ohne Python-Overhead)
+        approx = 0
+        for v in values:
+            try:
+                approx += len(json.dumps(v, ensure_ascii=False, default=str))
+            except Exception:
+                pass
+        st["approx_bytes"] = approx
+        return st
+
+# ---------------------------------------------------------------------------
+# Write-Behind für Sessions
+# ---------------------------------------------------------------------------
+
+_DIFF_DEPTH = 2              # session → beilagen → <Gericht>
+_PERSISTED_MAX = 5000        # gemerkte „zuletzt geschrieben“-Stände (LRU)
+_RETRY_MAX = 8               # Fehlversuche je Session, danach verwerfen (mit Error-Log)
+_RETRY_BACKOFF_MAX = 60.0    # Sekunden
+
+def _json_norm(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """So, wie das Backend es speichert (int-Keys → str, Tupel → Listen)."""
+    return json.loads(json.dumps(doc, ensure_ascii=False))
+
+def _diff_paths(old: Dict[str, Any], new: Dict[str, Any], prefix: tuple = (), depth: int = 0):
+    """
+    Feldpfade, die sich von old nach new geändert haben:
+    (sets {pfad-tupel: wert}, deletes [pfad-tupel]). Listen sind atomar.
+    """
+    sets: Dict[tuple, Any] = {}
+    dels: List[tuple] = [prefix + (k,) for k in old.keys() - new.keys()]
+    for k, v in new.items():
+        ov = old.get(k, _MISS)
+        if ov == v:
+            continue
+        if isinstance(v, dict) and isinstance(ov, dict) and v and depth < _DIFF_DEPTH:
+            s, d = _diff_paths(ov, v, prefix + (k,), depth + 1)
+            sets.update(s)
+            dels.extend(d)
+        else:
+            sets[prefix + (k,)] = v
+    return sets, dels
+
+class _WriteBehind:
+    """
+    Coalescing-Puffer pro Session-Schlüssel:
+      - put() merkt nur den letzten Stand je cid (älterer Stand wird verworfen)
+      - ein Daemon-Thread schreibt Einträge, deren erstes put() >= window her ist
+      - flush() schreibt synchron (Konversationsende, Shutdown, atexit)
+      - fehlgeschlagene Writes kommen mit exponentiellem Backoff zurück in
+        den Puffer (außer es liegt schon ein neuerer Stand vor)
+    window <= 0 → direkt durchschreiben (kein Puffer, kein Thread).
+    Geschrieben wird nur das Delta zum zuletzt persistierten Stand
+    (patch_session mit Feldpfaden); ohne bekannten Stand → voller Write.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._pending: Dict[str, tuple] = {}    # cid → (sess, erstes put)
+        self._retries: Dict[str, int] = {}      # cid → bisherige Fehlversuche
+        self._persisted: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._io = threading.Lock()             # serialisiert Writes/Deletes ans Backend
+        self._wake = threading.Event()
+        self._stats = {"requested": 0, "written": 0, "flushes": 0,
+                       "flush_ms_total": 0.0, "flush_ms_max": 0.0, "errors": 0,
+                       "full_writes": 0, "delta_writes": 0, "unchanged": 0, "payload_bytes": 0,
+                       "retries": 0, "dropped": 0, "flush_failures": 0}
+        self._thread = None
+        if self.window > 0:
+            self._thread = threading.Thread(target=self._run, name="session-write-behind", daemon=True)
+            self._thread.start()
+
+    def put(self, cid: str, sess: Dict[str, Any]) -> None:
+        with self._lock:
+            self._stats["requested"] += 1
+            if self.window > 0:
+                first = self._pending.get(cid, (None, time.monotonic()))[1]
+                self._pending[cid] = (sess, first)
+                self._wake.set()
+                return
+        with self._io:
+            self._write([(cid, sess)])
+
+    def peek(self, cid: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._pending.get(cid)
+        return deepcopy(entry[0]) if entry else None
+
+    def discard_and(self, cid: str, action) -> None:
+        """Verwirft den Puffer für cid und führt action (z. B. Delete) exklusiv aus."""
+        with self._io:
+            with self._lock:
+                self._pending.pop(cid, None)
+            self._persisted.pop(cid, None)
+            action()
+
+    def flush(self, cid: Optional[str] = None) -> None:
+        # Entnehmen + Schreiben unter _io, damit ein älterer Stand nie einen neueren überholt
+        with self._io:
+            with self._lock:
+                if cid is None:
+                    batch = [(k, v[0]) for k, v in self._pending.items()]
+                    self._pending.clear()
+                else:
+                    entry = self._pending.pop(cid, None)
+                    batch = [(cid, entry[0])] if entry else []
+            self._write(batch)
+
+    def local_base(self, cid: str) -> Optional[Dict[str, Any]]:
+        """Letzter von hier gepufferter/geschriebener Stand (None = nie geschrieben)."""
+        with self._lock:
+            entry = self._pending.get(cid)
+            if entry is not None:
+                return _json_norm(entry[0])
+            doc = self._persisted.get(cid)
+        return deepcopy(doc) if doc is not None else None
+
+    def persisted_stamp(self, cid: str) -> Optional[str]:
+        """updated_at des zuletzt von hier geschriebenen Stands (None = unbekannt)."""
+        doc = self._persisted.get(cid)
+        return doc.get("updated_at") if doc else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            st = dict(self._stats)
+            st["pending"] = len(self._pending)
+        st["coalescing_ratio"] = round(st["requested"] / st["written"], 2) if st["written"] else None
+        st["flush_ms_avg"] = round(st["flush_ms_total"] / st["flushes"], 2) if st["flushes"] else None
+        return st
+
+    # -- intern (Aufrufer hält _io)
+    def _write(self, batch: List[tuple]) -> None:
+        if not batch:
+            return
+        t0 = time.perf_counter()
+        written = errors = 0
+        kinds = {"full_writes": 0, "delta_writes": 0, "unchanged": 0, "payload_bytes": 0}
+        for cid, sess in batch:
+            try:
+                kind, size = self._write_one(cid, sess)
+                kinds[kind] += 1
+                kinds["payload_bytes"] += size
+                written += kind != "unchanged"
+                self._retries.pop(cid, None)
+            except Exception as e:
+                errors += 1
+                self._persisted.pop(cid, None)
+                self._requeue(cid, sess, e)
+        ms = (time.perf_counter() - t0) * 1000.0
+        with self._lock:
+            self._stats["written"] += written
+            self._stats["errors"] += errors
+            for k, v in kinds.items():
+                self._stats[k] += v
+            self._stats["flushes"] += 1
+            self._stats["flush_ms_total"] += ms
+            self._stats["flush_ms_max"] = max(self._stats["flush_ms_max"], ms)
+
+    def _requeue(self, cid: str, sess: Dict[str, Any], err: Exception) -> None:
+        n = self._retries.get(cid, 0) + 1
+        if self.window <= 0 or n > _RETRY_MAX:
+            self._retries.pop(cid, None)
+            with self._lock:
+                self._stats["dropped"] += 1
+            logging.error("Session-Write für %s endgültig fehlgeschlagen (%d Versuche): %s", cid, n, err)
+            return
+        self._retries[cid] = n
+        backoff = min(_RETRY_BACKOFF_MAX, self.window * (2 ** n))
+        with self._lock:
+            self._stats["retries"] += 1
+            if cid not in self._pending:            # neuerer Stand gewinnt, der ältere ist überholt
+                # fällig, sobald now - first >= window → first in die Zukunft schieben
+                self._pending[cid] = (sess, time.monotonic() + backoff - self.window)
+            self._wake.set()
+        logging.warning("Session-Write für %s fehlgeschlagen (%s) → Retry %d in %.1fs", cid, err, n, backoff)
+
+    def _write_one(self, cid: str, sess: Dict[str, Any]) -> tuple:
+        doc = _json_norm(sess)
+        base = self._persisted.pop(cid, None)
+        kind, size = "full_writes", 0
+        if base is not None:
+            sets, dels = _diff_paths(base, doc)
+            if set(sets) <= {("updated_at",)} and not dels:
+                kind = "unchanged"                  # nur der Zeitstempel → kein Write
+                doc["updated_at"] = base.get("updated_at")
+            else:
+                try:
+                    _backend().patch_session(cid, sets, dels)
+                    kind = "delta_writes"
+                    size = len(json.dumps({".".join(p): v for p, v in sets.items()}, ensure_ascii=False))
+                except Exception as e:
+                    logging.info("Session-Delta für %s nicht möglich (%s) → voller Write", cid, e)
+        if kind == "full_writes":
+            _backend().set_session(cid, doc)
+            size = len(json.dumps(doc, ensure_ascii=False))
+        self._persisted[cid] = doc
+        while len(self._persisted) > _PERSISTED_MAX:
+            self._persisted.popitem(last=False)
+        return kind, size
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait()
+            time.sleep(self.window)
+            now = time.monotonic()
+            batch: List[tuple] = []
+            try:
+                with self._io:
+                    with self._lock:
+                        due = [k for k, (_, first) in self._pending.items() if now - first >= self.window]
+                        batch = [(k, self._pending.pop(k)[0]) for k in due]
+                        if not self._pending:
+                            self._wake.clear()
+                    self._write(batch)
+            except Exception:
+                # außerhalb des Retry-Pfads von _write → sichtbar machen und
+                # den Batch zurücklegen (neuere Stände gewinnen)
+                logging.exception("Session-Write-Behind: Flush von %d Sessions fehlgeschlagen", len(batch))
+                with self._lock:
+                    self._stats["flush_failures"] += 1
+                    self._stats["errors"] += len(batch)
+                    for cid, sess in batch:
+                        self._pending.setdefault(cid, (sess, time.monotonic()))
+                    if self._pending:
+                        self._wake.set()
+
 # ---------------------------------------------------------------------------
 # JSON Backend (Status Quo, /tmp)
 # ---------------------------------------------------------------------------
@@ -94,13 +909,16 @@ class _JsonBackend:
             cls._inst = cls()
         return cls._inst
 
-    def __init__(self):
-        self.data_dir = os.getenv("DATA_DIR", "/tmp")
+    def __init__(self, data_dir: Optional[str] = None):
+        self.data_dir = data_dir or os.getenv("DATA_DIR", "/tmp")
         os.makedirs(self.data_dir, exist_ok=True)
+        self._scan_memo: Optional[tuple] = None
         self.files = {
             "profiles":  os.path.join(self.data_dir, "profiles.json"),
             "favorites": os.path.join(self.data_dir, "favorites.json"),
             "sessions":  os.path.join(self.data_dir, "sessions.json"),
+            "plans":     os.path.join(self.data_dir, "plans.json"),
+            "ptb_state": os.path.join(self.data_dir, "ptb_state.json"),
         }
 
     # -- Helpers
@@ -140,6 +958,18 @@ class _JsonBackend:
         allf[uid] = items
         self._save("favorites", allf)
 
+    def add_favorites(self, uid: str, items: List[str]) -> None:
+        allf = self._load("favorites")
+        cur = allf.get(uid, [])
+        allf[uid] = cur + [x for x in items if x not in cur]
+        self._save("favorites", allf)
+
+    def remove_favorites(self, uid: str, items: List[str]) -> None:
+        allf = self._load("favorites")
+        rm = set(items)
+        allf[uid] = [x for x in allf.get(uid, []) if x not in rm]
+        self._save("favorites", allf)
+
     # -- Sessions
     def get_session(self, cid: str):
         return self._load("sessions").get(cid)
@@ -155,6 +985,293 @@ class _JsonBackend:
             del alls[cid]
             self._save("sessions", alls)
 
+    def patch_session(self, cid: str, sets: Dict[tuple, Any], dels: List[tuple]) -> None:
+        alls = self._load("sessions")
+        if cid not in alls:
+            raise KeyError(cid)
+        for path in dels:
+            _path_parent(alls[cid], path).pop(path[-1], None)
+        for path, value in sets.items():
+            _path_parent(alls[cid], path)[path[-1]] = value
+        self._save("sessions", alls)
+
+    # -- Gemerkte Pläne
+    def get_pinned_plans(self, uid: str) -> List[Dict[str, Any]]:
+        return self._load("plans").get(uid, [])
+
+    def set_pinned_plans(self, uid: str, plans: List[Dict[str, Any]]) -> None:
+        allp = self._load("plans")
+        allp[uid] = plans
+        self._save("plans", allp)
+
+    def delete_pinned_plans(self, uid: str) -> None:
+        allp = self._load("plans")
+        if uid in allp:
+            del allp[uid]
+            self._save("plans", allp)
+
+    # -- PTB-Zustand
+    def get_ptb_state(self, key: str):
+        return self._load("ptb_state").get(key)
+
+    # -- Update-Deduplizierung: JSON liegt pro Instanz lokal, geteilt wird
+    #    nichts – der Ringpuffer im Bot reicht hier völlig.
+    def claim_update(self, update_id: int, ttl: int) -> bool:
+        return True
+
+    def location(self) -> str:
+        """Eindeutiger Speicherort (Migration: Quelle ≠ Ziel prüfen)."""
+        return f"json:{os.path.realpath(self.data_dir)}"
+
+    # -- Seitenweise lesen (Migration). JSON liegt ohnehin als ganze Datei
+    #    vor → einmal laden und über die Seiten hinweg merken.
+    def scan(self, ns: str, after: Optional[str], limit: int) -> List[tuple]:
+        if not self._scan_memo or self._scan_memo[0] != ns:
+            data = self._load(ns)
+            self._scan_memo = (ns, data, sorted(data))
+        _, data, keys = self._scan_memo
+        start = bisect_right(keys, after) if after is not None else 0
+        return [(k, data[k]) for k in keys[start:start + limit]]
+
+    # -- Unit of Work: jede Datei einmal laden und einmal schreiben
+    def commit_batch(self, ops: List[tuple]) -> None:
+        files: Dict[str, Dict[str, Any]] = {}
+        for ns, key, value in ops:
+            data = files.setdefault(ns, self._load(ns))
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        for ns, data in files.items():
+            self._save(ns, data)
+
+# ---------------------------------------------------------------------------
+# SQLite Backend (PERSISTENCE=sqlite) – eine DB-Datei in DATA_DIR, WAL-Modus,
+# eine Zeile pro Schlüssel (Favoriten: eine Zeile pro Eintrag)
+# ---------------------------------------------------------------------------
+
+class _SqliteBackend:
+    _inst = None
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS profiles  (uid TEXT PRIMARY KEY, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS sessions  (cid TEXT PRIMARY KEY, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS plans     (uid TEXT PRIMARY KEY, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS ptb_state (key TEXT PRIMARY KEY, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS favorites ("
+        " uid TEXT NOT NULL, pos INTEGER NOT NULL, item TEXT NOT NULL,"
+        " PRIMARY KEY (uid, item))",
+        "CREATE INDEX IF NOT EXISTS favorites_pos ON favorites (uid, pos)",
+        "CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, ts REAL NOT NULL)",
+    )
+    _CLAIM_PRUNE_EVERY = 256    # alle N Claims abgelaufene update_ids löschen
+
+    @classmethod
+    def instance(cls):
+        if not cls._inst:
+            cls._inst = cls()
+        return cls._inst
+
+    def __init__(self, data_dir: Optional[str] = None):
+        self.data_dir = data_dir or os.getenv("DATA_DIR", "/tmp")
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.path = os.path.join(self.data_dir, os.getenv("SQLITE_FILE", "foodbot.sqlite3"))
+        # Eine Verbindung für alle Threads, serialisiert über den Lock;
+        # sqlite3 cached die (konstanten) Statements als Prepared Statements.
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            for stmt in self._SCHEMA:
+                self._conn.execute(stmt)
+        self._claims = 0
+
+    # -- Helpers
+    def _get_doc(self, table: str, col: str, key: str):
+        with self._lock:
+            row = self._conn.execute(f"SELECT data FROM {table} WHERE {col} = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put_doc(self, table: str, col: str, key: str, data) -> None:
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO {table} ({col}, data) VALUES (?, ?) "
+                f"ON CONFLICT({col}) DO UPDATE SET data = excluded.data",
+                (key, payload),
+            )
+
+    def _del_doc(self, table: str, col: str, key: str) -> None:
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {table} WHERE {col} = ?", (key,))
+
+    # -- Profile
+    def get_profile(self, uid: str):
+        return self._get_doc("profiles", "uid", uid)
+
+    def set_profile(self, uid: str, data: Dict[str, Any]):
+        self._put_doc("profiles", "uid", uid, data)
+
+    def delete_profile(self, uid: str):
+        self._del_doc("profiles", "uid", uid)
+
+    # -- Favoriten
+    def get_favorites(self, uid: str) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT item FROM favorites WHERE uid = ? ORDER BY pos", (uid,)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def set_favorites(self, uid: str, items: List[str]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM favorites WHERE uid = ?", (uid,))
+                self._conn.executemany(
+                    "INSERT INTO favorites (uid, pos, item) VALUES (?, ?, ?)",
+                    [(uid, i, it) for i, it in enumerate(items)],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def add_favorites(self, uid: str, items: List[str]) -> None:
+        # Position = bisheriges Maximum + 1; vorhandene Einträge bleiben (PK uid,item)
+        sql = ("INSERT INTO favorites (uid, pos, item) "
+               "SELECT ?, COALESCE(MAX(pos), -1) + 1, ? FROM favorites WHERE uid = ? "
+               "ON CONFLICT(uid, item) DO NOTHING")
+        with self._lock:
+            if len(items) == 1:
+                self._conn.execute(sql, (uid, items[0], uid))
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(sql, [(uid, it, uid) for it in items])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def remove_favorites(self, uid: str, items: List[str]) -> None:
+        marks = ",".join("?" * len(items))
+        with self._lock:
+            self._conn.execute(
+                f"DELETE FROM favorites WHERE uid = ? AND item IN ({marks})", (uid, *items)
+            )
+
+    # -- Sessions
+    def get_session(self, cid: str):
+        return self._get_doc("sessions", "cid", cid)
+
+    def set_session(self, cid: str, sess: Dict[str, Any]):
+        self._put_doc("sessions", "cid", cid, sess)
+
+    def delete_session(self, cid: str):
+        self._del_doc("sessions", "cid", cid)
+
+    def patch_session(self, cid: str, sets: Dict[tuple, Any], dels: List[tuple]) -> None:
+        # json_remove/json_set auf der data-Spalte: ein UPDATE, nur geänderte Pfade
+        expr, params = "data", []
+        if dels:
+            expr = f"json_remove({expr}, {', '.join('?' * len(dels))})"
+            params += [_sqlite_path(p) for p in dels]
+        if sets:
+            expr = f"json_set({expr}, {', '.join('?, json(?)' for _ in sets)})"
+            for p, v in sets.items():
+                params += [_sqlite_path(p), json.dumps(v, ensure_ascii=False)]
+        with self._lock:
+            cur = self._conn.execute(f"UPDATE sessions SET data = {expr} WHERE cid = ?", (*params, cid))
+        if cur.rowcount == 0:
+            raise KeyError(cid)
+
+    # -- Gemerkte Pläne
+    def get_pinned_plans(self, uid: str) -> List[Dict[str, Any]]:
+        return self._get_doc("plans", "uid", uid) or []
+
+    def set_pinned_plans(self, uid: str, plans: List[Dict[str, Any]]) -> None:
+        self._put_doc("plans", "uid", uid, plans)
+
+    def delete_pinned_plans(self, uid: str) -> None:
+        self._del_doc("plans", "uid", uid)
+
+    # -- PTB-Zustand
+    def get_ptb_state(self, key: str):
+        return self._get_doc("ptb_state", "key", key)
+
+    # -- Update-Deduplizierung (mehrere Prozesse auf derselben DB-Datei)
+    def claim_update(self, update_id: int, ttl: int) -> bool:
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO seen_updates (update_id, ts) VALUES (?, ?)", (update_id, now)
+            )
+            self._claims += 1
+            if self._claims % self._CLAIM_PRUNE_EVERY == 0:
+                self._conn.execute("DELETE FROM seen_updates WHERE ts < ?", (now - ttl,))
+        return cur.rowcount == 1
+
+    def location(self) -> str:
+        return f"sqlite:{os.path.realpath(self.path)}"
+
+    # -- Seitenweise lesen (Migration), Keyset-Pagination über den Primärschlüssel
+    def scan(self, ns: str, after: Optional[str], limit: int) -> List[tuple]:
+        with self._lock:
+            if ns == "favorites":
+                uids = [r[0] for r in self._conn.execute(
+                    "SELECT DISTINCT uid FROM favorites WHERE uid > ? ORDER BY uid LIMIT ?",
+                    (after or "", limit),
+                )]
+                if not uids:
+                    return []
+                out: Dict[str, List[str]] = {u: [] for u in uids}
+                rows = self._conn.execute(
+                    f"SELECT uid, item FROM favorites WHERE uid IN ({','.join('?' * len(uids))}) "
+                    "ORDER BY uid, pos", uids,
+                )
+                for uid, item in rows:
+                    out[uid].append(item)
+                return list(out.items())
+            table, col = self._DOC_TABLES[ns]
+            rows = self._conn.execute(
+                f"SELECT {col}, data FROM {table} WHERE {col} > ? ORDER BY {col} LIMIT ?",
+                (after or "", limit),
+            ).fetchall()
+        return [(k, json.loads(d)) for k, d in rows]
+
+    # -- Unit of Work: eine Transaktion über alle Tabellen
+    _DOC_TABLES = {"profiles": ("profiles", "uid"), "sessions": ("sessions", "cid"),
+                   "plans": ("plans", "uid"), "ptb_state": ("ptb_state", "key")}
+
+    def commit_batch(self, ops: List[tuple]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for ns, key, value in ops:
+                    if ns == "favorites":
+                        self._conn.execute("DELETE FROM favorites WHERE uid = ?", (key,))
+                        self._conn.executemany(
+                            "INSERT INTO favorites (uid, pos, item) VALUES (?, ?, ?)",
+                            [(key, i, it) for i, it in enumerate(value or [])],
+                        )
+                        continue
+                    table, col = self._DOC_TABLES[ns]
+                    if value is None:
+                        self._conn.execute(f"DELETE FROM {table} WHERE {col} = ?", (key,))
+                    else:
+                        self._conn.execute(
+                            f"INSERT INTO {table} ({col}, data) VALUES (?, ?) "
+                            f"ON CONFLICT({col}) DO UPDATE SET data = excluded.data",
+                            (key, json.dumps(value, ensure_ascii=False, separators=(",", ":"))),
+                        )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
 # ---------------------------------------------------------------------------
 # Firestore Backend (wird erst aktiv, wenn PERSISTENCE=firestore)
 # ---------------------------------------------------------------------------
@@ -177,9 +1294,14 @@ class _FirestoreBackend:
                 "Füge es in requirements/Dockerfile hinzu."
             ) from e
         self._fs = firestore.Client()
+        self._array_union, self._array_remove = firestore.ArrayUnion, firestore.ArrayRemove
+        self._delete_field = firestore.DELETE_FIELD
         self._col_profiles  = self._fs.collection("profiles")
         self._col_favorites = self._fs.collection("favorites")
         self._col_sessions  = self._fs.collection("sessions")
+        self._col_plans     = self._fs.collection("plans")
+        self._col_ptb       = self._fs.collection("ptb_state")
+        self._col_seen      = self._fs.collection("seen_updates")
 
     # -- Profile
     def get_profile(self, uid: str):
@@ -204,6 +1326,18 @@ class _FirestoreBackend:
             merge=True
         )
 
+    def add_favorites(self, uid: str, items: List[str]) -> None:
+        self._col_favorites.document(uid).set(
+            {"items": self._array_union(items), "updated_at": _now_iso()},
+            merge=True
+        )
+
+    def remove_favorites(self, uid: str, items: List[str]) -> None:
+        self._col_favorites.document(uid).set(
+            {"items": self._array_remove(items), "updated_at": _now_iso()},
+            merge=True
+        )
+
     # -- Sessions (pro Chat)
     def get_session(self, cid: str):
         doc = self._col_sessions.document(cid).get()
@@ -214,3 +1348,184 @@ class _FirestoreBackend:
 
     def delete_session(self, cid: str):
         self._col_sessions.document(cid).delete()
+
+    def patch_session(self, cid: str, sets: Dict[tuple, Any], dels: List[tuple]) -> None:
+        # update() mit Feldpfaden (Keys wie Gerichtnamen werden gequotet);
+        # wirft NotFound, wenn das Dokument fehlt → Aufrufer schreibt voll
+        from google.cloud.firestore_v1.field_path import FieldPath
+        upd = {FieldPath(*p).to_api_repr(): v for p, v in sets.items()}
+        upd.update({FieldPath(*p).to_api_repr(): self._delete_field for p in dels})
+        self._col_sessions.document(cid).update(upd)
+
+    # -- Gemerkte Pläne (pro User)
+    def get_pinned_plans(self, uid: str) -> List[Dict[str, Any]]:
+        doc = self._col_plans.document(uid).get()
+        d = doc.to_dict() if doc.exists else None
+        return (d.get("items") if d else []) or []
+
+    def set_pinned_plans(self, uid: str, plans: List[Dict[str, Any]]) -> None:
+        # kein merge: die Liste wird als Ganzes ersetzt
+        self._col_plans.document(uid).set({"items": plans, "updated_at": _now_iso()})
+
+    def delete_pinned_plans(self, uid: str) -> None:
+        self._col_plans.document(uid).delete()
+
+    # -- PTB-Zustand
+    def get_ptb_state(self, key: str):
+        doc = self._col_ptb.document(key).get()
+        return doc.to_dict() if doc.exists else None
+
+    # -- Update-Deduplizierung: create() schlägt fehl, wenn das Doc existiert.
+    #    Aufräumen per Firestore-TTL-Policy auf dem Feld „expires_at“.
+    def claim_update(self, update_id: int, ttl: int) -> bool:
+        from google.api_core.exceptions import AlreadyExists
+        try:
+            self._col_seen.document(str(update_id)).create(_seen_doc(ttl))
+            return True
+        except AlreadyExists:
+            return False
+
+    def location(self) -> str:
+        return f"firestore:{self._fs.project}/{getattr(self._fs, '_database', '(default)')}"
+
+    # -- Seitenweise lesen (Migration): nach Dokument-ID, Cursor = letzte ID
+    def scan(self, ns: str, after: Optional[str], limit: int) -> List[tuple]:
+        from google.cloud.firestore_v1.field_path import FieldPath
+        col = {"profiles": self._col_profiles, "favorites": self._col_favorites,
+               "sessions": self._col_sessions, "plans": self._col_plans,
+               "ptb_state": self._col_ptb}[ns]
+        q = col.order_by(FieldPath.document_id())
+        if after is not None:
+            q = q.where(FieldPath.document_id(), ">", col.document(after))
+        out = []
+        for doc in q.limit(limit).stream():
+            d = doc.to_dict() or {}
+            out.append((doc.id, (d.get("items") or []) if ns in ("favorites", "plans") else d))
+        return out
+
+    # -- Unit of Work: ein WriteBatch (atomar, ein Round Trip)
+    def commit_batch(self, ops: List[tuple]) -> None:
+        batch = self._fs.batch()
+        _fill_firestore_batch(self, batch, ops)
+        batch.commit()
+
+def _seen_doc(ttl: int) -> Dict[str, Any]:
+    return {"ts": _now_iso(), "expires_at": datetime.fromtimestamp(time.time() + ttl, timezone.utc)}
+
+def _fill_firestore_batch(be, batch, ops: List[tuple]) -> None:
+    """Übersetzt UnitOfWork-Ops in Batch-Writes (gleiche Semantik wie die Einzel-Setter)."""
+    cols = {"profiles": be._col_profiles, "favorites": be._col_favorites,
+            "sessions": be._col_sessions, "plans": be._col_plans, "ptb_state": be._col_ptb}
+    for ns, key, value in ops:
+        ref = cols[ns].document(key)
+        if value is None:
+            batch.delete(ref)
+        elif ns == "favorites":
+            batch.set(ref, {"items": value, "updated_at": _now_iso()}, merge=True)
+        elif ns == "plans":
+            batch.set(ref, {"items": value, "updated_at": _now_iso()})
+        elif ns == "ptb_state":
+            batch.set(ref, value)
+        else:
+            batch.set(ref, value, merge=True)
+
+# ---------------------------------------------------------------------------
+# Firestore Async Backend (gleiche Collections, google.cloud.firestore.AsyncClient)
+# ---------------------------------------------------------------------------
+
+class _AsyncFirestoreBackend:
+    _inst = None
+
+    @classmethod
+    def instance(cls):
+        if not cls._inst:
+            cls._inst = cls()
+        return cls._inst
+
+    def __init__(self):
+        from google.cloud import firestore
+        self._fs = firestore.AsyncClient()
+        self._array_union, self._array_remove = firestore.ArrayUnion, firestore.ArrayRemove
+        self._col_profiles  = self._fs.collection("profiles")
+        self._col_favorites = self._fs.collection("favorites")
+        self._col_sessions  = self._fs.collection("sessions")
+        self._col_plans     = self._fs.collection("plans")
+        self._col_ptb       = self._fs.collection("ptb_state")
+        self._col_seen      = self._fs.collection("seen_updates")
+
+    async def _get(self, col, key: str):
+        doc = await col.document(key).get()
+        return doc.to_dict() if doc.exists else None
+
+    # -- Profile
+    async def get_profile(self, uid: str):
+        return await self._get(self._col_profiles, uid)
+
+    async def set_profile(self, uid: str, data: Dict[str, Any]):
+        await self._col_profiles.document(uid).set(data, merge=True)
+
+    async def delete_profile(self, uid: str):
+        await self._col_profiles.document(uid).delete()
+
+    # -- Favoriten
+    async def get_favorites(self, uid: str) -> List[str]:
+        d = await self._get(self._col_favorites, uid)
+        return (d.get("items") if d else []) or []
+
+    async def set_favorites(self, uid: str, items: List[str]) -> None:
+        await self._col_favorites.document(uid).set(
+            {"items": items, "updated_at": _now_iso()},
+            merge=True
+        )
+
+    async def add_favorites(self, uid: str, items: List[str]) -> None:
+        await self._col_favorites.document(uid).set(
+            {"items": self._array_union(items), "updated_at": _now_iso()},
+            merge=True
+        )
+
+    async def remove_favorites(self, uid: str, items: List[str]) -> None:
+        await self._col_favorites.document(uid).set(
+            {"items": self._array_remove(items), "updated_at": _now_iso()},
+            merge=True
+        )
+
+    # -- Sessions (pro Chat)
+    async def get_session(self, cid: str):
+        return await self._get(self._col_sessions, cid)
+
+    async def set_session(self, cid: str, sess: Dict[str, Any]):
+        await self._col_sessions.document(cid).set(sess, merge=True)
+
+    async def delete_session(self, cid: str):
+        await self._col_sessions.document(cid).delete()
+
+    # -- Gemerkte Pläne (pro User)
+    async def get_pinned_plans(self, uid: str) -> List[Dict[str, Any]]:
+        d = await self._get(self._col_plans, uid)
+        return (d.get("items") if d else []) or []
+
+    async def set_pinned_plans(self, uid: str, plans: List[Dict[str, Any]]) -> None:
+        await self._col_plans.document(uid).set({"items": plans, "updated_at": _now_iso()})
+
+    async def delete_pinned_plans(self, uid: str) -> None:
+        await self._col_plans.document(uid).delete()
+
+    # -- PTB-Zustand
+    async def get_ptb_state(self, key: str):
+        return await self._get(self._col_ptb, key)
+
+    # -- Update-Deduplizierung
+    async def claim_update(self, update_id: int, ttl: int) -> bool:
+        from google.api_core.exceptions import AlreadyExists
+        try:
+            await self._col_seen.document(str(update_id)).create(_seen_doc(ttl))
+            return True
+        except AlreadyExists:
+            return False
+
+    # -- Unit of Work
+    async def commit_batch(self, ops: List[tuple]) -> None:
+        batch = self._fs.batch()
+        _fill_firestore_batch(self, batch, ops)
+        await batch.commit()
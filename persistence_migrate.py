@@ -0,0 +1,199 @@
+# persistence_migrate.py
+# Streamt Profile, Favoriten, Sessions (und Pläne / PTB-Zustand) von einem
+# Persistenz-Backend in ein anderes – seitenweise, in Batches, fortsetzbar.
+#
+# Beispiele:
+#   python persistence_migrate.py --from json --from-dir /tmp --to sqlite --to-dir ./data
+#   python persistence_migrate.py --from sqlite --to firestore --checkpoint migrate.ckpt.json
+#   python persistence_migrate.py --from firestore --to jsonl --out export.jsonl
+#
+# Speicher bleibt beschränkt: es liegen höchstens (concurrency + 1) Seiten
+# gleichzeitig im Speicher. Der Checkpoint merkt sich je Namespace den letzten
+# Schlüssel, bis zu dem ALLE Seiten geschrieben sind → Abbruch + Neustart
+# setzt dort fort (bereits geschriebene Docs werden idempotent überschrieben).
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Any, List, Optional
+
+import persistence
+
+FIRESTORE_BATCH_MAX = 500      # Limit eines Firestore-WriteBatch
+
+
+class _JsonlSink:
+    """Export-Ziel: eine Zeile {"ns", "key", "value"} pro Dokument."""
+
+    def __init__(self, path: str):
+        self._f = open(path, "a", encoding="utf-8")
+
+    def commit_batch(self, ops: List[tuple]) -> None:
+        for ns, key, value in ops:
+            self._f.write(json.dumps({"ns": ns, "key": key, "value": value}, ensure_ascii=False) + "\n")
+        self._f.flush()
+
+    def close(self) -> None:
+        self._f.close()
+
+
+def _load_checkpoint(path: Optional[str]) -> Dict[str, Any]:
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def _save_checkpoint(path: Optional[str], ckpt: Dict[str, Any]) -> None:
+    if not path:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(ckpt, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)           # atomar – nie ein halber Checkpoint
+
+
+def _write_page(dst, ops: List[tuple], last_key: str) -> tuple:
+    dst.commit_batch(ops)
+    return last_key, len(ops)
+
+
+def migrate_namespace(src, dst, ns: str, *, page_size: int, concurrency: int,
+                      ckpt: Dict[str, Any], ckpt_path: Optional[str], dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Liest ns seitenweise aus src und schreibt jede Seite als einen Batch
+    nach dst (max. concurrency Batches parallel). Rückgabe: Kennzahlen.
+    """
+    state = ckpt.setdefault(ns, {"after": None, "done": False, "docs": 0})
+    if state.get("done"):
+        logging.info("%-10s bereits migriert (Checkpoint) – übersprungen", ns)
+        return {"ns": ns, "docs": 0, "seconds": 0.0, "skipped": True}
+
+    t0 = time.perf_counter()
+    docs = 0
+    after = state.get("after")
+    seq = 0                  # Seitennummer (Lesereihenfolge)
+    next_commit = 0          # kleinste noch nicht bestätigte Seite
+    finished: Dict[int, tuple] = {}          # seq → (letzter Key, Anzahl)
+    inflight: Dict[Any, int] = {}
+
+    def _advance() -> None:
+        # Checkpoint nur über lückenlos fertige Seiten vorrücken
+        # (Dry-Run schreibt nichts → Checkpoint bleibt unangetastet)
+        nonlocal next_commit
+        while next_commit in finished:
+            last_key, n = finished.pop(next_commit)
+            if not dry_run:
+                state["after"] = last_key
+                state["docs"] = state.get("docs", 0) + n
+            next_commit += 1
+        if not dry_run:
+            _save_checkpoint(ckpt_path, ckpt)
+
+    def _reap(block: bool) -> None:
+        nonlocal docs
+        if not inflight:
+            return
+        done, _ = wait(list(inflight), return_when=FIRST_COMPLETED, timeout=None if block else 0)
+        for fut in done:
+            s = inflight.pop(fut)
+            last_key, n = fut.result()          # Fehler → Abbruch, Checkpoint bleibt davor
+            finished[s] = (last_key, n)
+            docs += n
+        _advance()
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        while True:
+            page = src.scan(ns, after, page_size)
+            if not page:
+                break
+            after = page[-1][0]
+            ops = [(ns, key, value) for key, value in page]
+            if dry_run:
+                finished[seq] = (after, len(ops))
+                docs += len(ops)
+                _advance()
+            else:
+                fut = pool.submit(_write_page, dst, ops, after)
+                inflight[fut] = seq
+            seq += 1
+            while len(inflight) >= concurrency:
+                _reap(block=True)
+            _reap(block=False)
+            elapsed = time.perf_counter() - t0
+            logging.info("%-10s %7d Docs  %7.1f Docs/s  (bis %s)", ns, docs, docs / elapsed if elapsed else 0.0, after)
+        while inflight:
+            _reap(block=True)
+
+    if not dry_run:
+        state["done"] = True
+        _save_checkpoint(ckpt_path, ckpt)
+    secs = time.perf_counter() - t0
+    return {"ns": ns, "docs": docs, "seconds": round(secs, 2),
+            "docs_per_sec": round(docs / secs, 1) if secs else None}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Persistenz-Daten zwischen Backends migrieren/exportieren.")
+    ap.add_argument("--from", dest="src", required=True, choices=["json", "sqlite", "firestore"])
+    ap.add_argument("--to", dest="dst", required=True, choices=["json", "sqlite", "firestore", "jsonl"])
+    ap.add_argument("--from-dir", help="DATA_DIR des Quell-Backends (json/sqlite)")
+    ap.add_argument("--to-dir", help="DATA_DIR des Ziel-Backends (json/sqlite)")
+    ap.add_argument("--out", help="Zieldatei für --to jsonl")
+    ap.add_argument("--namespaces", default="profiles,favorites,sessions,plans,ptb_state",
+                    help="Kommagetrennt, Reihenfolge = Migrationsreihenfolge")
+    ap.add_argument("--page-size", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--checkpoint", help="Checkpoint-Datei (fortsetzbar)")
+    ap.add_argument("--dry-run", action="store_true", help="nur lesen und zählen")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    namespaces = [n.strip() for n in args.namespaces.split(",") if n.strip()]
+    unknown = [n for n in namespaces if n not in persistence.NAMESPACES]
+    if unknown:
+        ap.error(f"Unbekannte Namespaces: {', '.join(unknown)}")
+    if args.dst == "jsonl" and not args.out:
+        ap.error("--to jsonl braucht --out")
+
+    page_size = args.page_size
+    if args.dst == "firestore" and page_size > FIRESTORE_BATCH_MAX:
+        logging.warning("page-size %d > Firestore-Batch-Limit → %d", page_size, FIRESTORE_BATCH_MAX)
+        page_size = FIRESTORE_BATCH_MAX
+    concurrency = 1 if args.dst in ("json", "jsonl") else args.concurrency   # Datei-Ziele seriell
+
+    src = persistence.open_backend(args.src, args.from_dir)
+    dst = _JsonlSink(args.out) if args.dst == "jsonl" else persistence.open_backend(args.dst, args.to_dir)
+    # Nach dem Öffnen vergleichen: erst dann sind Defaults (DATA_DIR,
+    # SQLITE_FILE, Firestore-Projekt) und relative Pfade aufgelöst
+    if not isinstance(dst, _JsonlSink) and src.location() == dst.location():
+        ap.error(f"Quelle und Ziel sind identisch ({src.location()})")
+    ckpt = _load_checkpoint(args.checkpoint)
+
+    t0 = time.perf_counter()
+    results = []
+    try:
+        for ns in namespaces:
+            results.append(migrate_namespace(
+                src, dst, ns, page_size=page_size, concurrency=concurrency,
+                ckpt=ckpt, ckpt_path=args.checkpoint, dry_run=args.dry_run,
+            ))
+    finally:
+        if isinstance(dst, _JsonlSink):
+            dst.close()
+
+    total = sum(r["docs"] for r in results)
+    secs = time.perf_counter() - t0
+    for r in results:
+        logging.info("✔ %s", r)
+    logging.info("Gesamt: %d Docs in %.1fs (%.1f Docs/s)", total, secs, total / secs if secs else 0.0)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+# tracing.py
+# Tracing pro Update: jede Update-Verarbeitung bekommt eine Trace-ID und
+# sammelt Spans (Session laden, Katalog filtern, Sampling, Rendern, jeder
+# Telegram-/Persistenz-Aufruf …). Langsame – und optional zufällig
+# gesampelte – Updates landen als EINE JSON-Zeile auf stdout
+# (Cloud Logging liest severity/message/trace direkt aus).
+#
+#   with trace_update(update_id=…, chat_id=…, kind="callback"):
+#       with span("catalog_filter"):
+#           …
+#
+#   @traced("render")            # sync und async
+#   def render_…(…): …
+#
+# Ohne aktiven Trace (Import-Zeit, Jobs) sind span()/record() No-Ops.
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import inspect
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+TRACE_SLOW_MS     = float(os.getenv("TRACE_SLOW_MS", "1000"))      # ab hier immer loggen
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))     # Anteil schneller Updates, die trotzdem geloggt werden
+TRACE_MAX_SPANS   = int(os.getenv("TRACE_MAX_SPANS", "200"))       # Deckel pro Update (Aggregate zählen weiter)
+_GCP_PROJECT      = os.getenv("GOOGLE_CLOUD_PROJECT") or os.getenv("GCP_PROJECT")
+
+_current: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+
+# Eigener Logger ohne Präfix: eine Zeile = ein JSON-Objekt
+_log = logging.getLogger("trace")
+_log.propagate = False
+if not _log.handlers:
+    _h = logging.StreamHandler(sys.stdout)
+    _h.setFormatter(logging.Formatter("%(message)s"))
+    _log.addHandler(_h)
+    _log.setLevel(logging.INFO)
+
+emitted = slow = 0          # Kennzahlen für den Shutdown-Log
+
+
+class Trace:
+    __slots__ = ("trace_id", "attrs", "t0", "spans", "phases", "dropped", "error")
+
+    def __init__(self, **attrs):
+        self.trace_id = uuid.uuid4().hex
+        self.attrs = attrs
+        self.t0 = time.perf_counter()
+        self.spans: List[tuple] = []                # (name, start_ms, dauer_ms)
+        self.phases: Dict[str, list] = {}           # name → [Anzahl, Summe ms]
+        self.dropped = 0
+        self.error: Optional[str] = None
+
+    def add(self, name: str, start: float, duration: float) -> None:
+        ms = duration * 1000
+        ph = self.phases.get(name)
+        if ph is None:
+            ph = self.phases[name] = [0, 0.0]
+        ph[0] += 1
+        ph[1] += ms
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((name, round((start - self.t0) * 1000, 1), round(ms, 1)))
+        else:
+            self.dropped += 1
+
+    def to_log(self, total_ms: float, error: Optional[str]) -> Dict[str, Any]:
+        rec: Dict[str, Any] = {
+            "severity": "ERROR" if error else ("WARNING" if total_ms >= TRACE_SLOW_MS else "INFO"),
+            "message": f"update {self.attrs.get('update_id')} {self.attrs.get('kind', '')} {total_ms:.0f} ms".strip(),
+            "trace_id": self.trace_id,
+            "duration_ms": round(total_ms, 1),
+            **self.attrs,
+            "phases": {k: {"n": n, "ms": round(s, 1)} for k, (n, s) in
+                       sorted(self.phases.items(), key=lambda kv: kv[1][1], reverse=True)},
+            "spans": self.spans,
+        }
+        if self.dropped:
+            rec["spans_dropped"] = self.dropped
+        if error:
+            rec["error"] = error
+        if _GCP_PROJECT:
+            rec["logging.googleapis.com/trace"] = f"projects/{_GCP_PROJECT}/traces/{self.trace_id}"
+        return rec
+
+
+def mark_error(error: str) -> None:
+    """
+    Markiert den laufenden Trace als fehlgeschlagen. Nötig, weil PTB
+    Handler-Exceptions selbst abfängt (process_error) – bis trace_update
+    kommt nie eine Exception durch.
+    """
+    tr = _current.get()
+    if tr is not None and tr.error is None:
+        tr.error = error
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+def current_id() -> Optional[str]:
+    tr = _current.get()
+    return tr.trace_id if tr else None
+
+
+@contextmanager
+def trace_update(**attrs):
+    """Öffnet den Trace eines Updates; beim Verlassen ggf. JSON-Zeile loggen."""
+    global emitted, slow
+    tr = Trace(**attrs)
+    token = _current.set(tr)
+    error = None
+    try:
+        yield tr
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        error = error or tr.error
+        total_ms = (time.perf_counter() - tr.t0) * 1000
+        is_slow = total_ms >= TRACE_SLOW_MS
+        if is_slow or error or (TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE):
+            slow += is_slow
+            emitted += 1
+            try:
+                _log.info(json.dumps(tr.to_log(total_ms, error), ensure_ascii=False, default=str))
+            except Exception:
+                pass
+
+
+def record(name: str, duration: float) -> None:
+    """Bereits gemessene Dauer (Sekunden) als Span anhängen, endend jetzt."""
+    tr = _current.get()
+    if tr is not None:
+        now = time.perf_counter()
+        tr.add(name, now - duration, duration)
+
+@contextmanager
+def span(name: str):
+    tr = _current.get()
+    if tr is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        tr.add(name, t0, time.perf_counter() - t0)
+
+def traced(name: str):
+    """Decorator-Variante von span() für sync- und async-Funktionen."""
+    def deco(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def _aw(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return _aw
+
+        @functools.wraps(fn)
+        def _w(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return _w
+    return deco
+
+def stats() -> Dict[str, Any]:
+    return {"emitted": emitted, "slow": slow, "slow_ms": TRACE_SLOW_MS, "sample_rate": TRACE_SAMPLE_RATE}